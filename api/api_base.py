@@ -1,14 +1,417 @@
 """ Api Base """
 
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+import math
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError
+
 from common.log_manager import LogManager
-from common.utils import get_log_header
+from common.utils import get_log_header, get_tag
+
+
+# Requests sent on each thread that failed with a connection error, a timeout
+# or a server error after their retries
+request_failures = threading.local()
+
+
+def get_request_failure_count() -> int:
+    """
+    Get the number of failed requests sent on the current thread. Comparing
+    the count before and after a call shows if it hit a transient failure
+    that the api logged instead of raising
+    """
+    return getattr(request_failures, "count", 0)
+
+
+def add_request_failure():
+    """ Count a failed request on the current thread """
+    request_failures.count = get_request_failure_count() + 1
+
+
+# Requests sent on each thread inside no_retries are only sent once
+request_retries = threading.local()
+
+
+@contextmanager
+def no_retries():
+    """ Send the requests made on the current thread inside the block without retries """
+    previous_disabled = getattr(request_retries, "disabled", False)
+    request_retries.disabled = True
+    try:
+        yield
+    finally:
+        request_retries.disabled = previous_disabled
+
+
+@dataclass
+class ApiConnectionConfig:
+    """ Class representing the connection settings for an api server """
+    pool_size: int = 10
+    max_retries: int = 2
+    retry_backoff_seconds: float = 0.5
+    retry_backoff_max_seconds: float = 8.0
+    keep_alive: bool = True
+    adaptive_timeout: bool = True
+    max_timeout_seconds: float = 60.0
+    health_cache_seconds: float = 10.0
+    circuit_failure_threshold: int = 3
+    circuit_open_seconds: float = 30.0
+    rate_limit: float = 0.0
+    rate_burst: int = 10
+    max_in_flight: int = 0
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive connection failures to a server. After too many
+    failures the circuit opens and requests fail fast until the open time
+    has passed, then a single trial request is let through
+    """
+
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.consecutive_failures: int = 0
+        self.open_until: float = 0.0
+        self.lock = threading.Lock()
+
+    def get_open(self) -> bool:
+        """ Get if requests to the server should currently fail fast """
+        with self.lock:
+            return (
+                self.consecutive_failures >= self.failure_threshold
+                and time.monotonic() < self.open_until
+            )
+
+    def allow_request(self) -> bool:
+        """
+        Get if a request may be sent. When the open time has passed the
+        circuit is half open and one trial request is allowed
+        """
+        with self.lock:
+            if self.consecutive_failures < self.failure_threshold:
+                return True
+
+            current_time = time.monotonic()
+            if current_time < self.open_until:
+                return False
+
+            # Half open, hold the circuit open while the trial request runs
+            self.open_until = current_time + self.open_seconds
+            return True
+
+    def record_success(self):
+        """ Close the circuit after a successful request """
+        with self.lock:
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+
+    def record_failure(self):
+        """ Record a connection failure and open the circuit at the threshold """
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.open_seconds
+
+
+class RequestGovernor:
+    """
+    Limits the requests sent to a server with a token bucket refilled at
+    rate_limit requests per second and a cap on the requests in flight.
+    Requests over either limit wait in a queue. A rate limit or max in
+    flight of 0 disables that limit
+    """
+
+    def __init__(
+        self,
+        rate_limit: float,
+        rate_burst: int,
+        max_in_flight: int,
+        log_header: str,
+        log_manager: LogManager
+    ):
+        self.rate_limit = max(0.0, rate_limit)
+        self.rate_burst = float(max(1, rate_burst))
+        self.max_in_flight = max(0, max_in_flight)
+        self.log_header = log_header
+        self.log_manager = log_manager
+        self.condition = threading.Condition()
+
+        self.tokens: float = self.rate_burst
+        self.refill_time: float = time.monotonic()
+        self.in_flight: int = 0
+        self.queue_depth: int = 0
+
+        # Deepest queue since the last report, logged at most every report_seconds
+        self.peak_queue_depth: int = 0
+        self.report_seconds: float = 60.0
+        self.report_time: float = time.monotonic()
+
+    def get_enabled(self) -> bool:
+        """ Get if any limit is configured """
+        return self.rate_limit > 0 or self.max_in_flight > 0
+
+    def get_queue_depth(self) -> int:
+        """ Get the number of requests currently waiting to be sent """
+        with self.condition:
+            return self.queue_depth
+
+    def get_in_flight(self) -> int:
+        """ Get the number of requests currently being sent """
+        with self.condition:
+            return self.in_flight
+
+    def __refill(self, current_time: float):
+        """ Add the tokens earned since the last refill. Must be called with the lock held """
+        if self.rate_limit > 0:
+            self.tokens = min(
+                self.rate_burst,
+                self.tokens + ((current_time - self.refill_time) * self.rate_limit)
+            )
+        self.refill_time = current_time
+
+    def acquire(self):
+        """ Wait until a request may be sent """
+        if not self.get_enabled():
+            return
+
+        with self.condition:
+            waiting: bool = False
+            while True:
+                self.__refill(time.monotonic())
+
+                wait_seconds: float = None
+                if self.max_in_flight > 0 and self.in_flight >= self.max_in_flight:
+                    # Woken by release
+                    pass
+                elif self.rate_limit > 0 and self.tokens < 1.0:
+                    wait_seconds = (1.0 - self.tokens) / self.rate_limit
+                else:
+                    break
+
+                if not waiting:
+                    waiting = True
+                    self.queue_depth += 1
+                    self.peak_queue_depth = max(
+                        self.peak_queue_depth, self.queue_depth
+                    )
+                self.condition.wait(wait_seconds)
+
+            if waiting:
+                self.queue_depth -= 1
+            if self.rate_limit > 0:
+                self.tokens -= 1.0
+            self.in_flight += 1
+
+    def release(self):
+        """ Release the slot of a sent request """
+        if not self.get_enabled():
+            return
+
+        report_queue_depth: int = 0
+        with self.condition:
+            self.in_flight -= 1
+            # Token and max in flight waiters share the condition so wake them
+            # all, a single notify could wake a token waiter and strand a slot
+            self.condition.notify_all()
+
+            current_time = time.monotonic()
+            if (
+                self.peak_queue_depth > 0
+                and current_time - self.report_time >= self.report_seconds
+            ):
+                report_queue_depth = self.peak_queue_depth
+                self.peak_queue_depth = 0
+                self.report_time = current_time
+
+        if report_queue_depth > 0:
+            self.log_manager.log_info(
+                f"{self.log_header} Requests waited for the server limits "
+                f"{get_tag("peak_queue_depth", report_queue_depth)} "
+                f"{get_tag("queue_depth", self.get_queue_depth())} "
+                f"{get_tag("in_flight", self.get_in_flight())} "
+                f"{get_tag("rate_limit", self.rate_limit)} "
+                f"{get_tag("max_in_flight", self.max_in_flight)}"
+            )
+
+
+class LatencyTracker:
+    """
+    Keeps the recent latencies of each endpoint of a server. Once an
+    endpoint has enough samples its timeout grows to a multiple of the
+    observed p95 latency so a slow but healthy server is not cut off
+    """
+
+    def __init__(self, enabled: bool, max_timeout_seconds: float):
+        self.enabled = enabled
+        self.max_timeout_seconds = max_timeout_seconds
+        self.sample_size: int = 100
+        self.min_samples: int = 20
+        self.timeout_factor: float = 3.0
+        self.latencies: dict[str, deque[float]] = {}
+        self.lock = threading.Lock()
+
+    def get_endpoint(self, method: str, url: str) -> str:
+        """ Get the endpoint of a request with the ids in its path replaced """
+        return f"{method} {re.sub(r"/[^/]*\d[^/]*", "/{id}", urlsplit(url).path)}"
+
+    def add_latency(self, endpoint: str, seconds: float):
+        """ Record the latency of a request to an endpoint """
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = deque(maxlen=self.sample_size)
+            self.latencies[endpoint].append(seconds)
+
+    def get_p95(self, endpoint: str) -> float:
+        """ Get the p95 latency of an endpoint. Returns None without enough samples """
+        with self.lock:
+            if endpoint not in self.latencies or len(self.latencies[endpoint]) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies[endpoint])
+        return latencies[math.ceil(len(latencies) * 0.95) - 1]
+
+    def get_timeout(self, endpoint: str, timeout: float) -> float:
+        """ Get the timeout of a request. The requested timeout is the minimum """
+        if not self.enabled or timeout is None:
+            return timeout
+
+        p95 = self.get_p95(endpoint)
+        if p95 is None:
+            return timeout
+        return max(timeout, min(self.max_timeout_seconds, p95 * self.timeout_factor))
+
+
+class ServerAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that fails fast while the circuit breaker of its server is
+    open and holds requests back until the request governor allows them.
+    Idempotent requests that fail with a connection error, a timeout or a
+    temporary server error are retried with jittered exponential backoff
+    """
+
+    IDEMPOTENT_METHODS: frozenset[str] = frozenset(
+        {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+    )
+    # Plex changes state over GET on these endpoints so a retry after a read
+    # timeout could apply the change twice
+    NON_IDEMPOTENT_PATHS: re.Pattern = re.compile(
+        r"/:/(scrobble|unscrobble|rate|timeline|progress)$"
+        r"|/library/sections/[^/]+/(refresh|analyze|emptyTrash)$"
+    )
+    RETRY_STATUS_CODES: frozenset[int] = frozenset({429, 502, 503, 504})
+
+    def __init__(
+        self,
+        circuit_breaker: CircuitBreaker,
+        request_governor: RequestGovernor,
+        latency_tracker: LatencyTracker,
+        connection_config: ApiConnectionConfig,
+        **kwargs
+    ):
+        self.circuit_breaker = circuit_breaker
+        self.request_governor = request_governor
+        self.latency_tracker = latency_tracker
+        self.retry_count = connection_config.max_retries
+        self.retry_backoff_seconds = connection_config.retry_backoff_seconds
+        self.retry_backoff_max_seconds = connection_config.retry_backoff_max_seconds
+        super().__init__(**kwargs)
+
+    def __get_backoff_seconds(self, attempt: int, retry_after: float) -> float:
+        """ Get the full jitter backoff before a retry, at least any time the server asked for """
+        backoff_seconds = random.uniform(
+            0.0,
+            min(
+                self.retry_backoff_max_seconds,
+                self.retry_backoff_seconds * (2 ** attempt)
+            )
+        )
+        return min(self.retry_backoff_max_seconds, max(backoff_seconds, retry_after))
+
+    def __get_retry_after(self, response: requests.Response) -> float:
+        """ Get the seconds a server asked to wait before a retry """
+        try:
+            return max(0.0, float(response.headers.get("Retry-After", 0)))
+        except ValueError:
+            return 0.0
+
+    def __get_retry_count(self, request) -> int:
+        """ Get the retries allowed for a request. Only idempotent requests are retried """
+        if (
+            getattr(request_retries, "disabled", False)
+            or request.method not in self.IDEMPOTENT_METHODS
+            or self.NON_IDEMPOTENT_PATHS.search(urlsplit(request.url).path)
+        ):
+            return 0
+        return self.retry_count
+
+    def send(self, request, **kwargs):
+        if not self.circuit_breaker.allow_request():
+            add_request_failure()
+            raise RequestsConnectionError(
+                f"Circuit open for {request.url}", request=request
+            )
+
+        endpoint = self.latency_tracker.get_endpoint(request.method, request.url)
+        timeout = kwargs.get("timeout")
+        if not isinstance(timeout, tuple):
+            kwargs["timeout"] = self.latency_tracker.get_timeout(endpoint, timeout)
+
+        retry_count = self.__get_retry_count(request)
+        attempt: int = 0
+        while True:
+            retry_after: float = 0.0
+            self.request_governor.acquire()
+            start_time = time.monotonic()
+            try:
+                response = super().send(request, **kwargs)
+                self.latency_tracker.add_latency(
+                    endpoint, time.monotonic() - start_time
+                )
+                if (
+                    response.status_code not in self.RETRY_STATUS_CODES
+                    or attempt >= retry_count
+                ):
+                    self.circuit_breaker.record_success()
+                    if (
+                        response.status_code >= 500
+                        or response.status_code in self.RETRY_STATUS_CODES
+                    ):
+                        add_request_failure()
+                    return response
+
+                retry_after = self.__get_retry_after(response)
+                response.close()
+            except (RequestsConnectionError, requests.exceptions.Timeout) as e:
+                if isinstance(e, requests.exceptions.ReadTimeout):
+                    # A slow endpoint raises its own timeout for later requests
+                    self.latency_tracker.add_latency(
+                        endpoint, time.monotonic() - start_time
+                    )
+                if attempt >= retry_count:
+                    self.circuit_breaker.record_failure()
+                    add_request_failure()
+                    raise
+            finally:
+                self.request_governor.release()
+
+            time.sleep(self.__get_backoff_seconds(attempt, retry_after))
+            attempt += 1
 
 
 class ApiBase:
     """
     Base class for API interactions with media servers.
     Provides common functionality for API classes like setting up the URL,
-    API key, ansi code, module name and LogManager
+    API key, ansi code, module name, LogManager and a pooled http session
     """
 
     def __init__(
@@ -18,7 +421,8 @@ class ApiBase:
         api_key: str,
         ansi_code: str,
         module: str,
-        log_manager: LogManager
+        log_manager: LogManager,
+        connection_config: ApiConnectionConfig = None
     ):
         """
         Initializes the ApiBase with the server URL, API key, ANSI code, module name, and LogManager.
@@ -29,6 +433,7 @@ class ApiBase:
             ansi_code (str): The ANSI escape code for log header coloring.
             module (str): The name of the module using this class.
             log_manager (LogManager): The LogManager instance for logging messages.
+            connection_config (ApiConnectionConfig): Pool, retry and keep-alive settings for the session.
         """
 
         self.server_name = server_name
@@ -40,10 +445,81 @@ class ApiBase:
         self.log_header = get_log_header(
             ansi_code, f"{module}({self.server_name})"
         )
+        self.connection_config = (
+            connection_config
+            if connection_config is not None else
+            ApiConnectionConfig()
+        )
+        self.circuit_breaker = CircuitBreaker(
+            self.connection_config.circuit_failure_threshold,
+            self.connection_config.circuit_open_seconds
+        )
+        self.request_governor = RequestGovernor(
+            self.connection_config.rate_limit,
+            self.connection_config.rate_burst,
+            self.connection_config.max_in_flight,
+            self.log_header,
+            self.log_manager
+        )
+        self.latency_tracker = LatencyTracker(
+            self.connection_config.adaptive_timeout,
+            self.connection_config.max_timeout_seconds
+        )
+        self.session = self.__create_session()
+
+        # Cached result of the last successful health probe
+        self.health_lock = threading.Lock()
+        self.health_expire_time: float = 0.0
+
+    def __create_session(self) -> requests.Session:
+        """ Create the pooled keep-alive session used for all requests to this server """
+        session = requests.Session()
+
+        # Retries are handled by the adapter so they respect the circuit
+        # breaker, the request governor and the request method
+        adapter = ServerAdapter(
+            self.circuit_breaker,
+            self.request_governor,
+            self.latency_tracker,
+            self.connection_config,
+            pool_connections=self.connection_config.pool_size,
+            pool_maxsize=self.connection_config.pool_size,
+            max_retries=0
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        if not self.connection_config.keep_alive:
+            session.headers["Connection"] = "close"
+
+        return session
 
     def get_valid(self) -> bool:
         """
-        Checks if the connection to the media server is valid. (To be implemented by subclasses)
+        Checks if the connection to the media server is valid.
+        A successful probe is cached for health_cache_seconds and a server
+        with an open circuit breaker is reported invalid without a request.
+        The probe is not retried so an unreachable server fails after one timeout
+        """
+        with self.health_lock:
+            if time.monotonic() < self.health_expire_time:
+                return True
+
+        if self.circuit_breaker.get_open():
+            return False
+
+        with no_retries():
+            valid = self.get_health_probe()
+        with self.health_lock:
+            self.health_expire_time = (
+                time.monotonic() + self.connection_config.health_cache_seconds
+                if valid else 0.0
+            )
+        return valid
+
+    def get_health_probe(self) -> bool:
+        """
+        Sends a lightweight request to check the server is reachable. (To be implemented by subclasses)
         """
         return False
 
@@ -70,3 +546,9 @@ class ApiBase:
         Retrieves the friendly name of the media server. (To be implemented by subclasses)
         """
         return ""
+
+    def shutdown(self) -> None:
+        """
+        Closes the pooled session and all of its connections.
+        """
+        self.session.close()
@@ -1,12 +1,14 @@
 """ Api Manager """
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import threading
 import time
 
 from common import utils
 from common.log_manager import LogManager
 
-from api.api_base import ApiBase
+from api.api_base import ApiBase, ApiConnectionConfig
 from api.emby import EmbyAPI
 from api.jellystat import JellystatAPI
 from api.plex import PlexAPI
@@ -32,6 +34,21 @@ class ApiManager:
         self.jellystat_api_list: list[JellystatAPI] = []
         self.log_manager = log_manager
 
+        # Apis waiting for validation with their formatted server type name
+        self.pending_validation: list[tuple[ApiBase, str]] = []
+        self.revalidate_seconds: float = 60.0
+        if "server_revalidate_seconds" in config:
+            try:
+                self.revalidate_seconds = max(
+                    1.0, float(config["server_revalidate_seconds"])
+                )
+            except (ValueError, TypeError) as e:
+                self.log_manager.log_warning(
+                    f"Configuration server_revalidate_seconds invalid using default "
+                    f"{utils.get_tag("error", e)}"
+                )
+        self.stop_event = threading.Event()
+
         if "plex" in config and "servers" in config["plex"]:
             for server in config["plex"]["servers"]:
                 self.__create_plex_server(server)
@@ -40,14 +57,53 @@ class ApiManager:
             for server in config["emby"]["servers"]:
                 self.__create_emby_server(server)
 
+        # Validate the connections in the background so start up is not blocked
+        self.validation_thread = threading.Thread(
+            target=self.__validate_apis,
+            name="api_validation",
+            daemon=True
+        )
+        self.validation_thread.start()
+
+    def __validate_apis(self):
+        """
+        Validate all api connections concurrently. Servers that are not
+        reachable are revalidated in the background until they connect
+        """
+        pending = self.pending_validation
+        first_pass: bool = True
+        while len(pending) > 0 and not self.stop_event.is_set():
+            with ThreadPoolExecutor(
+                max_workers=len(pending),
+                thread_name_prefix="api_validation"
+            ) as executor:
+                results = list(
+                    executor.map(
+                        lambda api_info: self.__wait_api_valid(
+                            api_info[0], api_info[1], first_pass
+                        ),
+                        pending
+                    )
+                )
+
+            pending = [
+                api_info for api_info, valid in zip(pending, results) if not valid
+            ]
+            first_pass = False
+            self.stop_event.wait(self.revalidate_seconds)
+
     def __wait_api_valid(
         self,
         api: ApiBase,
-        formatted_name: str
+        formatted_name: str,
+        log_not_available: bool
     ) -> bool:
         start_time: datetime = datetime.now()
         current_time: datetime = start_time
         while (current_time - start_time).total_seconds() < 10:
+            if self.stop_event.is_set():
+                return False
+
             if api.get_valid():
                 server_name = (
                     api.get_server_reported_name()
@@ -63,13 +119,74 @@ class ApiManager:
             time.sleep(1)
             current_time = datetime.now()
 
-        tag_url = utils.get_tag("url", api.get_url())
-        tag_api = utils.get_tag("api_key", api.get_api_key())
-        self.log_manager.log_warning(
-            f"{formatted_name}({api.get_server_name()}) server not available. Is this correct {tag_url} {tag_api}"
-        )
+        if log_not_available:
+            tag_url = utils.get_tag("url", api.get_url())
+            tag_api = utils.get_tag("api_key", api.get_api_key())
+            self.log_manager.log_warning(
+                f"{formatted_name}({api.get_server_name()}) server not available. Is this correct {tag_url} {tag_api}"
+            )
         return False
 
+    def __read_connection_config(self, config: dict) -> ApiConnectionConfig:
+        """ Read the optional connection pool settings of a server configuration """
+        connection_config = ApiConnectionConfig()
+        try:
+            if "connection_pool_size" in config:
+                connection_config.pool_size = max(
+                    1, int(config["connection_pool_size"])
+                )
+            if "connection_max_retries" in config:
+                connection_config.max_retries = max(
+                    0, int(config["connection_max_retries"])
+                )
+            if "connection_retry_backoff_seconds" in config:
+                connection_config.retry_backoff_seconds = max(
+                    0.0, float(config["connection_retry_backoff_seconds"])
+                )
+            if "connection_retry_backoff_max_seconds" in config:
+                connection_config.retry_backoff_max_seconds = max(
+                    0.0, float(config["connection_retry_backoff_max_seconds"])
+                )
+            if "connection_adaptive_timeout" in config:
+                connection_config.adaptive_timeout = config["connection_adaptive_timeout"] == "True"
+            if "connection_max_timeout_seconds" in config:
+                connection_config.max_timeout_seconds = max(
+                    1.0, float(config["connection_max_timeout_seconds"])
+                )
+            if "connection_keep_alive" in config:
+                connection_config.keep_alive = config["connection_keep_alive"] == "True"
+            if "health_cache_seconds" in config:
+                connection_config.health_cache_seconds = max(
+                    0.0, float(config["health_cache_seconds"])
+                )
+            if "circuit_failure_threshold" in config:
+                connection_config.circuit_failure_threshold = max(
+                    1, int(config["circuit_failure_threshold"])
+                )
+            if "circuit_open_seconds" in config:
+                connection_config.circuit_open_seconds = max(
+                    0.0, float(config["circuit_open_seconds"])
+                )
+            if "connection_rate_limit" in config:
+                connection_config.rate_limit = max(
+                    0.0, float(config["connection_rate_limit"])
+                )
+            if "connection_rate_burst" in config:
+                connection_config.rate_burst = max(
+                    1, int(config["connection_rate_burst"])
+                )
+            if "connection_max_in_flight" in config:
+                connection_config.max_in_flight = max(
+                    0, int(config["connection_max_in_flight"])
+                )
+        except (ValueError, TypeError) as e:
+            self.log_manager.log_warning(
+                f"{utils.get_tag("server", config.get("server_name", ""))} "
+                f"invalid connection configuration using defaults {utils.get_tag("error", e)}"
+            )
+            connection_config = ApiConnectionConfig()
+        return connection_config
+
     def __create_plex_server(self, config: dict):
         if (
             "server_name" in config
@@ -79,28 +196,56 @@ class ApiManager:
             and "tautulli_url" in config
             and "tautulli_api_key" in config
         ):
+            connection_config = self.__read_connection_config(config)
+
+            location_index_refresh_seconds: float = 300.0
+            if "location_index_refresh_seconds" in config:
+                try:
+                    location_index_refresh_seconds = max(
+                        1.0, float(config["location_index_refresh_seconds"])
+                    )
+                except (ValueError, TypeError) as e:
+                    self.log_manager.log_warning(
+                        f"{utils.get_tag("server", config["server_name"])} "
+                        f"invalid location_index_refresh_seconds using default {utils.get_tag("error", e)}"
+                    )
+
             plex_api = PlexAPI(
                 config["server_name"],
                 config["plex_url"],
                 config["plex_api_key"],
                 config["media_path"],
-                self.log_manager
+                self.log_manager,
+                connection_config,
+                location_index_refresh_seconds
             )
-            self.__wait_api_valid(
-                plex_api,
-                utils.get_formatted_plex()
+            self.pending_validation.append(
+                (plex_api, utils.get_formatted_plex())
             )
             self.plex_api_list.append(plex_api)
 
+            history_page_size: int = 500
+            if "tautulli_history_page_size" in config:
+                try:
+                    history_page_size = max(
+                        1, int(config["tautulli_history_page_size"])
+                    )
+                except (ValueError, TypeError) as e:
+                    self.log_manager.log_warning(
+                        f"{utils.get_tag("server", config["server_name"])} "
+                        f"invalid tautulli_history_page_size using default {utils.get_tag("error", e)}"
+                    )
+
             tautulli_api = TautulliAPI(
                 config["server_name"],
                 config["tautulli_url"],
                 config["tautulli_api_key"],
-                self.log_manager
+                self.log_manager,
+                connection_config,
+                history_page_size
             )
-            self.__wait_api_valid(
-                tautulli_api,
-                utils.get_formatted_tautulli()
+            self.pending_validation.append(
+                (tautulli_api, utils.get_formatted_tautulli())
             )
             self.tautulli_api_list.append(tautulli_api)
         else:
@@ -117,17 +262,43 @@ class ApiManager:
             and "jellystat_url" in config
             and "jellystat_api_key" in config
         ):
+            connection_config = self.__read_connection_config(config)
+
+            path_index_refresh_seconds: float = 300.0
+            if "path_index_refresh_seconds" in config:
+                try:
+                    path_index_refresh_seconds = max(
+                        1.0, float(config["path_index_refresh_seconds"])
+                    )
+                except (ValueError, TypeError) as e:
+                    self.log_manager.log_warning(
+                        f"{utils.get_tag("server", config["server_name"])} "
+                        f"invalid path_index_refresh_seconds using default {utils.get_tag("error", e)}"
+                    )
+
+            playlist_chunk_size: int = 100
+            if "playlist_chunk_size" in config:
+                try:
+                    playlist_chunk_size = int(config["playlist_chunk_size"])
+                except (ValueError, TypeError) as e:
+                    self.log_manager.log_warning(
+                        f"{utils.get_tag("server", config["server_name"])} "
+                        f"invalid playlist_chunk_size using default {utils.get_tag("error", e)}"
+                    )
+
             # Setup the emby api
             emby_api = EmbyAPI(
                 config["server_name"],
                 config["emby_url"],
                 config["emby_api_key"],
                 config["media_path"],
-                self.log_manager
+                self.log_manager,
+                connection_config,
+                path_index_refresh_seconds,
+                playlist_chunk_size
             )
-            self.__wait_api_valid(
-                emby_api,
-                utils.get_formatted_emby()
+            self.pending_validation.append(
+                (emby_api, utils.get_formatted_emby())
             )
             self.emby_api_list.append(emby_api)
 
@@ -135,11 +306,11 @@ class ApiManager:
                 config["server_name"],
                 config["jellystat_url"],
                 config["jellystat_api_key"],
-                self.log_manager
+                self.log_manager,
+                connection_config
             )
-            self.__wait_api_valid(
-                js_api,
-                utils.get_formatted_jellystat()
+            self.pending_validation.append(
+                (js_api, utils.get_formatted_jellystat())
             )
             self.jellystat_api_list.append(js_api)
         else:
@@ -193,3 +364,14 @@ class ApiManager:
             if jellystat_api.get_server_name() == name:
                 return jellystat_api
         return None
+
+    def shutdown(self) -> None:
+        """ Stop background validation and close the sessions of all api connections """
+        self.stop_event.set()
+        for api in (
+            self.plex_api_list
+            + self.tautulli_api_list
+            + self.emby_api_list
+            + self.jellystat_api_list
+        ):
+            api.shutdown()
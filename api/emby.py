@@ -1,11 +1,13 @@
 """ The API to the Emby Media Server """
 
+import posixpath
+import threading
 from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 
-import requests
 from requests.exceptions import RequestException
 
-from api.api_base import ApiBase
+from api.api_base import ApiBase, ApiConnectionConfig
 from common import utils
 from common.log_manager import LogManager
 
@@ -29,6 +31,21 @@ class EmbyItem:
     run_time_ticks: int
 
 
+@dataclass
+class EmbyPathIndexItem:
+    """ Class representing an item in the emby path index """
+    id: str
+    type: str
+    run_time_ticks: int
+
+
+@dataclass
+class EmbyChunkResult:
+    """ Class representing the result of a request for a chunk of ids """
+    ids: list[str]
+    success: bool
+
+
 @dataclass
 class EmbyPlaylistItem:
     """ Class representing an emby playlist item """
@@ -79,7 +96,10 @@ class EmbyAPI(ApiBase):
         url: str,
         api_key: str,
         media_path: str,
-        log_manager: LogManager
+        log_manager: LogManager,
+        connection_config: ApiConnectionConfig = None,
+        path_index_refresh_seconds: float = 300.0,
+        playlist_chunk_size: int = 100
     ):
         """
         Initializes the EmbyAPI with the server URL, API key, and LogManager.
@@ -89,13 +109,42 @@ class EmbyAPI(ApiBase):
             url (str): The base URL of the Emby Media Server.
             api_key (str): The API key for authenticating with the Emby server.
             log_manager (LogManager): The LogManager instance for logging messages.
+            connection_config (ApiConnectionConfig): Connection pool settings for the server.
+            path_index_refresh_seconds (float): Seconds before the path index is refreshed.
+            playlist_chunk_size (int): Maximum ids sent in one playlist request.
         """
         super().__init__(
-            server_name, url, api_key, utils.ANSI_CODE_EMBY, self.__module__, log_manager
+            server_name,
+            url,
+            api_key,
+            utils.ANSI_CODE_EMBY,
+            self.__module__,
+            log_manager,
+            connection_config
         )
 
         self.media_path = media_path
 
+        # Library wide index of normalized path to item used for path lookups
+        self.path_index: dict[str, EmbyPathIndexItem] = {}
+        self.path_index_lock = threading.Lock()
+        self.path_index_refresh_seconds = path_index_refresh_seconds
+        self.path_index_page_size: int = 1000
+        self.path_index_rebuild_hours: float = 24.0
+        self.path_index_built_time: datetime = None
+        self.path_index_refresh_time: datetime = None
+        self.path_index_next_refresh_time: datetime = None
+        self.path_index_retry_seconds: float = 30.0
+        self.path_index_failures: int = 0
+        self.path_index_refreshing: bool = False
+        # Ids of every item in each library used to find deleted items
+        self.library_item_ids: dict[str, set[str]] = {}
+
+        # Maximum length of a comma separated id list in a single request
+        self.max_ids_length: int = 1500
+
+        self.playlist_chunk_size = max(1, playlist_chunk_size)
+
     def __get_api_url(self) -> str:
         """ URL to use for emby requests """
         return f"{self.url}/emby"
@@ -133,11 +182,14 @@ class EmbyAPI(ApiBase):
         """ Returns the invalid item id for emby """
         return self.invalid_item_id
 
-    def get_valid(self) -> bool:
-        """ Get if the emby server is valid """
+    def get_health_probe(self) -> bool:
+        """
+        Get if the emby server accepts the api key on the lightweight system info
+        request. The ping endpoint answers without a key so it can not be used
+        """
         try:
-            r = requests.get(
-                f"{self.__get_api_url()}/System/Configuration",
+            r = self.session.get(
+                f"{self.__get_api_url()}/System/Info",
                 params=self.__get_default_payload(),
                 timeout=5
             )
@@ -150,7 +202,7 @@ class EmbyAPI(ApiBase):
     def get_server_reported_name(self) -> str:
         """ Get the name reported by the emby server """
         try:
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/System/Info",
                 params=self.__get_default_payload(),
                 timeout=5
@@ -167,7 +219,7 @@ class EmbyAPI(ApiBase):
     def get_user_id(self, user_name: str) -> str:
         """ Get the id of a user by name """
         try:
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Users/Query",
                 params=self.__get_default_payload(),
                 timeout=5
@@ -189,6 +241,56 @@ class EmbyAPI(ApiBase):
         )
         return self.get_invalid_item_id()
 
+    def __pack_item(self, item: dict) -> EmbyItem:
+        """ Pack an emby item response into an EmbyItem """
+        item_type: str = None
+        if "Type" in item:
+            item_type = item["Type"]
+
+        item_name: str = None
+        if "Name" in item:
+            item_name = item["Name"]
+
+        item_path: str = None
+        if "Path" in item:
+            item_path = item["Path"]
+
+        item_series_name: str = None
+        if "SeriesName" in item:
+            item_series_name = item["SeriesName"]
+
+        item_season_num: int = None
+        if "ParentIndexNumber" in item:
+            item_season_num = item["ParentIndexNumber"]
+
+        item_episode_num: int = None
+        if "IndexNumber" in item:
+            item_episode_num = item["IndexNumber"]
+
+        item_run_time_ticks: int = None
+        if "RunTimeTicks" in item:
+            item_run_time_ticks = item["RunTimeTicks"]
+
+        return EmbyItem(
+            item_name,
+            item["Id"],
+            item_path,
+            item_type,
+            EmbyItemSeries(
+                item_series_name,
+                item_season_num,
+                item_episode_num
+            ),
+            item_run_time_ticks
+        )
+
+    def __get_id_chunks(self, ids: list[str]) -> list[list[str]]:
+        """ Split unique ids into chunks that keep the request url a safe length """
+        return utils.get_comma_separated_chunks(
+            list(dict.fromkeys(ids)),
+            self.max_ids_length
+        )
+
     def search_item(self, emby_id: str) -> EmbyItem:
         """ Search for an item by id """
         try:
@@ -197,7 +299,7 @@ class EmbyAPI(ApiBase):
                 "Ids": emby_id,
                 "Fields": "Path"
             }
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Items",
                 params=payload,
                 timeout=5
@@ -209,66 +311,276 @@ class EmbyAPI(ApiBase):
                     self.log_manager.log_warning(
                         f"{self.log_header} "
                         f"search_item returned multiple items "
-                        f"{utils.get_tag("item", id)}"
+                        f"{utils.get_tag("item", emby_id)}"
                     )
 
-                main_response = response[0]
-
-                item_type: str = None
-                if "Type" in main_response:
-                    item_type = main_response["Type"]
-
-                item_name: str = None
-                if "Name" in main_response:
-                    item_name = main_response["Name"]
-
-                item_path: str = None
-                if "Path" in main_response:
-                    item_path = main_response["Path"]
-
-                item_series_name: str = None
-                if "SeriesName" in main_response:
-                    item_series_name = main_response["SeriesName"]
-
-                item_season_num: int = None
-                if "ParentIndexNumber" in main_response:
-                    item_season_num = main_response["ParentIndexNumber"]
-
-                item_episode_num: int = None
-                if "IndexNumber" in main_response:
-                    item_episode_num = main_response["IndexNumber"]
-
-                item_run_time_ticks: int = None
-                if "RunTimeTicks" in main_response:
-                    item_run_time_ticks = main_response["RunTimeTicks"]
-
-                return EmbyItem(
-                    item_name,
-                    emby_id,
-                    item_path,
-                    item_type,
-                    EmbyItemSeries(
-                        item_series_name,
-                        item_season_num,
-                        item_episode_num
-                    ),
-                    item_run_time_ticks
-                )
+                emby_item = self.__pack_item(response[0])
+                emby_item.id = emby_id
+                return emby_item
             else:
                 self.log_manager.log_warning(
-                    f"{self.log_header} search_item returned no results {utils.get_tag("item", id)}"
+                    f"{self.log_header} search_item returned no results {utils.get_tag("item", emby_id)}"
                 )
         except RequestException as e:
             self.log_manager.log_error(
                 f"{self.log_header} search_item "
-                f"{utils.get_tag("item", id)} "
+                f"{utils.get_tag("item", emby_id)} "
                 f"{utils.get_tag("error", e)}"
             )
 
         return None
 
+    def search_items(self, emby_ids: list[str]) -> dict[str, EmbyItem]:
+        """ Search for a list of items by id. Returns the found items keyed by id """
+        return_items: dict[str, EmbyItem] = {}
+        for id_chunk in self.__get_id_chunks(emby_ids):
+            try:
+                payload = self.__get_default_payload()
+                payload["Ids"] = utils.get_comma_separated_list(id_chunk)
+                payload["Fields"] = "Path"
+
+                r = self.session.get(
+                    f"{self.__get_api_url()}/Items",
+                    params=payload,
+                    timeout=5
+                )
+                for item in r.json()["Items"]:
+                    emby_item = self.__pack_item(item)
+                    return_items[emby_item.id] = emby_item
+            except RequestException as e:
+                self.log_manager.log_error(
+                    f"{self.log_header} search_items "
+                    f"{utils.get_tag("items", len(id_chunk))} "
+                    f"{utils.get_tag("error", e)}"
+                )
+
+        return return_items
+
+    def __get_normalized_path(self, path: str) -> str:
+        """ Normalize a path to use as a key in the path index """
+        return posixpath.normpath(path)
+
+    def __get_emby_time_string(self, date_time: datetime) -> str:
+        """ Get a UTC date time string compatible with emby queries """
+        return date_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def __get_library_folder_ids(self) -> list[str]:
+        """ Get the ids of all the libraries on the server """
+        r = self.session.get(
+            f"{self.__get_api_url()}/Library/SelectableMediaFolders",
+            params=self.__get_default_payload(),
+            timeout=5
+        )
+        return [library["Id"] for library in r.json() if "Id" in library]
+
+    def __get_library_items_payload(self, library_id: str) -> dict:
+        """ Payload listing every item of a library without images or user data """
+        payload = self.__get_default_payload()
+        payload["ParentId"] = library_id
+        payload["Recursive"] = "true"
+        payload["EnableImages"] = "false"
+        payload["EnableUserData"] = "false"
+        return payload
+
+    def __add_library_to_path_index(
+        self,
+        library_id: str,
+        min_date_last_saved: datetime,
+        index_items: dict[str, EmbyPathIndexItem],
+        item_ids: set[str]
+    ) -> None:
+        """ Page through the items of a library and add them to an index and id set """
+        start_index: int = 0
+        while True:
+            payload = self.__get_library_items_payload(library_id)
+            payload["Fields"] = "Path"
+            payload["StartIndex"] = start_index
+            payload["Limit"] = self.path_index_page_size
+            if min_date_last_saved is not None:
+                payload["MinDateLastSaved"] = self.__get_emby_time_string(
+                    min_date_last_saved
+                )
+
+            r = self.session.get(
+                f"{self.__get_api_url()}/Items",
+                params=payload,
+                timeout=30
+            )
+            response = r.json()
+
+            for item in response["Items"]:
+                if "Id" not in item:
+                    continue
+                item_ids.add(item["Id"])
+                if "Path" in item and item["Path"]:
+                    index_items[self.__get_normalized_path(item["Path"])] = EmbyPathIndexItem(
+                        item["Id"],
+                        item["Type"] if "Type" in item else None,
+                        item["RunTimeTicks"] if "RunTimeTicks" in item else None
+                    )
+
+            start_index += len(response["Items"])
+            if (
+                len(response["Items"]) < self.path_index_page_size
+                or start_index >= response["TotalRecordCount"]
+            ):
+                break
+
+    def __get_library_item_count(self, library_id: str) -> int:
+        """ Get the number of items in a library """
+        payload = self.__get_library_items_payload(library_id)
+        payload["Limit"] = 0
+        r = self.session.get(
+            f"{self.__get_api_url()}/Items",
+            params=payload,
+            timeout=30
+        )
+        return r.json()["TotalRecordCount"]
+
+    def __get_library_item_ids(self, library_id: str) -> set[str]:
+        """ Page through the ids of every item in a library """
+        item_ids: set[str] = set()
+        start_index: int = 0
+        while True:
+            payload = self.__get_library_items_payload(library_id)
+            payload["StartIndex"] = start_index
+            payload["Limit"] = self.path_index_page_size
+            r = self.session.get(
+                f"{self.__get_api_url()}/Items",
+                params=payload,
+                timeout=30
+            )
+            response = r.json()
+            item_ids.update(item["Id"] for item in response["Items"] if "Id" in item)
+
+            start_index += len(response["Items"])
+            if (
+                len(response["Items"]) < self.path_index_page_size
+                or start_index >= response["TotalRecordCount"]
+            ):
+                break
+        return item_ids
+
+    def __build_path_index_changes(
+        self,
+        min_date_last_saved: datetime,
+        library_item_ids: dict[str, set[str]]
+    ) -> tuple[dict[str, EmbyPathIndexItem], dict[str, set[str]], set[str]]:
+        """
+        Request the items saved since min_date_last_saved or every item when it
+        is None. Returns the index items, the item ids of each library and the
+        ids of deleted items
+        """
+        index_items: dict[str, EmbyPathIndexItem] = {}
+        new_library_item_ids: dict[str, set[str]] = {}
+        deleted_ids: set[str] = set()
+        for library_id in self.__get_library_folder_ids():
+            item_ids: set[str] = set(library_item_ids.get(library_id, set()))
+            self.__add_library_to_path_index(
+                library_id, min_date_last_saved, index_items, item_ids
+            )
+
+            # Items were deleted when the library holds fewer items than were indexed
+            if (
+                min_date_last_saved is not None
+                and self.__get_library_item_count(library_id) != len(item_ids)
+            ):
+                current_ids = self.__get_library_item_ids(library_id)
+                deleted_ids.update(item_ids - current_ids)
+                item_ids = current_ids
+
+            new_library_item_ids[library_id] = item_ids
+
+        return index_items, new_library_item_ids, deleted_ids
+
+    def __refresh_path_index(self) -> None:
+        """
+        Build the path index if it is missing or too old otherwise only add
+        items saved since the last refresh and drop deleted items. The requests
+        are sent without the lock held so lookups keep using the current index
+        """
+        current_time = datetime.now(timezone.utc)
+        with self.path_index_lock:
+            if (
+                self.path_index_refreshing
+                or (
+                    self.path_index_next_refresh_time is not None
+                    and current_time < self.path_index_next_refresh_time
+                )
+            ):
+                return
+
+            full_build: bool = (
+                self.path_index_built_time is None
+                or current_time - self.path_index_built_time > timedelta(hours=self.path_index_rebuild_hours)
+            )
+
+            # Overlap the incremental window to cover items saved during the last refresh
+            min_date_last_saved: datetime = (
+                None
+                if full_build else
+                self.path_index_refresh_time - timedelta(minutes=1)
+            )
+            library_item_ids = {} if full_build else self.library_item_ids
+            self.path_index_refreshing = True
+
+        try:
+            index_items, new_library_item_ids, deleted_ids = self.__build_path_index_changes(
+                min_date_last_saved, library_item_ids
+            )
+        except (RequestException, KeyError, ValueError) as e:
+            with self.path_index_lock:
+                # Back off so lookups do not retry a failing build on every call
+                self.path_index_failures += 1
+                self.path_index_next_refresh_time = current_time + timedelta(
+                    seconds=min(
+                        self.path_index_retry_seconds * (2 ** (self.path_index_failures - 1)),
+                        max(self.path_index_refresh_seconds, self.path_index_retry_seconds)
+                    )
+                )
+            self.log_manager.log_error(
+                f"{self.log_header} refresh_path_index "
+                f"{utils.get_tag("full_build", full_build)} "
+                f"{utils.get_tag("error", e)}"
+            )
+        else:
+            with self.path_index_lock:
+                if full_build:
+                    self.path_index = index_items
+                    self.path_index_built_time = current_time
+                else:
+                    if len(deleted_ids) > 0:
+                        self.path_index = {
+                            path: item for path, item in self.path_index.items()
+                            if item.id not in deleted_ids
+                        }
+                    self.path_index.update(index_items)
+                self.library_item_ids = new_library_item_ids
+                self.path_index_refresh_time = current_time
+                self.path_index_next_refresh_time = current_time + timedelta(
+                    seconds=self.path_index_refresh_seconds
+                )
+                self.path_index_failures = 0
+        finally:
+            with self.path_index_lock:
+                self.path_index_refreshing = False
+
+    def get_path_index_item(self, path: str) -> EmbyPathIndexItem:
+        """ Get an item from the library path index. Returns None if not found """
+        self.__refresh_path_index()
+        normalized_path = self.__get_normalized_path(path)
+        with self.path_index_lock:
+            if normalized_path in self.path_index:
+                return self.path_index[normalized_path]
+        return None
+
     def get_item_id_from_path(self, path) -> str:
         """ Get the id of an item by path """
+        index_item = self.get_path_index_item(path)
+        if index_item is not None:
+            return index_item.id
+
+        # Not in the index yet so fall back to a direct path query
         try:
             # Setup the required payload
             payload = self.__get_default_payload()
@@ -276,7 +588,7 @@ class EmbyAPI(ApiBase):
             payload["Path"] = path
             payload["Fields"] = "Path"
 
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Items",
                 params=payload,
                 timeout=5
@@ -284,7 +596,14 @@ class EmbyAPI(ApiBase):
             response = r.json()
 
             if response["TotalRecordCount"] > 0:
-                return response["Items"][0]["Id"]
+                item = response["Items"][0]
+                with self.path_index_lock:
+                    self.path_index[self.__get_normalized_path(path)] = EmbyPathIndexItem(
+                        item["Id"],
+                        item["Type"] if "Type" in item else None,
+                        item["RunTimeTicks"] if "RunTimeTicks" in item else None
+                    )
+                return item["Id"]
 
         except RequestException as e:
             self.log_manager.log_error(
@@ -295,6 +614,60 @@ class EmbyAPI(ApiBase):
 
         return self.get_invalid_item_id()
 
+    def __pack_user_play_state(self, user_id: str, item: dict) -> EmbyUserPlayState:
+        """ Pack an emby user item response into an EmbyUserPlayState """
+        # Currently only process movies or episodes
+        if (
+            "Type" in item
+            and not (
+                item["Type"] == self.get_media_type_movie()
+                or item["Type"] == self.get_media_type_episode()
+            )
+        ):
+            return None
+
+        if "UserData" in item:
+            user_data = item["UserData"]
+
+            item_path: str = ""
+            if "Path" in item:
+                item_path = item["Path"]
+
+            played_percentage: float = 0.0
+            if "PlayedPercentage" in user_data:
+                played_percentage = user_data["PlayedPercentage"]
+
+            playback_position_ticks: int = 0
+            if "PlaybackPositionTicks" in user_data:
+                playback_position_ticks = user_data["PlaybackPositionTicks"]
+
+            play_count: int = 0
+            if "PlayCount" in user_data:
+                play_count = user_data["PlayCount"]
+
+            is_favorite: bool = False
+            if "IsFavorite" in user_data:
+                is_favorite = user_data["IsFavorite"]
+
+            played: bool = False
+            if "Played" in user_data:
+                played = user_data["Played"]
+
+            return EmbyUserPlayState(
+                user_id,
+                item["Id"],
+                item_path,
+                EmbyPlayState(
+                    played_percentage,
+                    playback_position_ticks,
+                    play_count,
+                    is_favorite,
+                    played
+                )
+            )
+
+        return None
+
     def get_user_play_state(self, user_id: str, item_id: str) -> EmbyUserPlayState:
         """ Get the play state of a user for an item """
         try:
@@ -303,7 +676,7 @@ class EmbyAPI(ApiBase):
             payload["Ids"] = item_id
             payload["Fields"] = "Path,UserDataLastPlayedDate,UserDataPlayCount"
 
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Users/{user_id}/Items",
                 params=payload,
                 timeout=5
@@ -320,59 +693,55 @@ class EmbyAPI(ApiBase):
         if r.status_code < 300:
             response = r.json()
             if response["TotalRecordCount"] > 0:
-                item = response["Items"][0]
+                play_state = self.__pack_user_play_state(
+                    user_id, response["Items"][0]
+                )
+                if play_state is not None:
+                    play_state.item_id = item_id
+                return play_state
 
-                # Currently only process movies or episodes
-                if (
-                    "Type" in item
-                    and not (
-                        item["Type"] == self.get_media_type_movie()
-                        or item["Type"] == self.get_media_type_episode()
-                    )
-                ):
-                    return None
-
-                if "UserData" in item:
-                    user_data = item["UserData"]
-
-                    item_path: str = ""
-                    if "Path" in item:
-                        item_path = item["Path"]
-
-                    played_percentage: float = 0.0
-                    if "PlayedPercentage" in user_data:
-                        played_percentage = user_data["PlayedPercentage"]
-
-                    playback_position_ticks: int = 0
-                    if "PlaybackPositionTicks" in user_data:
-                        playback_position_ticks = user_data["PlaybackPositionTicks"]
-
-                    play_count: int = 0
-                    if "PlayCount" in user_data:
-                        play_count = user_data["PlayCount"]
-
-                    is_favorite: bool = False
-                    if "IsFavorite" in user_data:
-                        is_favorite = user_data["IsFavorite"]
-
-                    played: bool = False
-                    if "Played" in user_data:
-                        played = user_data["Played"]
-
-                    return EmbyUserPlayState(
-                        user_id,
-                        item_id,
-                        item_path,
-                        EmbyPlayState(
-                            played_percentage,
-                            playback_position_ticks,
-                            play_count,
-                            is_favorite,
-                            played
-                        )
+        return None
+
+    def get_user_play_states(
+        self,
+        user_id: str,
+        item_ids: list[str]
+    ) -> dict[str, EmbyUserPlayState]:
+        """ Get the play states of a user for a list of items keyed by item id """
+        return_play_states: dict[str, EmbyUserPlayState] = {}
+        for id_chunk in self.__get_id_chunks(item_ids):
+            try:
+                # Setup the required payload
+                payload = self.__get_default_payload()
+                payload["Ids"] = utils.get_comma_separated_list(id_chunk)
+                payload["Fields"] = "Path,UserDataLastPlayedDate,UserDataPlayCount"
+
+                r = self.session.get(
+                    f"{self.__get_api_url()}/Users/{user_id}/Items",
+                    params=payload,
+                    timeout=5
+                )
+                if r.status_code < 300:
+                    for item in r.json()["Items"]:
+                        play_state = self.__pack_user_play_state(user_id, item)
+                        if play_state is not None:
+                            return_play_states[play_state.item_id] = play_state
+                else:
+                    self.log_manager.log_error(
+                        f"{self.log_header} get_user_play_states api response error "
+                        f"{utils.get_tag("code", r.status_code)} "
+                        f"{utils.get_tag("user_id", user_id)} "
+                        f"{utils.get_tag("error", r.reason)}"
                     )
+            except RequestException as e:
+                self.log_manager.log_error(
+                    f"{self.log_header} get_user_play_states "
+                    f"{utils.get_tag("user_id", user_id)} "
+                    f"{utils.get_tag("items", len(id_chunk))} "
+                    f"{utils.get_tag("error", e)}"
+                )
 
-        return None
+        return return_play_states
 
     def get_watched_status(self, user_id: str, item_id: str) -> bool:
         """ Get the watched status of an item """
@@ -382,7 +751,7 @@ class EmbyAPI(ApiBase):
             payload["Ids"] = item_id
             payload["IsPlayed"] = "true"
 
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Users/{user_id}/Items",
                 params=payload,
                 timeout=5
@@ -407,6 +776,45 @@ class EmbyAPI(ApiBase):
 
         return None
 
+    def get_watched_statuses(self, user_id: str, item_ids: list[str]) -> dict[str, bool]:
+        """
+        Get the watched status of a list of items keyed by item id.
+        Items in a chunk that could not be retrieved are left out of the result.
+        """
+        return_statuses: dict[str, bool] = {}
+        for id_chunk in self.__get_id_chunks(item_ids):
+            try:
+                # Setup the required payload
+                payload = self.__get_default_payload()
+                payload["Ids"] = utils.get_comma_separated_list(id_chunk)
+                payload["IsPlayed"] = "true"
+
+                r = self.session.get(
+                    f"{self.__get_api_url()}/Users/{user_id}/Items",
+                    params=payload,
+                    timeout=5
+                )
+                if r.status_code < 300:
+                    played_ids = {item["Id"] for item in r.json()["Items"]}
+                    for item_id in id_chunk:
+                        return_statuses[item_id] = item_id in played_ids
+                else:
+                    self.log_manager.log_error(
+                        f"{self.log_header} get_watched_statuses api response error "
+                        f"{utils.get_tag("code", r.status_code)} "
+                        f"{utils.get_tag("user", user_id)} "
+                        f"{utils.get_tag("error", r.reason)}"
+                    )
+            except RequestException as e:
+                self.log_manager.log_error(
+                    f"{self.log_header} get_watched_statuses failed for "
+                    f"{utils.get_tag("user", user_id)} "
+                    f"{utils.get_tag("items", len(id_chunk))} "
+                    f"{utils.get_tag("error", e)}"
+                )
+
+        return return_statuses
+
     def set_play_state(
         self,
         user_id: str,
@@ -422,7 +830,7 @@ class EmbyAPI(ApiBase):
                 "LastPlayedDate": played_date
             }
 
-            r = requests.post(
+            r = self.session.post(
                 emby_url, headers=self.__get_default_header(),
                 params=self.__get_default_payload(),
                 json=data,
@@ -443,7 +851,7 @@ class EmbyAPI(ApiBase):
         """ Set an item as watched """
         try:
             emby_url = f"{self.__get_api_url()}/Users/{user_id}/PlayedItems/{item_id}"
-            requests.post(
+            self.session.post(
                 emby_url, headers=self.__get_default_header(),
                 params=self.__get_default_payload(), timeout=5)
         except RequestException as e:
@@ -466,7 +874,7 @@ class EmbyAPI(ApiBase):
             payload["ReplaceAllMetadata"] = "false"
 
             emby_url = f"{self.__get_api_url()}/Items/{library_id}/Refresh"
-            requests.post(
+            self.session.post(
                 emby_url, headers=self.__get_default_header(), params=payload, timeout=5)
         except RequestException as e:
             self.log_manager.log_error(
@@ -475,10 +883,47 @@ class EmbyAPI(ApiBase):
                 f"{utils.get_tag("error", e)}"
             )
 
+    def set_media_updated(self, paths: list[str], update_type: str = "Deleted") -> bool:
+        """
+        Tells emby only the given paths changed instead of scanning a library.
+        Returns False if the caller should fall back to a full library scan
+        """
+        if len(paths) == 0:
+            return False
+
+        try:
+            data: dict = {
+                "Updates": [
+                    {"Path": path, "UpdateType": update_type} for path in paths
+                ]
+            }
+            r = self.session.post(
+                f"{self.__get_api_url()}/Library/Media/Updated",
+                headers=self.__get_default_header(),
+                params=self.__get_default_payload(),
+                json=data,
+                timeout=5
+            )
+            if r.status_code < 300:
+                if update_type == "Deleted":
+                    with self.path_index_lock:
+                        for path in paths:
+                            self.path_index.pop(
+                                self.__get_normalized_path(path), None
+                            )
+                return True
+        except RequestException as e:
+            self.log_manager.log_error(
+                f"{self.log_header} set_media_updated "
+                f"{utils.get_tag("paths", len(paths))} "
+                f"{utils.get_tag("error", e)}"
+            )
+        return False
+
     def get_library_valid(self, name: str) -> bool:
         """ Get the validity of a library by name """
         try:
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Library/SelectableMediaFolders",
                 params=self.__get_default_payload(),
                 timeout=5
@@ -504,7 +949,7 @@ class EmbyAPI(ApiBase):
     def get_library_id(self, name: str) -> str:
         """ Get a library id by name """
         try:
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Library/SelectableMediaFolders",
                 params=self.__get_default_payload(),
                 timeout=5
@@ -528,7 +973,7 @@ class EmbyAPI(ApiBase):
             payload["SearchTerm"] = playlist_name
             payload["Fields"] = "Path"
 
-            r = requests.get(
+            r = self.session.get(
                 f"{self.__get_api_url()}/Items",
                 params=payload,
                 timeout=5
@@ -548,25 +993,73 @@ class EmbyAPI(ApiBase):
 
         return self.get_invalid_item_id()
 
+    def __get_playlist_chunks(self, ids: list[str]) -> list[list[str]]:
+        """ Split ids into chunks of at most playlist_chunk_size that also fit in a request """
+        chunks: list[list[str]] = []
+        for id_chunk in self.__get_id_chunks(ids):
+            for index in range(0, len(id_chunk), self.playlist_chunk_size):
+                chunks.append(id_chunk[index:index + self.playlist_chunk_size])
+        return chunks
+
+    def __send_playlist_chunks(
+        self,
+        send_chunk,
+        ids: list[str]
+    ) -> list[EmbyChunkResult]:
+        """
+        Send the chunks one after another and return the result of each chunk.
+        Emby updates a playlist by reading and rewriting it so chunks for the
+        same playlist sent together can lose items and would lose the order
+        """
+        return [
+            EmbyChunkResult(chunk, send_chunk(chunk))
+            for chunk in self.__get_playlist_chunks(ids)
+        ]
+
     def create_playlist(
         self,
         playlist_name: str,
         ids: list[str]
     ) -> str:
-        """ Create a playlist """
+        """
+        Create a playlist. The playlist is created with the first chunk of
+        ids and the remaining chunks are added to it in order. Returns the
+        invalid id if the playlist could not be created with every item
+        """
+        chunks = self.__get_playlist_chunks(ids)
         try:
             # Setup the required payload
             payload = self.__get_default_payload()
             payload["Name"] = playlist_name
-            payload["Ids"] = utils.get_comma_separated_list(ids)
+            payload["Ids"] = utils.get_comma_separated_list(
+                chunks[0] if len(chunks) > 0 else []
+            )
             payload["MediaType"] = "Movies"
 
             emby_url = f"{self.__get_api_url()}/Playlists"
-            r = requests.post(
+            r = self.session.post(
                 emby_url, headers=self.__get_default_header(), params=payload, timeout=5)
             if r.status_code < 300:
                 response = r.json()
-                return response["Id"]
+                playlist_id = response["Id"]
+                if len(chunks) > 1:
+                    failed_ids = [
+                        failed_id
+                        for chunk_result in self.add_playlist_items(
+                            playlist_id,
+                            [item_id for chunk in chunks[1:] for item_id in chunk]
+                        )
+                        if not chunk_result.success
+                        for failed_id in chunk_result.ids
+                    ]
+                    if len(failed_ids) > 0:
+                        self.log_manager.log_warning(
+                            f"{self.log_header} create_playlist "
+                            f"{utils.get_tag("playlist", playlist_name)} "
+                            f"failed adding {utils.get_tag("items", len(failed_ids))}"
+                        )
+                        return self.get_invalid_item_id()
+                return playlist_id
         except RequestException as e:
             self.log_manager.log_error(
                 f"{self.log_header} create_playlist "
@@ -580,7 +1073,7 @@ class EmbyAPI(ApiBase):
         try:
             playlist = self.search_item(playlist_id)
             if playlist is not None:
-                r = requests.get(
+                r = self.session.get(
                     f"{self.__get_api_url()}/Playlists/{playlist.id}/Items",
                     params=self.__get_default_payload(),
                     timeout=5
@@ -608,15 +1101,15 @@ class EmbyAPI(ApiBase):
 
         return None
 
-    def add_playlist_items(self, playlist_id: str, item_ids: list[str]) -> bool:
-        """ Add items to a playlist """
+    def __add_playlist_item_chunk(self, playlist_id: str, item_ids: list[str]) -> bool:
+        """ Add a chunk of items to a playlist """
         try:
             # Setup the required payload
             payload = self.__get_default_payload()
             payload["Ids"] = utils.get_comma_separated_list(item_ids)
 
             emby_url = f"{self.__get_api_url()}/Playlists/{playlist_id}/Items"
-            r = requests.post(
+            r = self.session.post(
                 emby_url, headers=self.__get_default_header(), params=payload, timeout=5)
             if r.status_code < 300:
                 return True
@@ -629,8 +1122,15 @@ class EmbyAPI(ApiBase):
             )
         return False
 
-    def remove_playlist_items(self, playlist_id: str, playlist_item_ids: list[str]) -> bool:
-        """ Remove items from a playlist """
+    def add_playlist_items(self, playlist_id: str, item_ids: list[str]) -> list[EmbyChunkResult]:
+        """ Add items to a playlist in chunks sent in order """
+        return self.__send_playlist_chunks(
+            lambda chunk: self.__add_playlist_item_chunk(playlist_id, chunk),
+            item_ids
+        )
+
+    def __remove_playlist_item_chunk(self, playlist_id: str, playlist_item_ids: list[str]) -> bool:
+        """ Remove a chunk of items from a playlist """
         try:
             # Setup the required payload
             payload = self.__get_default_payload()
@@ -638,7 +1138,7 @@ class EmbyAPI(ApiBase):
                 playlist_item_ids)
 
             emby_url = f"{self.__get_api_url()}/Playlists/{playlist_id}/Items/Delete"
-            r = requests.post(
+            r = self.session.post(
                 emby_url,
                 headers=self.__get_default_header(),
                 params=payload, timeout=5
@@ -654,6 +1154,13 @@ class EmbyAPI(ApiBase):
             )
         return False
 
+    def remove_playlist_items(self, playlist_id: str, playlist_item_ids: list[str]) -> list[EmbyChunkResult]:
+        """ Remove items from a playlist in chunks sent one after another """
+        return self.__send_playlist_chunks(
+            lambda chunk: self.__remove_playlist_item_chunk(playlist_id, chunk),
+            playlist_item_ids
+        )
+
     def set_move_playlist_item_to_index(
         self,
         playlist_id: str,
@@ -663,7 +1170,7 @@ class EmbyAPI(ApiBase):
         """ Move a playlist item to a new index """
         try:
             emby_url = f"{self.__get_api_url()}/Playlists/{playlist_id}/Items/{playlist_item_id}/Move/{str(index)}"
-            r = requests.post(
+            r = self.session.post(
                 emby_url,
                 headers=self.__get_default_header(),
                 params=self.__get_default_payload(),
@@ -5,10 +5,9 @@ from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Any
 
-import requests
 from requests.exceptions import RequestException
 
-from api.api_base import ApiBase
+from api.api_base import ApiBase, ApiConnectionConfig
 from common import utils
 from common.log_manager import LogManager
 
@@ -39,7 +38,8 @@ class JellystatAPI(ApiBase):
         server_name: str,
         url: str,
         api_key: str,
-        log_manager: LogManager
+        log_manager: LogManager,
+        connection_config: ApiConnectionConfig = None
     ):
         super().__init__(
             server_name,
@@ -47,7 +47,8 @@ class JellystatAPI(ApiBase):
             api_key,
             utils.ANSI_CODE_JELLYSTAT,
             self.__module__,
-            log_manager
+            log_manager,
+            connection_config
         )
 
     def get_connection_error_log(self) -> str:
@@ -71,11 +72,11 @@ class JellystatAPI(ApiBase):
         return {"x-api-token": self.api_key,
                 "Content-Type": "application/json"}
 
-    def get_valid(self) -> bool:
+    def get_health_probe(self) -> bool:
         """ Get if the jellystat server is valid """
         try:
             payload = {}
-            r = requests.get(
+            r = self.session.get(
                 f"{self.get_api_url()}/getconfig",
                 headers=self.get_headers(),
                 params=payload,
@@ -91,7 +92,7 @@ class JellystatAPI(ApiBase):
         """ Get the id of a library by name """
         try:
             payload = {}
-            r = requests.get(
+            r = self.session.get(
                 f"{self.get_api_url()}/getLibraries",
                 headers=self.get_headers(),
                 params=payload,
@@ -160,7 +161,7 @@ class JellystatAPI(ApiBase):
             payload = {
                 "userid": user_id
             }
-            r = requests.post(
+            r = self.session.post(
                 f"{self.get_api_url()}/getUserHistory",
                 headers=self.get_headers(),
                 data=json.dumps(payload),
@@ -193,7 +194,7 @@ class JellystatAPI(ApiBase):
             payload = {
                 "libraryid": library_id
             }
-            r = requests.post(
+            r = self.session.post(
                 f"{self.get_api_url()}/getLibraryHistory",
                 headers=self.get_headers(),
                 data=json.dumps(payload),
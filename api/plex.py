@@ -1,12 +1,17 @@
 """ The API to the Plex Server """
 
-from typing import Any
+import posixpath
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
 from dataclasses import dataclass, field
 
 from plexapi import server
+from plexapi import utils as plex_utils
 from plexapi.exceptions import BadRequest, NotFound, Unauthorized
+from requests.exceptions import RequestException
 
-from api.api_base import ApiBase
+from api.api_base import ApiBase, ApiConnectionConfig
 from common import utils
 from common.log_manager import LogManager
 
@@ -23,6 +28,13 @@ class PlexCollection:
     """ Individual collection for plex with items """
     name: str
     items: list[PlexCollectionItem] = field(default_factory=list)
+    updated_at: datetime = None
+
+
+@dataclass
+class PlexLocationIndexItem:
+    """ Class representing an item in the plex location index """
+    rating_key: str
 
 
 @dataclass
@@ -48,15 +60,60 @@ class PlexAPI(ApiBase):
         url: str,
         api_key: str,
         media_path: str,
-        log_manager: LogManager
+        log_manager: LogManager,
+        connection_config: ApiConnectionConfig = None,
+        location_index_refresh_seconds: float = 300.0
     ):
         super().__init__(
-            server_name, url, api_key, utils.ANSI_CODE_PLEX, self.__module__, log_manager
+            server_name,
+            url,
+            api_key,
+            utils.ANSI_CODE_PLEX,
+            self.__module__,
+            log_manager,
+            connection_config
         )
 
-        self.plex_server = server.PlexServer(url.rstrip("/"), api_key)
+        # The plex server connection is created on first use so an unreachable
+        # server does not block start up
+        self.__plex_server: server.PlexServer = None
+        self.plex_server_lock = threading.Lock()
         self.media_path = media_path
 
+        # Above this many changed folders a full library scan is cheaper
+        self.max_scan_folders: int = 25
+
+        # Library wide index of normalized file location to item used to
+        # mark items watched without searching by title
+        self.location_index: dict[str, PlexLocationIndexItem] = {}
+        self.location_index_lock = threading.Lock()
+        self.location_index_refresh_seconds = location_index_refresh_seconds
+        self.location_index_page_size: int = 1000
+        self.location_index_rebuild_hours: float = 24.0
+        self.location_index_built_time: datetime = None
+        self.location_index_refresh_time: datetime = None
+        self.location_index_next_refresh_time: datetime = None
+        self.location_index_retry_seconds: float = 30.0
+        self.location_index_failures: int = 0
+        self.location_index_refreshing: bool = False
+
+        # Library section type to the item type holding the file locations
+        self.location_index_types: dict[str, str] = {
+            "movie": "movie",
+            "show": "episode"
+        }
+
+    @property
+    def plex_server(self) -> server.PlexServer:
+        """ The plex server connection. Connects on first use """
+        if self.__plex_server is None:
+            with self.plex_server_lock:
+                if self.__plex_server is None:
+                    self.__plex_server = server.PlexServer(
+                        self.url, self.api_key, session=self.session, timeout=5
+                    )
+        return self.__plex_server
+
     def get_server_name(self) -> str:
         """ Name of the plex server """
         return self.server_name
@@ -85,12 +142,20 @@ class PlexAPI(ApiBase):
         """ Returns the invalid type for plex """
         return self.invalid_item_type
 
-    def get_valid(self) -> bool:
-        """ Get if the plex server is valid """
+    def get_health_probe(self) -> bool:
+        """
+        Get if the plex server accepts the token on the lightweight root request.
+        The identity endpoint answers without a token so it can not be used
+        """
         try:
-            self.plex_server.library.sections()
-            return True
-        except (BadRequest, NotFound, Unauthorized):
+            r = self.session.get(
+                f"{self.url}/",
+                headers={"X-Plex-Token": self.api_key},
+                timeout=5
+            )
+            if r.status_code < 300:
+                return True
+        except RequestException:
             pass
         return False
 
@@ -103,7 +168,7 @@ class PlexAPI(ApiBase):
         """
         try:
             return self.plex_server.friendlyName
-        except (BadRequest, NotFound, Unauthorized):
+        except (BadRequest, NotFound, Unauthorized, RequestException):
             return "Server Error"
 
     def get_item_path(self, rating_key: Any) -> str:
@@ -111,10 +176,36 @@ class PlexAPI(ApiBase):
         try:
             item = self.plex_server.fetchItem(rating_key)
             return item.locations[0]
-        except (BadRequest, NotFound, Unauthorized):
+        except (BadRequest, NotFound, Unauthorized, RequestException):
             pass
         return self.get_invalid_type()
 
+    def get_item_paths(self, rating_keys: list[Any]) -> dict[str, str]:
+        """
+        Retrieves the paths of a list of items with batched metadata requests.
+        Returns the paths keyed by the string rating key
+        """
+        return_paths: dict[str, str] = {}
+        key_chunks = utils.get_comma_separated_chunks(
+            list(dict.fromkeys(str(rating_key) for rating_key in rating_keys)),
+            1500
+        )
+        for key_chunk in key_chunks:
+            try:
+                items = self.plex_server.fetchItems(
+                    f"/library/metadata/{utils.get_comma_separated_list(key_chunk)}"
+                )
+                for item in items:
+                    if len(item.locations) > 0:
+                        return_paths[str(item.ratingKey)] = item.locations[0]
+            except (BadRequest, NotFound, Unauthorized, RequestException) as e:
+                self.log_manager.log_error(
+                    f"{self.log_header} get_item_paths "
+                    f"{utils.get_tag("items", len(key_chunk))} "
+                    f"{utils.get_tag("error", e)}"
+                )
+        return return_paths
+
     def __search(self, search_str: str, media_type: str) -> PlexSearchResults:
         """ Search the plex server for a string and media type """
         return_results: PlexSearchResults = PlexSearchResults()
@@ -130,7 +221,7 @@ class PlexAPI(ApiBase):
                             item.librarySectionTitle
                         )
                     )
-        except (BadRequest, NotFound, Unauthorized):
+        except (BadRequest, NotFound, Unauthorized, RequestException):
             pass
         return return_results
 
@@ -139,10 +230,181 @@ class PlexAPI(ApiBase):
         try:
             self.plex_server.library.section(library_name)
             return True
-        except (BadRequest, NotFound, Unauthorized):
+        except (BadRequest, NotFound, Unauthorized, RequestException):
             pass
         return False
 
+    def __get_normalized_location(self, location: str) -> str:
+        """ Normalize a file location to use as a key in the location index """
+        return posixpath.normpath(location)
+
+    def __add_section_to_location_index(
+        self,
+        section: Any,
+        updated_after: datetime,
+        index_items: dict[str, PlexLocationIndexItem]
+    ) -> None:
+        """ List the items of a library section and add them to an index """
+        args: dict[str, Any] = {
+            "type": plex_utils.searchType(self.location_index_types[section.type])
+        }
+        if updated_after is not None:
+            args["updatedAt>>"] = int(updated_after.timestamp())
+
+        items = self.plex_server.fetchItems(
+            f"/library/sections/{section.key}/all{plex_utils.joinArgs(args)}",
+            container_size=self.location_index_page_size
+        )
+
+        for item in items:
+            for location in item.locations:
+                index_items[self.__get_normalized_location(location)] = PlexLocationIndexItem(
+                    str(item.ratingKey)
+                )
+
+    def __refresh_location_index(self) -> None:
+        """
+        Build the location index if it is missing or too old otherwise only add
+        items updated since the last refresh. The requests are sent without the
+        lock held so lookups keep using the current index
+        """
+        current_time = datetime.now(timezone.utc)
+        with self.location_index_lock:
+            if (
+                self.location_index_refreshing
+                or (
+                    self.location_index_next_refresh_time is not None
+                    and current_time < self.location_index_next_refresh_time
+                )
+            ):
+                return
+
+            full_build: bool = (
+                self.location_index_built_time is None
+                or current_time - self.location_index_built_time > timedelta(hours=self.location_index_rebuild_hours)
+            )
+
+            # Overlap the incremental window to cover items updated during the last refresh
+            updated_after: datetime = (
+                None
+                if full_build else
+                self.location_index_refresh_time - timedelta(minutes=1)
+            )
+            self.location_index_refreshing = True
+
+        try:
+            index_items: dict[str, PlexLocationIndexItem] = {}
+            for section in self.plex_server.library.sections():
+                if section.type in self.location_index_types:
+                    self.__add_section_to_location_index(
+                        section, updated_after, index_items
+                    )
+        except (BadRequest, NotFound, Unauthorized, RequestException) as e:
+            with self.location_index_lock:
+                # Back off so lookups do not retry a failing build on every call
+                self.location_index_failures += 1
+                self.location_index_next_refresh_time = current_time + timedelta(
+                    seconds=min(
+                        self.location_index_retry_seconds * (2 ** (self.location_index_failures - 1)),
+                        max(self.location_index_refresh_seconds, self.location_index_retry_seconds)
+                    )
+                )
+            self.log_manager.log_error(
+                f"{self.log_header} refresh_location_index "
+                f"{utils.get_tag("full_build", full_build)} "
+                f"{utils.get_tag("error", e)}"
+            )
+        else:
+            with self.location_index_lock:
+                if full_build:
+                    self.location_index = index_items
+                    self.location_index_built_time = current_time
+                else:
+                    self.location_index.update(index_items)
+                self.location_index_refresh_time = current_time
+                self.location_index_next_refresh_time = current_time + timedelta(
+                    seconds=self.location_index_refresh_seconds
+                )
+                self.location_index_failures = 0
+        finally:
+            with self.location_index_lock:
+                self.location_index_refreshing = False
+
+    def get_location_index_item(self, location: str) -> PlexLocationIndexItem:
+        """ Get an item from the library location index. Returns None if not found """
+        self.__refresh_location_index()
+        normalized_location = self.__get_normalized_location(location)
+        with self.location_index_lock:
+            if normalized_location in self.location_index:
+                return self.location_index[normalized_location]
+        return None
+
+    def __scrobble(self, rating_key: str) -> bool:
+        """ Mark an item watched with a single scrobble request """
+        try:
+            r = self.session.get(
+                f"{self.url}/:/scrobble",
+                params={
+                    "key": rating_key,
+                    "identifier": "com.plexapp.plugins.library"
+                },
+                headers={"X-Plex-Token": self.api_key},
+                timeout=5
+            )
+            if r.status_code < 300:
+                return True
+
+            self.log_manager.log_error(
+                f"{self.log_header} scrobble "
+                f"{utils.get_tag("rating_key", rating_key)} "
+                f"{utils.get_tag("code", r.status_code)}"
+            )
+        except RequestException as e:
+            self.log_manager.log_error(
+                f"{self.log_header} scrobble "
+                f"{utils.get_tag("rating_key", rating_key)} "
+                f"{utils.get_tag("error", e)}"
+            )
+        return False
+
+    def __set_location_watched(self, location: str) -> Optional[bool]:
+        """
+        Set the item at a file location as watched using the location index.
+        Returns None if the location is not indexed or the indexed item no longer
+        exists at the location otherwise if the item was set as watched
+        """
+        index_item = self.get_location_index_item(location)
+        if index_item is None:
+            return None
+
+        # The watched state is read live since unwatching an item in plex does
+        # not change its updatedAt so the index could not keep it current
+        try:
+            item = self.plex_server.fetchItem(int(index_item.rating_key))
+        except NotFound:
+            # Removed since the index was built so fall back to a title search
+            return None
+        except (BadRequest, Unauthorized, RequestException) as e:
+            self.log_manager.log_error(
+                f"{self.log_header} set_location_watched "
+                f"{utils.get_tag("rating_key", index_item.rating_key)} "
+                f"{utils.get_tag("error", e)}"
+            )
+            return False
+
+        # Incremental refreshes never remove a moved or deleted location so the
+        # indexed item must still hold the file before it is marked
+        normalized_location = self.__get_normalized_location(location)
+        if not any(
+            self.__get_normalized_location(item_location) == normalized_location
+            for item_location in item.locations
+        ):
+            return None
+
+        if item.isWatched:
+            return False
+        return self.__scrobble(index_item.rating_key)
+
     def set_episode_watched(
         self,
         show_name: str,
@@ -152,6 +414,11 @@ class PlexAPI(ApiBase):
         episode_location: str
     ) -> bool:
         """ Set an episode as watched in plex. Returns if episode was set as watched """
+        location_watched = self.__set_location_watched(episode_location)
+        if location_watched is not None:
+            return location_watched
+
+        # Not in the index yet so fall back to a title search
         results = self.__search(
             show_name,
             self.get_media_type_show_name()
@@ -173,12 +440,17 @@ class PlexAPI(ApiBase):
                         ):
                             episode.markWatched()
                             return True
-                except (BadRequest, NotFound, Unauthorized):
+                except (BadRequest, NotFound, Unauthorized, RequestException):
                     pass
         return False
 
     def set_movie_watched(self, movie_name: str, location: str) -> bool:
         """ Set a movie as watched in plex. Returns if movie was set as watched """
+        location_watched = self.__set_location_watched(location)
+        if location_watched is not None:
+            return location_watched
+
+        # Not in the index yet so fall back to a title search
         result_items = self.__search(
             movie_name,
             self.get_media_type_movie()
@@ -192,7 +464,7 @@ class PlexAPI(ApiBase):
                     if not library_item.isWatched:
                         library_item.markWatched()
                         return True
-                except (BadRequest, NotFound, Unauthorized):
+                except (BadRequest, NotFound, Unauthorized, RequestException):
                     pass
         return False
 
@@ -201,13 +473,36 @@ class PlexAPI(ApiBase):
         try:
             library = self.plex_server.library.section(library_name)
             library.update()
-        except (BadRequest, NotFound, Unauthorized) as e:
+        except (BadRequest, NotFound, Unauthorized, RequestException) as e:
             self.log_manager.log_error(
                 f"{self.log_header} set_library_scan "
                 f"{utils.get_tag("library", library_name)} "
                 f"{utils.get_tag("error", e)}"
             )
 
+    def set_library_scan_paths(self, library_name: str, paths: list[str]) -> bool:
+        """
+        Tells plex to scan only the folders containing the changed paths.
+        Returns False if the caller should fall back to a full library scan
+        """
+        folders = utils.get_parent_folders(paths)
+        if len(folders) == 0 or len(folders) > self.max_scan_folders:
+            return False
+
+        try:
+            library = self.plex_server.library.section(library_name)
+            for folder in folders:
+                library.update(path=folder)
+            return True
+        except (BadRequest, NotFound, Unauthorized, RequestException) as e:
+            self.log_manager.log_error(
+                f"{self.log_header} set_library_scan_paths "
+                f"{utils.get_tag("library", library_name)} "
+                f"{utils.get_tag("folders", len(folders))} "
+                f"{utils.get_tag("error", e)}"
+            )
+        return False
+
     def get_library_name_from_path(self, path: str) -> str:
         """ Returns the name of the plex library from a path """
         try:
@@ -222,7 +517,7 @@ class PlexAPI(ApiBase):
                 f"{self.log_header} No library found with "
                 f"{utils.get_tag("path", path)}"
             )
-        except (BadRequest, NotFound, Unauthorized):
+        except (BadRequest, NotFound, Unauthorized, RequestException):
             pass
         return ""
 
@@ -237,26 +532,34 @@ class PlexAPI(ApiBase):
             for collection in library.collections():
                 if collection.title == collection_name:
                     return True
-        except (BadRequest, NotFound, Unauthorized):
+        except (BadRequest, NotFound, Unauthorized, RequestException):
             pass
         return False
 
+    def get_collection_updated_at(self, library_name: str, collection_name: str) -> datetime:
+        """ Returns when a plex collection was last updated without fetching its items """
+        try:
+            library = self.plex_server.library.section(library_name)
+            return library.collection(collection_name).updatedAt
+        except (BadRequest, NotFound, Unauthorized, RequestException):
+            pass
+        return self.get_invalid_type()
+
     def get_collection(self, library_name: str, collection_name: str) -> PlexCollection:
         """ Returns a plex collection if valid invalid type if not """
         try:
             library = self.plex_server.library.section(library_name)
-            for collection in library.collections():
-                if collection.title == collection_name:
-                    items: list[PlexCollectionItem] = []
-                    for item in collection.children:
-                        if len(item.locations) > 0:
-                            items.append(
-                                PlexCollectionItem(
-                                    item.title,
-                                    item.locations[0]
-                                )
-                            )
-                    return PlexCollection(collection.title, items)
-        except (BadRequest, NotFound, Unauthorized):
+            collection = library.collection(collection_name)
+            items: list[PlexCollectionItem] = []
+            for item in collection.children:
+                if len(item.locations) > 0:
+                    items.append(
+                        PlexCollectionItem(
+                            item.title,
+                            item.locations[0]
+                        )
+                    )
+            return PlexCollection(collection.title, items, collection.updatedAt)
+        except (BadRequest, NotFound, Unauthorized, RequestException):
             pass
         return self.get_invalid_type()
@@ -1,12 +1,11 @@
 """ The API to the Tautulli Server """
 
-from typing import Any
-from dataclasses import dataclass, field
+from typing import Any, Iterator
+from dataclasses import dataclass
 
-import requests
 from requests.exceptions import RequestException
 
-from api.api_base import ApiBase
+from api.api_base import ApiBase, ApiConnectionConfig
 from common import utils
 from common.log_manager import LogManager
 
@@ -27,12 +26,21 @@ class TautulliHistoryItem:
     watched: bool
     date_watched: int
     playback_percentage: int
+    file: str
 
 
-@dataclass
-class TautulliHistoryItems:
-    """ Class representing an Tautulli History items """
-    items: list[TautulliHistoryItem] = field(default_factory=list)
+class TautulliHistoryStream:
+    """
+    Watch history items requested page by page while iterating. complete is
+    False once a page could not be requested so the history is truncated
+    """
+
+    def __init__(self):
+        self.complete: bool = True
+        self.items: Iterator[TautulliHistoryItem] = iter(())
+
+    def __iter__(self) -> Iterator[TautulliHistoryItem]:
+        return self.items
 
 
 class TautulliAPI(ApiBase):
@@ -43,12 +51,22 @@ class TautulliAPI(ApiBase):
         server_name: str,
         url: str,
         api_key: str,
-        log_manager: LogManager
+        log_manager: LogManager,
+        connection_config: ApiConnectionConfig = None,
+        history_page_size: int = 500
     ):
         super().__init__(
-            server_name, url, api_key, utils.ANSI_CODE_TAUTULLI, self.__module__, log_manager
+            server_name,
+            url,
+            api_key,
+            utils.ANSI_CODE_TAUTULLI,
+            self.__module__,
+            log_manager,
+            connection_config
         )
 
+        self.history_page_size = history_page_size
+
     def __get_api_url(self) -> str:
         """ URL to use for Tautulli requests """
         return f"{self.url}/api/v2"
@@ -84,10 +102,10 @@ class TautulliAPI(ApiBase):
             "cmd": cmd_name
         }
 
-    def get_valid(self) -> bool:
+    def get_health_probe(self) -> bool:
         """ Get if the Tautulli server is valid """
         try:
-            r = requests.get(
+            r = self.session.get(
                 self.__get_api_url(),
                 params=self.__get_payload("get_tautulli_info"),
                 timeout=5,
@@ -102,7 +120,7 @@ class TautulliAPI(ApiBase):
     def get_server_reported_name(self) -> str:
         """ Get the name reported by the Tautulli server """
         try:
-            r = requests.get(
+            r = self.session.get(
                 self.__get_api_url(),
                 params=self.__get_payload("get_server_info"),
                 timeout=5
@@ -117,7 +135,7 @@ class TautulliAPI(ApiBase):
     def get_library_id(self, lib_name: str) -> str:
         """ Get the id of a library by name """
         try:
-            r = requests.get(
+            r = self.session.get(
                 self.__get_api_url(),
                 params=self.__get_payload("get_libraries"),
                 timeout=5
@@ -143,7 +161,7 @@ class TautulliAPI(ApiBase):
     def get_user_id(self, user_name: str) -> str:
         """ Get the id of a user by name """
         try:
-            r = requests.get(
+            r = self.session.get(
                 self.__get_api_url(),
                 params=self.__get_payload("get_users"),
                 timeout=5
@@ -170,7 +188,7 @@ class TautulliAPI(ApiBase):
     def get_user_info(self, user_name: str) -> TautulliUserInfo:
         """ Get the info of a user by name """
         try:
-            r = requests.get(
+            r = self.session.get(
                 self.__get_api_url(),
                 params=self.__get_payload("get_users_table"),
                 timeout=5
@@ -228,111 +246,92 @@ class TautulliAPI(ApiBase):
         if "percent_complete" in item:
             item_playback_percentage = item["percent_complete"]
 
+        item_file: str = ""
+        if "file" in item and item["file"]:
+            item_file = item["file"]
+
         return TautulliHistoryItem(
             item_name,
             item_full_name,
             item_id,
             item_watched,
             item_watched_date,
-            item_playback_percentage
+            item_playback_percentage,
+            item_file
         )
 
-    def get_watch_history_for_user(self, user_id: int, date_time_for_history: str) -> TautulliHistoryItems:
-        """ Get the watch history of a user """
-        return_items: TautulliHistoryItems = TautulliHistoryItems()
-        try:
-            # Setup the required payload
-            payload = self.__get_payload("get_history")
-            payload["include_activity"] = 0
-            payload["user_id"] = user_id
-            payload["after"] = date_time_for_history
-
-            r = requests.get(self.__get_api_url(), params=payload, timeout=5)
-            response = r.json()
-
-            if (
-                "response" in response
-                and "data" in response["response"]
-                and "data" in response["response"]["data"]
-            ):
-                for item in response["response"]["data"]["data"]:
-                    return_items.items.append(
-                        self.__pack_history_item(item)
-                    )
-        except RequestException as e:
-            self.log_manager.log_error(
-                f"{self.log_header} get_watch_history_for_user "
-                f"{utils.get_tag("user_id", user_id)} "
-                f"{utils.get_tag("error", e)}"
-            )
-        return return_items
-
-    def get_watch_history_for_user_and_library(
+    def get_watch_history(
         self,
         user_id: int,
-        lib_id: str,
-        date_time_for_history: str
-    ) -> TautulliHistoryItems:
-        """ Get the watch history of a user and library """
-
-        return_items: TautulliHistoryItems = TautulliHistoryItems()
-        try:
-            # Setup the required payload
-            payload = self.__get_payload("get_history")
-            payload["include_activity"] = 0
-            payload["user_id"] = user_id
-            payload["section_id"] = lib_id
-            payload["after"] = date_time_for_history
-
-            r = requests.get(self.__get_api_url(), params=payload, timeout=5)
-            response = r.json()
+        date_time_for_history: str,
+        lib_id: str = None
+    ) -> TautulliHistoryStream:
+        """
+        Page through the watch history of a user, optionally for a single library,
+        yielding items newest first as each page arrives
+        """
+        history = TautulliHistoryStream()
+        history.items = self.__get_watch_history_pages(
+            history, user_id, date_time_for_history, lib_id
+        )
+        return history
 
-            if (
+    def __get_watch_history_pages(
+        self,
+        history: TautulliHistoryStream,
+        user_id: int,
+        date_time_for_history: str,
+        lib_id: str
+    ) -> Iterator[TautulliHistoryItem]:
+        start: int = 0
+        while True:
+            try:
+                # Setup the required payload
+                payload = self.__get_payload("get_history")
+                payload["include_activity"] = 0
+                payload["user_id"] = user_id
+                payload["after"] = date_time_for_history
+                payload["order_column"] = "date"
+                payload["order_dir"] = "desc"
+                payload["start"] = start
+                payload["length"] = self.history_page_size
+                if lib_id is not None:
+                    payload["section_id"] = lib_id
+
+                r = self.session.get(self.__get_api_url(), params=payload, timeout=5)
+                response = r.json()
+            except RequestException as e:
+                self.log_manager.log_error(
+                    f"{self.log_header} get_watch_history "
+                    f"{utils.get_tag("user_id", user_id)} "
+                    f"{utils.get_tag("library_id", lib_id)} "
+                    f"{utils.get_tag("start", start)} "
+                    f"{utils.get_tag("error", e)}"
+                )
+                history.complete = False
+                return
+
+            if not (
                 "response" in response
                 and "data" in response["response"]
                 and "data" in response["response"]["data"]
             ):
-                for item in response["response"]["data"]["data"]:
-                    return_items.items.append(
-                        self.__pack_history_item(item)
-                    )
-
-        except RequestException as e:
-            self.log_manager.log_error(
-                f"{self.log_header} get_watch_history_for_user_and_library "
-                f"{utils.get_tag("user_id", user_id)} "
-                f"{utils.get_tag("library_id", lib_id)} "
-                f"{utils.get_tag("error", e)}"
-            )
-
-        return return_items
-
-    def get_filename(self, key: int) -> str:
-        """ Get the filename of a key """
-        try:
-            # Setup the required payload
-            payload = self.__get_payload("get_metadata")
-            payload["rating_key"] = key
-
-            r = requests.get(self.__get_api_url(), params=payload, timeout=5)
-            response = r.json()
-
-            if "response" in response and "data" in response["response"]:
-                res_data = response["response"]["data"]
-                if (
-                    "media_info" in res_data
-                    and len(res_data["media_info"]) > 0
-                    and "parts" in res_data["media_info"][0]
-                    and len(res_data["media_info"][0]["parts"]) > 0
-                    and "file" in res_data["media_info"][0]["parts"][0]
-                ):
-                    return res_data["media_info"][0]["parts"][0]["file"]
-
-        except RequestException as e:
-            self.log_manager.log_error(
-                f"{self.log_header} get_filename "
-                f"{utils.get_tag("key", key)} "
-                f"{utils.get_tag("error", e)}"
-            )
-
-        return ""
+                self.log_manager.log_error(
+                    f"{self.log_header} get_watch_history invalid page "
+                    f"{utils.get_tag("user_id", user_id)} "
+                    f"{utils.get_tag("library_id", lib_id)} "
+                    f"{utils.get_tag("start", start)}"
+                )
+                history.complete = False
+                return
+
+            history_data = response["response"]["data"]
+            for item in history_data["data"]:
+                yield self.__pack_history_item(item)
+
+            start += len(history_data["data"])
+            if (
+                len(history_data["data"]) < self.history_page_size
+                or ("recordsFiltered" in history_data and start >= history_data["recordsFiltered"])
+            ):
+                return
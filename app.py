@@ -23,8 +23,11 @@ scheduler = BlockingScheduler()
 
 def _exit_application(_sig_num, _frame):
     log_manager.log_info("Shutting down ...")
-    service_manager.shutdown()
+
+    # Stop the jobs first so the last refresh requests they queue are flushed
     scheduler.shutdown(wait=True)
+    service_manager.shutdown()
+    api_manager.shutdown()
     sys.exit(0)
 
 
@@ -48,7 +51,8 @@ if "CONFIG_PATH" in os.environ:
             signal.signal(signal.SIGTERM, _exit_application)
             signal.signal(signal.SIGINT, _exit_application)
 
-            # Configure the gotify logging
+            # Configure the log output and gotify logging
+            log_manager.configure_logging(data)
             log_manager.configure_gotify(data)
 
             # Create the API Manager
@@ -0,0 +1,74 @@
+""" Checkpoint Store """
+
+import json
+import os
+import threading
+from typing import Any
+
+from common import utils
+from common.log_manager import LogManager
+
+
+class CheckpointStore:
+    """
+    Persists small checkpoint values, like the last processed history time,
+    to a json file so services can resume where the previous run stopped.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        log_header: str,
+        log_manager: LogManager
+    ):
+        """
+        Initializes the CheckpointStore and loads any existing checkpoints.
+
+        Args:
+            file_path (str): The json file used to persist the checkpoints.
+            log_header (str): The log header of the owning service.
+            log_manager (LogManager): The LogManager instance for logging messages.
+        """
+        self.file_path = file_path
+        self.log_header = log_header
+        self.log_manager = log_manager
+        self.lock = threading.Lock()
+        self.checkpoints: dict[str, Any] = {}
+
+        if os.path.exists(self.file_path):
+            try:
+                with open(self.file_path, "r", encoding="utf-8") as f:
+                    self.checkpoints = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                self.log_manager.log_warning(
+                    f"{self.log_header} Could not read checkpoints starting fresh "
+                    f"{utils.get_tag("file", self.file_path)} "
+                    f"{utils.get_tag("error", e)}"
+                )
+
+    def get(self, key: str) -> Any:
+        """ Get a checkpoint value. Returns None if not set """
+        with self.lock:
+            if key in self.checkpoints:
+                return self.checkpoints[key]
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        """ Set a checkpoint value. Call save to persist it """
+        with self.lock:
+            self.checkpoints[key] = value
+
+    def save(self) -> None:
+        """ Atomically write all checkpoints to the json file """
+        with self.lock:
+            temp_file_path = f"{self.file_path}.tmp"
+            try:
+                with open(temp_file_path, "w", encoding="utf-8") as f:
+                    json.dump(self.checkpoints, f, indent=4)
+                os.replace(temp_file_path, self.file_path)
+            except OSError as e:
+                self.log_manager.log_error(
+                    f"{self.log_header} Could not save checkpoints "
+                    f"{utils.get_tag("file", self.file_path)} "
+                    f"{utils.get_tag("error", e)}"
+                )
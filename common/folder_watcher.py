@@ -0,0 +1,320 @@
+""" Folder Watcher """
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+from dataclasses import dataclass
+
+from common import utils
+from common.log_manager import LogManager
+
+# inotify flags and event masks from <sys/inotify.h>
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+@dataclass
+class FolderEntry:
+    """ Class representing a file or folder in a watched folder """
+    name: str
+    path: str
+    is_dir: bool
+    mtime: float
+
+
+class FolderWatcher:
+    """
+    Keeps an in memory index of the files and folders below a set of root
+    folders up to date with Linux inotify events. The roots are only walked
+    at start up and when the kernel event queue overflows.
+    """
+
+    def __init__(self, log_header: str, log_manager: LogManager):
+        """
+        Initializes the FolderWatcher.
+
+        Args:
+            log_header (str): The log header of the owning service.
+            log_manager (LogManager): The LogManager instance for logging messages.
+        """
+        self.log_header = log_header
+        self.log_manager = log_manager
+        self.roots: list[str] = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.watch_thread: threading.Thread = None
+        self.valid: bool = False
+        self.change_count: int = 0
+
+        self.inotify_fd: int = -1
+        self.libc = None
+
+        # Folder path to the entries it holds by name
+        self.folders: dict[str, dict[str, FolderEntry]] = {}
+        self.watch_paths: dict[int, str] = {}
+        self.path_watches: dict[str, int] = {}
+
+    def __load_libc(self) -> bool:
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            self.libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+            )
+            return hasattr(self.libc, "inotify_init1")
+        except OSError:
+            return False
+
+    def start(self, roots: list[str]) -> bool:
+        """ Index the roots and start watching them. Returns False if inotify is not available """
+        if not self.__load_libc():
+            self.log_manager.log_warning(
+                f"{self.log_header} Watch mode needs Linux inotify ... Scanning instead"
+            )
+            return False
+
+        self.inotify_fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            self.log_manager.log_warning(
+                f"{self.log_header} Could not start inotify "
+                f"{utils.get_tag("error", os.strerror(ctypes.get_errno()))} ... Scanning instead"
+            )
+            return False
+
+        self.roots = [root.rstrip("/") for root in roots]
+        with self.lock:
+            self.valid = True
+            for root in self.roots:
+                self.__index_folder(root)
+
+        if not self.valid:
+            self.stop()
+            return False
+
+        self.watch_thread = threading.Thread(
+            target=self.__watch, name="folder_watcher", daemon=True
+        )
+        self.watch_thread.start()
+        return True
+
+    def stop(self):
+        """ Stop watching and release the inotify watches """
+        self.stop_event.set()
+        if self.watch_thread is not None:
+            self.watch_thread.join()
+            self.watch_thread = None
+        with self.lock:
+            self.valid = False
+            if self.inotify_fd >= 0:
+                os.close(self.inotify_fd)
+                self.inotify_fd = -1
+
+    def get_valid(self) -> bool:
+        """ Get if the index is being kept up to date """
+        with self.lock:
+            return self.valid
+
+    def get_change_count(self) -> int:
+        """ Get a counter that increases whenever the indexed folders change """
+        with self.lock:
+            return self.change_count
+
+    def get_entries(self, folder: str) -> list[FolderEntry]:
+        """ Get the entries of a folder. Returns None if the folder is not indexed """
+        with self.lock:
+            folder = folder.rstrip("/")
+            if folder in self.folders:
+                return list(self.folders[folder].values())
+        return None
+
+    def get_files(self, folder: str, skip_hidden: bool = False) -> list[FolderEntry]:
+        """
+        Get all files below a folder. Returns None if the folder is not indexed.
+        With skip_hidden files and folders starting with a dot are left out
+        """
+        with self.lock:
+            folder = folder.rstrip("/")
+            if folder not in self.folders:
+                return None
+
+            files: list[FolderEntry] = []
+            folders: list[str] = [folder]
+            while len(folders) > 0:
+                for entry in self.folders.get(folders.pop(), {}).values():
+                    if skip_hidden and entry.name.startswith("."):
+                        continue
+                    if entry.is_dir:
+                        folders.append(entry.path)
+                    else:
+                        files.append(entry)
+            return files
+
+    def __add_watch(self, folder: str) -> bool:
+        """ Watch a folder. Must be called with the lock held """
+        wd = self.libc.inotify_add_watch(
+            self.inotify_fd, os.fsencode(folder), WATCH_MASK
+        )
+        if wd < 0:
+            error = ctypes.get_errno()
+            if os.path.isdir(folder):
+                # Running out of watches means the index can not be trusted
+                self.valid = False
+                self.log_manager.log_warning(
+                    f"{self.log_header} Could not watch "
+                    f"{utils.get_tag("folder", folder)} "
+                    f"{utils.get_tag("error", os.strerror(error))} ... Scanning instead"
+                )
+            return False
+
+        self.watch_paths[wd] = folder
+        self.path_watches[folder] = wd
+        return True
+
+    def __index_folder(self, root: str):
+        """ Watch and index a folder and everything below it. Must be called with the lock held """
+        folders: list[str] = [root]
+        while len(folders) > 0 and self.valid:
+            folder = folders.pop()
+
+            # Watch before listing so entries created in between are not missed
+            if not self.__add_watch(folder):
+                continue
+
+            entries: dict[str, FolderEntry] = {}
+            try:
+                with os.scandir(folder) as dir_entries:
+                    for dir_entry in dir_entries:
+                        try:
+                            is_dir = dir_entry.is_dir(follow_symlinks=False)
+                            entries[dir_entry.name] = FolderEntry(
+                                dir_entry.name,
+                                dir_entry.path,
+                                is_dir,
+                                dir_entry.stat(follow_symlinks=False).st_mtime
+                            )
+                            if is_dir:
+                                folders.append(dir_entry.path)
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+            self.folders[folder] = entries
+
+    def __remove_folder(self, folder: str):
+        """ Remove a folder and everything below it from the index. Must be called with the lock held """
+        folders: list[str] = [folder]
+        while len(folders) > 0:
+            current_folder = folders.pop()
+            for entry in self.folders.pop(current_folder, {}).values():
+                if entry.is_dir:
+                    folders.append(entry.path)
+
+            wd = self.path_watches.pop(current_folder, None)
+            if wd is not None:
+                self.watch_paths.pop(wd, None)
+                self.libc.inotify_rm_watch(self.inotify_fd, wd)
+
+    def __reindex(self):
+        """ Rebuild the whole index after events were lost. Must be called with the lock held """
+        self.log_manager.log_warning(
+            f"{self.log_header} Watch event queue overflowed ... Rebuilding index"
+        )
+        for folder in list(self.path_watches):
+            self.__remove_folder(folder)
+        for root in self.roots:
+            self.__index_folder(root)
+
+    def __handle_event(self, wd: int, mask: int, name: str):
+        """ Apply an inotify event to the index. Must be called with the lock held """
+        if mask & IN_Q_OVERFLOW:
+            self.__reindex()
+            return
+
+        if wd not in self.watch_paths:
+            return
+
+        folder = self.watch_paths[wd]
+        if mask & IN_IGNORED:
+            self.watch_paths.pop(wd, None)
+            if self.path_watches.get(folder) == wd:
+                self.path_watches.pop(folder, None)
+            return
+
+        if not name or folder not in self.folders:
+            return
+
+        path = f"{folder}/{name}"
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            entry = self.folders[folder].pop(name, None)
+            if entry is not None and entry.is_dir:
+                self.__remove_folder(path)
+        elif mask & (IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB):
+            try:
+                mtime = os.stat(path, follow_symlinks=False).st_mtime
+            except OSError:
+                return
+
+            is_dir = bool(mask & IN_ISDIR)
+            self.folders[folder][name] = FolderEntry(name, path, is_dir, mtime)
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                self.__index_folder(path)
+
+    def __read_events(self):
+        try:
+            data = os.read(self.inotify_fd, 65536)
+        except BlockingIOError:
+            return
+
+        with self.lock:
+            offset: int = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _cookie, name_length = EVENT_HEADER.unpack_from(
+                    data, offset
+                )
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(
+                    data[offset:offset + name_length].rstrip(b"\0")
+                )
+                offset += name_length
+
+                self.__handle_event(wd, mask, name)
+            self.change_count += 1
+
+    def __watch(self):
+        while not self.stop_event.is_set():
+            try:
+                readable, _, _ = select.select([self.inotify_fd], [], [], 1.0)
+                if readable:
+                    self.__read_events()
+            except OSError as e:
+                self.log_manager.log_error(
+                    f"{self.log_header} Watch stopped "
+                    f"{utils.get_tag("error", e)} ... Scanning instead"
+                )
+                with self.lock:
+                    self.valid = False
+                return
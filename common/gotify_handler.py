@@ -1,38 +1,198 @@
 """ Gotify Log Handler """
 
 import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
 import requests
 from requests.exceptions import RequestException
 
 
+@dataclass
+class GotifyMessage:
+    """ Class representing a message waiting to be sent to Gotify """
+    level_name: str
+    message: str
+    count: int = 1
+
+
 class GotifyHandler(logging.Handler):
-    """ Gotify Log Handler """
+    """
+    Gotify Log Handler. Records are queued and sent by a background thread
+    so a slow or unavailable Gotify server never blocks logging. Repeats of
+    a waiting message are coalesced into one message with a count and a
+    digest interval batches all waiting messages into a single message
+    """
 
     def __init__(
         self,
         url,
         app_token,
         title,
-        priority
+        priority,
+        queue_size: int = 100,
+        digest_seconds: float = 0.0
     ):
         self.url = url.rstrip('/')
         self.app_token = app_token
         self.title = title
         self.priority = priority
+        self.session = requests.Session()
         logging.Handler.__init__(self=self)
 
+        # Messages waiting to be sent keyed by level and text so repeats coalesce
+        self.queue_size = max(1, queue_size)
+        self.digest_seconds = max(0.0, digest_seconds)
+        self.retry_seconds: float = 30.0
+        self.pending: OrderedDict[tuple[str, str], GotifyMessage] = OrderedDict()
+        self.dropped_count: int = 0
+        self.pending_lock = threading.Lock()
+        self.pending_event = threading.Event()
+        self.stop_event = threading.Event()
+
+        self.send_thread = threading.Thread(
+            target=self.__send_loop, name="gotify_handler", daemon=True
+        )
+        self.send_thread.start()
+
     def emit(self, record: logging.LogRecord):
-        """ Emits a log record to Gotify """
+        """ Queues a log record to be sent to Gotify without waiting for the send """
         try:
             formatted_message = self.formatter.format(record)
-            requests.post(
+        except Exception:
+            self.handleError(record)
+            return
+
+        key = (record.levelname, formatted_message)
+        with self.pending_lock:
+            if key in self.pending:
+                self.pending[key].count += 1
+            elif len(self.pending) < self.queue_size:
+                self.pending[key] = GotifyMessage(
+                    record.levelname, formatted_message
+                )
+            else:
+                self.dropped_count += 1
+        self.pending_event.set()
+
+    def __get_message_text(self, message: GotifyMessage) -> str:
+        if message.count > 1:
+            return f"{message.message} (repeated {message.count} times)"
+        return message.message
+
+    def __post(self, title: str, message: str) -> bool:
+        """ Send a message to Gotify. Returns if it was sent """
+        try:
+            r = self.session.post(
                 f"{self.url}/message?token={self.app_token}",
                 json={
-                    "message": formatted_message,
+                    "message": message,
                     "priority": self.priority,
-                    "title": f"{self.title} - {record.levelname}"
+                    "title": title
                 },
                 timeout=5
             )
+            return r.status_code < 300
         except RequestException:
-            self.handleError(record)
+            return False
+
+    def __take_pending(self) -> tuple[list[GotifyMessage], int]:
+        """ Take all waiting messages and the count of dropped messages """
+        with self.pending_lock:
+            messages = list(self.pending.values())
+            dropped_count = self.dropped_count
+            self.pending.clear()
+            self.dropped_count = 0
+            self.pending_event.clear()
+        return messages, dropped_count
+
+    def __return_pending(self, messages: list[GotifyMessage], dropped_count: int):
+        """ Put messages that could not be sent back in front of the queue """
+        with self.pending_lock:
+            newer = self.pending
+            self.pending = OrderedDict()
+            for message in messages:
+                if len(self.pending) < self.queue_size:
+                    self.pending[(message.level_name, message.message)] = message
+                else:
+                    dropped_count += 1
+
+            for key, message in newer.items():
+                if key in self.pending:
+                    self.pending[key].count += message.count
+                elif len(self.pending) < self.queue_size:
+                    self.pending[key] = message
+                else:
+                    dropped_count += 1
+            self.dropped_count += dropped_count
+        self.pending_event.set()
+
+    def __send_digest(self, messages: list[GotifyMessage], dropped_count: int) -> bool:
+        """ Send all messages as one digest message. Returns if it was sent """
+        lines = [
+            f"{message.level_name}: {self.__get_message_text(message)}"
+            for message in messages
+        ]
+        if dropped_count > 0:
+            lines.append(f"{dropped_count} more messages dropped")
+        return self.__post(f"{self.title} - Digest", "\n".join(lines))
+
+    def __send_messages(self, messages: list[GotifyMessage], dropped_count: int) -> bool:
+        """ Send each message on its own. Returns if all of them were sent """
+        for index, message in enumerate(messages):
+            if not self.__post(
+                f"{self.title} - {message.level_name}",
+                self.__get_message_text(message)
+            ):
+                self.__return_pending(messages[index:], dropped_count)
+                return False
+
+        if dropped_count > 0 and not self.__post(
+            f"{self.title} - WARNING",
+            f"{dropped_count} messages dropped while the notification queue was full"
+        ):
+            self.__return_pending([], dropped_count)
+            return False
+        return True
+
+    def __send_pending(self) -> bool:
+        """ Send the waiting messages. Returns False if Gotify could not be reached """
+        messages, dropped_count = self.__take_pending()
+        if len(messages) == 0 and dropped_count == 0:
+            return True
+
+        if self.digest_seconds > 0:
+            if not self.__send_digest(messages, dropped_count):
+                self.__return_pending(messages, dropped_count)
+                return False
+            return True
+
+        return self.__send_messages(messages, dropped_count)
+
+    def __send_loop(self):
+        while not self.stop_event.is_set():
+            if self.digest_seconds > 0:
+                self.stop_event.wait(self.digest_seconds)
+            else:
+                self.pending_event.wait()
+
+            if self.stop_event.is_set():
+                break
+
+            if not self.__send_pending():
+                # Gotify is not reachable, keep the messages and try again later
+                self.stop_event.wait(self.retry_seconds)
+
+        # Deliver what is left once on shut down then close the keep-alive
+        # session here so it is never closed under a send still posting
+        self.__send_pending()
+        self.session.close()
+
+    def close(self):
+        """ Send the waiting messages then close the handler and its keep-alive session """
+        self.stop_event.set()
+        self.pending_event.set()
+        if self.send_thread.is_alive():
+            self.send_thread.join(timeout=10)
+        logging.Handler.close(self)
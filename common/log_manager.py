@@ -1,20 +1,27 @@
 """ Log Manager """
 
+import atexit
 import logging
+import queue
 from logging import Logger
-from logging.handlers import RotatingFileHandler
 
 import colorlog
 
 from common.gotify_handler import GotifyHandler
 from common.gotify_plain_text_formatter import GotifyPlainTextFormatter
+from common.log_queue import (
+    BufferedRotatingFileHandler,
+    LogQueueHandler,
+    LogQueueListener
+)
 from common.plain_text_formatter import PlainTextFormatter
 
 
 class LogManager:
     """
     Manages logging for the application, including file and console output,
-    and optional Gotify notifications.
+    and optional Gotify notifications. File and console output is written by
+    a queue listener thread so logging never waits on disk or terminal I/O.
     """
 
     def __init__(
@@ -28,7 +35,12 @@ class LogManager:
             log_name (str): The name of the logger.
         """
         self.logger = logging.getLogger(log_name)
-        self.handler_list: list[logging.Handler] = []
+
+        # Defaults until configure_logging reads the configuration
+        self.flush_seconds: float = 1.0
+        self.max_bytes: int = 1000000
+        self.backup_count: int = 5
+        self.backlog_size: int = 10000
 
         log_date_format = "%Y-%m-%d %H:%M:%S"
         log_colors = {
@@ -44,8 +56,11 @@ class LogManager:
         self.file_formatter = PlainTextFormatter()
 
         # Create a file handler to write logs to a file
-        self.file_rotating_handler = RotatingFileHandler(
-            "/logs/media-utility.log", maxBytes=100000, backupCount=5
+        self.file_rotating_handler = BufferedRotatingFileHandler(
+            "/logs/media-utility.log",
+            self.max_bytes,
+            self.backup_count,
+            self.flush_seconds
         )
         self.file_rotating_handler.setLevel(logging.INFO)
         self.file_rotating_handler.setFormatter(self.file_formatter)
@@ -64,12 +79,67 @@ class LogManager:
         # Setup a place holder gotify handler
         self.gotify_handler: GotifyHandler = None
         self.gotify_formatter: GotifyPlainTextFormatter = None
-        
-        self.logger.addHandler(self.file_rotating_handler)
-        self.handler_list.append(self.file_rotating_handler)
-        
-        self.logger.addHandler(self.console_info_handler)
-        self.handler_list.append(self.console_info_handler)
+
+        # Route file and console output through the queue
+        self.queue_handler: LogQueueHandler = None
+        self.queue_listener: LogQueueListener = None
+        self.__start_queue()
+
+        # Write out the backlog when the application exits
+        atexit.register(self.shutdown)
+
+    def __start_queue(self) -> None:
+        """ Start a queue listener writing to the file and console handlers """
+        self.queue_handler = LogQueueHandler(
+            queue.Queue(maxsize=self.backlog_size)
+        )
+        self.queue_listener = LogQueueListener(
+            self.queue_handler,
+            self.flush_seconds,
+            self.file_rotating_handler,
+            self.console_info_handler
+        )
+        self.logger.addHandler(self.queue_handler)
+        self.queue_listener.start()
+
+    def __stop_queue(self) -> None:
+        """ Write out the backlog and stop the queue listener """
+        if self.queue_handler is not None:
+            self.logger.removeHandler(self.queue_handler)
+            self.queue_listener.stop()
+            self.queue_handler = None
+            self.queue_listener = None
+
+    def configure_logging(self, config: dict) -> None:
+        """ Configures the log flush interval, rotation size and backlog cap """
+        if "logging" in config:
+            logging_config = config["logging"]
+            try:
+                if "flush_seconds" in logging_config:
+                    self.flush_seconds = max(
+                        0.1, float(logging_config["flush_seconds"])
+                    )
+                if "max_bytes" in logging_config:
+                    self.max_bytes = max(0, int(logging_config["max_bytes"]))
+                if "backup_count" in logging_config:
+                    self.backup_count = max(
+                        0, int(logging_config["backup_count"])
+                    )
+                if "backlog_size" in logging_config:
+                    self.backlog_size = max(
+                        1, int(logging_config["backlog_size"])
+                    )
+            except (ValueError, TypeError) as e:
+                self.logger.warning(
+                    f"Configuration logging invalid using defaults error={e}"
+                )
+
+            # Restart the queue so the new settings apply
+            self.__stop_queue()
+            self.file_rotating_handler.maxBytes = self.max_bytes
+            self.file_rotating_handler.backupCount = self.backup_count
+            self.file_rotating_handler.flush_seconds = self.flush_seconds
+            self.__start_queue()
 
     def configure_gotify(self, config: dict) -> None:
         """Configures Gotify logging if enabled in the configuration."""
@@ -86,19 +156,39 @@ class LogManager:
                 and "message_title" in config["gotify_logging"]
                 and "priority" in config["gotify_logging"]
             ):
+                # Optional size of the notification queue and seconds between
+                # digest messages. A digest time of 0 sends messages as they arrive
+                queue_size: int = 100
+                digest_seconds: float = 0.0
+                try:
+                    if "queue_size" in config["gotify_logging"]:
+                        queue_size = int(config["gotify_logging"]["queue_size"])
+                    if "digest_seconds" in config["gotify_logging"]:
+                        digest_seconds = float(
+                            config["gotify_logging"]["digest_seconds"]
+                        )
+                except (ValueError, TypeError) as e:
+                    queue_size = 100
+                    digest_seconds = 0.0
+                    self.logger.warning(
+                        f"Configuration gotify_logging invalid using defaults error={e}"
+                    )
+
                 self.gotify_formatter = GotifyPlainTextFormatter()
                 self.gotify_handler = GotifyHandler(
                     config["gotify_logging"]["url"],
                     config["gotify_logging"]["app_token"],
                     config["gotify_logging"]["message_title"],
-                    config["gotify_logging"]["priority"]
+                    config["gotify_logging"]["priority"],
+                    queue_size,
+                    digest_seconds
                 )
                 self.gotify_handler.setLevel(logging.WARNING)
                 self.gotify_handler.setFormatter(self.gotify_formatter)
 
-                # Add the gotify handler to the logger
+                # Add the gotify handler to the logger. It queues its own
+                # messages so it does not need the log queue
                 self.logger.addHandler(self.gotify_handler)
-                self.handler_list.append(self.gotify_handler)
             else:
                 self.logger.warning(
                     "Configuration gotify_logging enabled is True but missing an attribute url, app_token, message_title or priority"
@@ -116,17 +206,15 @@ class LogManager:
     def log_info(self, message: str):
         """ Log an info message. """
         self.logger.info(message)
-        for handler in self.handler_list:
-            handler.flush()
 
     def log_warning(self, message: str):
         """ Log an warning message. """
         self.logger.warning(message)
-        for handler in self.handler_list:
-            handler.flush()
 
     def log_error(self, message: str):
         """ Log an error message. """
         self.logger.error(message)
-        for handler in self.handler_list:
-            handler.flush()
+
+    def shutdown(self) -> None:
+        """ Write out the log backlog and stop the queue listener """
+        self.__stop_queue()
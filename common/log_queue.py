@@ -0,0 +1,115 @@
+""" Log Queue """
+
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler that writes its buffer to disk at most every
+    flush_seconds instead of after every record
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        max_bytes: int,
+        backup_count: int,
+        flush_seconds: float
+    ):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count)
+        self.flush_seconds = max(0.0, flush_seconds)
+        self.flush_time: float = time.monotonic()
+
+    def flush(self):
+        """ Flush the buffer if flush_seconds have passed since the last flush """
+        if time.monotonic() - self.flush_time >= self.flush_seconds:
+            self.flush_now()
+
+    def flush_now(self):
+        """ Flush the buffer to disk """
+        self.flush_time = time.monotonic()
+        super().flush()
+
+
+class LogQueueHandler(QueueHandler):
+    """ QueueHandler that drops records instead of blocking when the backlog is full """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped_count: int = 0
+        self.dropped_lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord):
+        """ Add a record to the queue or count it as dropped if the queue is full """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped_count += 1
+
+    def take_dropped_count(self) -> int:
+        """ Get the number of records dropped since the last call """
+        with self.dropped_lock:
+            dropped_count = self.dropped_count
+            self.dropped_count = 0
+        return dropped_count
+
+
+class LogQueueListener(QueueListener):
+    """
+    QueueListener that writes the queued records on its own thread. While
+    the queue is idle the handlers are flushed and dropped records reported
+    """
+
+    def __init__(
+        self,
+        queue_handler: LogQueueHandler,
+        flush_seconds: float,
+        *handlers: logging.Handler
+    ):
+        super().__init__(queue_handler.queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.flush_seconds = max(0.1, flush_seconds)
+
+    def __flush_handlers(self):
+        """ Report dropped records and flush every handler """
+        dropped_count = self.queue_handler.take_dropped_count()
+        if dropped_count > 0:
+            self.handle(
+                logging.makeLogRecord({
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": logging.getLevelName(logging.WARNING),
+                    "msg": f"Log backlog full ... {dropped_count} messages dropped"
+                })
+            )
+
+        for handler in self.handlers:
+            if isinstance(handler, BufferedRotatingFileHandler):
+                handler.flush_now()
+            else:
+                handler.flush()
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        """ Wait for the next record, flushing the handlers whenever the queue is idle """
+        if not block:
+            return self.queue.get_nowait()
+
+        while True:
+            try:
+                return self.queue.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                self.__flush_handlers()
+
+    def enqueue_sentinel(self):
+        """ Wait for room for the stop sentinel so a full backlog is still written out """
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        """ Write out the backlog then stop the listener thread """
+        super().stop()
+        self.__flush_handlers()
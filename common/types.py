@@ -26,6 +26,7 @@ class UserInfo:
     """ Class representing a User group of Plex and Emby users """
     plex_users: list[UserPlexInfo] = field(default_factory=list)
     emby_users: list[UserEmbyInfo] = field(default_factory=list)
+    all_users_valid: bool = True
 
 
 @dataclass
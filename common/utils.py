@@ -1,7 +1,9 @@
 """ Common Utilities """
 
+import bisect
 import re
 from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, TypeVar
 
 from common.types import CronInfo
 
@@ -21,6 +23,9 @@ ANSI_CODE_SERVICE_DVR_MAINTAINER = f"{ANSI_CODE_START}210{ANSI_CODE_END}"
 ANSI_CODE_SERVICE_FOLDER_CLEANUP = f"{ANSI_CODE_START}70{ANSI_CODE_END}"
 ANSI_CODE_SERVICE_MEDIA_SERVER_SYNC = f"{ANSI_CODE_START}45{ANSI_CODE_END}"
 ANSI_CODE_SERVICE_PLAYLIST_SYNC = f"{ANSI_CODE_START}171{ANSI_CODE_END}"
+ANSI_CODE_SERVICE_LIBRARY_REFRESH = f"{ANSI_CODE_START}180{ANSI_CODE_END}"
+
+T = TypeVar("T")
 
 
 def get_log_header(module_ansi_code: str, module: str) -> str:
@@ -137,6 +142,105 @@ def get_short_path(path: str) -> str:
     return path
 
 
+def get_mapped_path(path: str, from_path: str, to_path: str) -> str:
+    """ Map a path from one root to another. Returns an empty string if the path is not under from_path """
+    if not from_path:
+        return ""
+
+    # Match whole folder names so /media/tv does not match /media/tv2
+    from_root = from_path.rstrip("/")
+    if path != from_root and not path.startswith(f"{from_root}/"):
+        return ""
+    return f"{to_path.rstrip("/")}{path[len(from_root):]}" or "/"
+
+
+def get_parent_folders(paths: Iterable[str]) -> list[str]:
+    """ Get the unique parent folders of a list of paths keeping the order first seen """
+    folders: dict[str, None] = {}
+    for path in paths:
+        folder = path.rstrip("/").rpartition("/")[0]
+        if folder:
+            folders[folder] = None
+    return list(folders)
+
+
 def get_comma_separated_list(list_to_separate: list[str]) -> str:
     """ Get a comma separated string from a list """
     return ",".join(list_to_separate)
+
+
+def get_comma_separated_chunks(
+    list_to_separate: list[str],
+    max_length: int
+) -> list[list[str]]:
+    """
+    Split a list into chunks whose comma separated string stays within max_length.
+    A single entry longer than max_length is returned in its own chunk.
+    """
+    chunks: list[list[str]] = []
+    current_chunk: list[str] = []
+    current_length: int = 0
+    for item in list_to_separate:
+        item_length = len(item) if not current_chunk else len(item) + 1
+        if current_chunk and current_length + item_length > max_length:
+            chunks.append(current_chunk)
+            current_chunk = []
+            item_length = len(item)
+            current_length = 0
+        current_chunk.append(item)
+        current_length += item_length
+
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
+def get_longest_increasing_subsequence(values: list[int]) -> list[int]:
+    """
+    Get the indexes of a longest strictly increasing subsequence of values in O(n log n).
+    """
+    # tail_indexes[length - 1] is the index of the smallest tail of an increasing run of that length
+    tail_indexes: list[int] = []
+    tail_values: list[int] = []
+    previous_indexes: list[int] = [-1] * len(values)
+    for index, value in enumerate(values):
+        length = bisect.bisect_left(tail_values, value)
+        if length > 0:
+            previous_indexes[index] = tail_indexes[length - 1]
+        if length == len(tail_values):
+            tail_indexes.append(index)
+            tail_values.append(value)
+        else:
+            tail_indexes[length] = index
+            tail_values[length] = value
+
+    subsequence: list[int] = []
+    index = tail_indexes[-1] if tail_indexes else -1
+    while index != -1:
+        subsequence.append(index)
+        index = previous_indexes[index]
+    subsequence.reverse()
+    return subsequence
+
+
+def get_latest_per_key(
+    items: Iterable[T],
+    get_key: Callable[[T], Any],
+    get_date: Callable[[T], Any],
+    replace_on_equal_date: bool = False
+) -> list[T]:
+    """
+    Reduce items to the latest item per key in a single pass.
+    Items can be streamed from a generator and the result keeps the order keys were first seen.
+    """
+    latest_items: dict[Any, T] = {}
+    for item in items:
+        key = get_key(item)
+        if key not in latest_items:
+            latest_items[key] = item
+        else:
+            item_date = get_date(item)
+            latest_date = get_date(latest_items[key])
+            if item_date > latest_date or (replace_on_equal_date and item_date == latest_date):
+                latest_items[key] = item
+    return list(latest_items.values())
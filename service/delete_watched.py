@@ -5,6 +5,7 @@ Deletes watched shows set up from a config file.
 
 import os
 import math
+import time
 from datetime import datetime
 from dataclasses import dataclass, field
 from typing import List
@@ -14,6 +15,7 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 from api.api_manager import ApiManager
 from common import utils
 from common.log_manager import LogManager
+from service.library_refresher import LibraryRefresher
 from service.service_base import ServiceBase
 
 
@@ -67,6 +69,13 @@ class LibraryInfo:
         default_factory=list)
 
 
+@dataclass
+class FileNameCacheEntry:
+    """ Class representing a cached rating key file name """
+    file_name: str
+    expire_time: float
+
+
 @dataclass
 class DeleteFileInfo:
     """ Class representing a file to delete """
@@ -84,7 +93,8 @@ class DeleteWatched(ServiceBase):
         api_manager: ApiManager,
         config: dict,
         log_manager: LogManager,
-        scheduler: BlockingScheduler
+        scheduler: BlockingScheduler,
+        library_refresher: LibraryRefresher
     ):
         super().__init__(
             utils.ANSI_CODE_SERVICE_DELETE_WATCHED,
@@ -95,9 +105,15 @@ class DeleteWatched(ServiceBase):
             scheduler
         )
 
+        self.library_refresher = library_refresher
+
         self.library_configs: list[LibraryConfigInfo] = []
         self.delete_time_hours: int = 24
 
+        # Cache of server and rating key to file name
+        self.file_name_cache: dict[tuple[str, str], FileNameCacheEntry] = {}
+        self.file_name_cache_ttl_hours: float = 24.0
+
         try:
             current_id: int = 1
             for library in config["libraries"]:
@@ -137,6 +153,10 @@ class DeleteWatched(ServiceBase):
 
             if "delete_time_hours" in config:
                 self.delete_time_hours = config["delete_time_hours"]
+            if "file_name_cache_ttl_hours" in config:
+                self.file_name_cache_ttl_hours = float(
+                    config["file_name_cache_ttl_hours"]
+                )
             self.get_history_days = int(
                 math.ceil(self.delete_time_hours / 24) + 1)
         except Exception as e:
@@ -250,6 +270,49 @@ class DeleteWatched(ServiceBase):
             )
         return None
 
+    def __resolve_plex_file_names(
+        self,
+        server_name: str,
+        history_file_names: dict[str, str]
+    ) -> dict[str, str]:
+        """
+        Resolve the file names of rating keys using the history file, the cache
+        and a single batched plex metadata request for the remaining keys
+        """
+        current_time = time.time()
+        expire_time = current_time + (self.file_name_cache_ttl_hours * 3600)
+
+        # Drop expired cache entries
+        for cache_key in [
+            key for key, entry in self.file_name_cache.items()
+            if entry.expire_time <= current_time
+        ]:
+            del self.file_name_cache[cache_key]
+
+        file_names: dict[str, str] = {}
+        missing_keys: list[str] = []
+        for rating_key, history_file_name in history_file_names.items():
+            cache_key = (server_name, rating_key)
+            if history_file_name:
+                file_names[rating_key] = history_file_name
+                self.file_name_cache[cache_key] = FileNameCacheEntry(
+                    history_file_name, expire_time
+                )
+            elif cache_key in self.file_name_cache:
+                file_names[rating_key] = self.file_name_cache[cache_key].file_name
+            else:
+                missing_keys.append(rating_key)
+
+        if len(missing_keys) > 0:
+            plex_api = self.api_manager.get_plex_api(server_name)
+            for rating_key, file_name in plex_api.get_item_paths(missing_keys).items():
+                file_names[rating_key] = file_name
+                self.file_name_cache[(server_name, rating_key)] = FileNameCacheEntry(
+                    file_name, expire_time
+                )
+
+        return file_names
+
     def __find_plex_watched_media(
         self,
         lib: MediaServerLibraryInfo,
@@ -260,38 +323,51 @@ class DeleteWatched(ServiceBase):
         tautulli_api = self.api_manager.get_tautulli_api(lib.server_name)
         date_time_string_for_history = utils.get_datetime_for_history_plex_string(
             self.get_history_days)
+
+        # Gather the watched items old enough to delete for every user
+        user_rating_keys: list[tuple[UserLibraryInfo, str]] = []
+        history_file_names: dict[str, str] = {}
         for user in lib.user_list:
             if (
                 user.user_name != ""
                 and lib.library_id != ""
                 and lib.media_path != ""
             ):
-                watched_items = tautulli_api.get_watch_history_for_user_and_library(
+                watched_items = tautulli_api.get_watch_history(
                     user.user_id_int,
-                    lib.library_id,
-                    date_time_string_for_history
+                    date_time_string_for_history,
+                    lib.library_id
                 )
-                for item in watched_items.items:
+                for item in watched_items:
                     if item.watched is not None and item.watched:
-                        file_name = tautulli_api.get_filename(item.id)
-                        if len(file_name) > 0:
-                            item_hours_since_play = utils.get_hours_since_play(
-                                False,
-                                datetime.fromtimestamp(
-                                    item.date_watched
-                                )
+                        item_hours_since_play = utils.get_hours_since_play(
+                            False,
+                            datetime.fromtimestamp(
+                                item.date_watched
                             )
-                            if item_hours_since_play >= self.delete_time_hours:
-                                return_deletes.append(
-                                    DeleteFileInfo(
-                                        lib_id,
-                                        file_name.replace(
-                                            lib.media_path,
-                                            utilities_path),
-                                        user.friendly_name,
-                                        utils.get_formatted_plex()
-                                    )
-                                )
+                        )
+                        if item_hours_since_play >= self.delete_time_hours:
+                            rating_key = str(item.id)
+                            user_rating_keys.append((user, rating_key))
+                            if item.file or rating_key not in history_file_names:
+                                history_file_names[rating_key] = item.file
+
+        file_names = self.__resolve_plex_file_names(
+            lib.server_name, history_file_names
+        )
+
+        for user, rating_key in user_rating_keys:
+            if rating_key in file_names and len(file_names[rating_key]) > 0:
+                return_deletes.append(
+                    DeleteFileInfo(
+                        lib_id,
+                        file_names[rating_key].replace(
+                            lib.media_path,
+                            utilities_path),
+                        user.friendly_name,
+                        utils.get_formatted_plex()
+                    )
+                )
 
         return return_deletes
 
@@ -315,38 +391,50 @@ class DeleteWatched(ServiceBase):
                 lib.library_id
             )
 
+            # Group the ids of items played long enough ago by user
+            user_item_ids: dict[str, dict[str, None]] = {
+                user.user_name: {} for user in lib.user_list if user.user_name != ""
+            }
             for item in watched_items.items:
-                for user in lib.user_list:
-                    if user.user_name != "" and item.user_name == user.user_name:
-                        item_id = "0"
-                        if item.episode_id:
-                            item_id = item.episode_id
-                        else:
-                            item_id = item.id
-
-                        emby_watched_status = emby_api.get_watched_status(
-                            user.user_id, item_id
-                        )
-                        if emby_watched_status is not None and emby_watched_status:
-                            item_hours_since_play = utils.get_hours_since_play(
-                                True,
-                                datetime.fromisoformat(item.date_watched)
+                if item.user_name in user_item_ids:
+                    item_hours_since_play = utils.get_hours_since_play(
+                        True,
+                        datetime.fromisoformat(item.date_watched)
+                    )
+                    if item_hours_since_play >= self.delete_time_hours:
+                        user_item_ids[item.user_name][
+                            item.episode_id if item.episode_id else item.id
+                        ] = None
+
+            # Resolve the watched status and path of each users items in batches
+            for user in lib.user_list:
+                if user.user_name not in user_item_ids or len(user_item_ids[user.user_name]) == 0:
+                    continue
+
+                item_ids = list(user_item_ids[user.user_name])
+                emby_watched_statuses = emby_api.get_watched_statuses(
+                    user.user_id, item_ids
+                )
+                watched_item_ids = [
+                    item_id for item_id in item_ids
+                    if item_id in emby_watched_statuses and emby_watched_statuses[item_id]
+                ]
+                if len(watched_item_ids) == 0:
+                    continue
+
+                emby_items = emby_api.search_items(watched_item_ids)
+                for item_id in watched_item_ids:
+                    if item_id in emby_items and emby_items[item_id].path:
+                        return_deletes.append(
+                            DeleteFileInfo(
+                                lib_id,
+                                emby_items[item_id].path.replace(
+                                    lib.media_path,
+                                    utilities_path),
+                                user.user_name,
+                                utils.get_formatted_emby()
                             )
-
-                            if item_hours_since_play >= self.delete_time_hours:
-                                emby_item = emby_api.search_item(item_id)
-                                if emby_item is not None:
-                                    return_deletes.append(
-                                        DeleteFileInfo(
-                                            lib_id,
-                                            emby_item.path.replace(
-                                                lib.media_path,
-                                                utilities_path),
-                                            user.user_name,
-                                            utils.get_formatted_emby()
-                                        )
-                                    )
-                        break
+                        )
 
         return return_deletes
 
@@ -461,8 +549,9 @@ class DeleteWatched(ServiceBase):
 
         return libraries
 
-    def __delete_media(self, media_to_delete: list[list[DeleteFileInfo]]) -> list[int]:
-        return_libraries: list[int] = []
+    def __delete_media(self, media_to_delete: list[list[DeleteFileInfo]]) -> dict[int, list[str]]:
+        """ Delete the media and return the deleted file paths per library id """
+        deleted_paths: dict[int, list[str]] = {}
 
         for media_container in media_to_delete:
             for media in media_container:
@@ -473,14 +562,10 @@ class DeleteWatched(ServiceBase):
                         f"{utils.get_tag("file", utils.get_standout_text(media.file_path))}"
                     )
 
-                    # Check if this library needs to be added to the list to notify
-                    notify_lib_found = False
-                    for notify_lib in return_libraries:
-                        if notify_lib == media.id:
-                            notify_lib_found = True
-                            break
-                    if not notify_lib_found:
-                        return_libraries.append(media.id)
+                    # Record the path so the library can be notified of the change
+                    deleted_paths.setdefault(media.id, []).append(
+                        media.file_path
+                    )
                 except FileNotFoundError:
                     self.log_error(
                         f"Failed to delete {utils.get_tag("file", media.file_path)} not found."
@@ -497,17 +582,42 @@ class DeleteWatched(ServiceBase):
                         f"Failed to delete {utils.get_tag("file", media.file_path)} {utils.get_tag("error", e)}"
                     )
 
-        return return_libraries
+        return deleted_paths
 
-    def __notify_plex(self, plex_library_list: list[MediaServerLibraryInfo], target_name) -> str:
+    def __get_server_paths(
+        self,
+        deleted_paths: list[str],
+        utilities_path: str,
+        media_path: str
+    ) -> list[str]:
+        """ Map deleted utility paths to the paths the media server uses """
+        server_paths: list[str] = []
+        for deleted_path in deleted_paths:
+            server_path = utils.get_mapped_path(
+                deleted_path, utilities_path, media_path
+            )
+            if not server_path:
+                # A path that can not be mapped needs a full library scan
+                return []
+            server_paths.append(server_path)
+        return server_paths
+
+    def __notify_plex(
+        self,
+        plex_library_list: list[MediaServerLibraryInfo],
+        target_name: str,
+        utilities_path: str,
+        deleted_paths: list[str]
+    ) -> str:
         return_target_name: str = target_name
         for plex_library in plex_library_list:
             if plex_library.library_name != "":
-                plex_api = self.api_manager.get_plex_api(
-                    plex_library.server_name
-                )
-                plex_api.set_library_scan(
-                    plex_library.library_name
+                self.library_refresher.request_plex_refresh(
+                    plex_library.server_name,
+                    plex_library.library_name,
+                    self.__get_server_paths(
+                        deleted_paths, utilities_path, plex_library.media_path
+                    )
                 )
                 return_target_name = utils.build_target_string(
                     return_target_name,
@@ -516,15 +626,23 @@ class DeleteWatched(ServiceBase):
                 )
         return return_target_name
 
-    def __notify_emby(self, emby_library_list: list[MediaServerLibraryInfo], target_name) -> str:
+    def __notify_emby(
+        self,
+        emby_library_list: list[MediaServerLibraryInfo],
+        target_name: str,
+        utilities_path: str,
+        deleted_paths: list[str]
+    ) -> str:
         return_target_name: str = target_name
         for emby_library in emby_library_list:
             if emby_library.library_id != "":
-                emby_api = self.api_manager.get_emby_api(
-                    emby_library.server_name
-                )
-                emby_api.set_library_scan(
-                    emby_library.library_id
+                self.library_refresher.request_emby_refresh(
+                    emby_library.server_name,
+                    emby_library.library_name,
+                    emby_library.library_id,
+                    self.__get_server_paths(
+                        deleted_paths, utilities_path, emby_library.media_path
+                    )
                 )
                 return_target_name = utils.build_target_string(
                     return_target_name,
@@ -555,23 +673,31 @@ class DeleteWatched(ServiceBase):
                 )
 
         # Delete media added to the list
-        libraries_to_notify: list[int] = self.__delete_media(media_to_delete)
+        deleted_paths: dict[int, list[str]] = self.__delete_media(
+            media_to_delete
+        )
 
-        for notify_lib in libraries_to_notify:
+        for notify_lib, notify_paths in deleted_paths.items():
             for library in libraries:
                 if library.id == notify_lib:
                     target_name = ""
 
                     target_name = self.__notify_plex(
-                        library.plex_library_list, target_name
+                        library.plex_library_list,
+                        target_name,
+                        library.utilities_path,
+                        notify_paths
                     )
 
                     target_name = self.__notify_emby(
-                        library.emby_library_list, target_name
+                        library.emby_library_list,
+                        target_name,
+                        library.utilities_path,
+                        notify_paths
                     )
 
                     if target_name:
-                        self.log_info(f"Notified {target_name} to refresh")
+                        self.log_info(f"Queued {target_name} to refresh")
 
                     break
 
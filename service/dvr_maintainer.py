@@ -3,17 +3,19 @@ DVR Maintainer Service
 Deletes shows based on age or number of shows within the folder
 """
 
+import heapq
 import os
-import glob
+import time
 from dataclasses import dataclass, field
-from datetime import datetime
 from typing import List
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 from api.api_manager import ApiManager
 from common import utils
+from common.folder_watcher import FolderWatcher
 from common.log_manager import LogManager
+from service.library_refresher import LibraryRefresher
 from service.service_base import ServiceBase
 
 
@@ -31,6 +33,7 @@ class MediaServerInfo:
     server_name: str
     library_name: str
     library_id: str
+    media_path: str = ""
 
 
 @dataclass
@@ -58,7 +61,8 @@ class DvrMaintainer(ServiceBase):
         api_manager: ApiManager,
         config: dict,
         log_manager: LogManager,
-        scheduler: BlockingScheduler
+        scheduler: BlockingScheduler,
+        library_refresher: LibraryRefresher
     ):
         super().__init__(
             utils.ANSI_CODE_SERVICE_DVR_MAINTAINER,
@@ -69,9 +73,23 @@ class DvrMaintainer(ServiceBase):
             scheduler
         )
 
+        self.library_refresher = library_refresher
+
         self.library_configs: list[LibraryConfig] = []
         self.run_test: bool = False
 
+        self.file_extensions: set[str] = {".ts", ".mkv"}
+        if "file_extensions" in config:
+            self.file_extensions = {
+                extension if extension.startswith(".") else f".{extension}"
+                for extension in config["file_extensions"]
+            }
+
+        # Optionally keep an inotify index of the libraries instead of walking them every run
+        self.folder_watcher: FolderWatcher = None
+        if "watch_mode" in config and config["watch_mode"] == "True":
+            self.folder_watcher = FolderWatcher(self.log_header, log_manager)
+
         current_library_id: int = 1
 
         library_number: int = 1
@@ -117,20 +135,13 @@ class DvrMaintainer(ServiceBase):
 
     def __read_plex_server_info(self, plex_server: dict) -> MediaServerInfo:
         if "server" in plex_server and "library_name" in plex_server:
-            plex_api = self.api_manager.get_plex_api(plex_server["server"])
-            if plex_api is not None:
-                if (
-                    plex_api.get_valid()
-                    and not plex_api.get_library_valid(plex_server["library_name"])
-                ):
-                    self.log_warning(
-                        f"No {utils.get_formatted_plex()}({plex_server['server']}) "
-                        f"library found for {plex_server['library_name']}"
-                    )
+            # The server is checked when the job runs since it may not be reachable yet
+            if self.api_manager.get_plex_api(plex_server["server"]) is not None:
                 return MediaServerInfo(
                     plex_server["server"],
                     plex_server["library_name"],
-                    ""
+                    "",
+                    plex_server.get("media_path", "")
                 )
 
             self.log_warning(
@@ -146,21 +157,13 @@ class DvrMaintainer(ServiceBase):
 
     def __read_emby_server_info(self, emby_server: dict) -> MediaServerInfo:
         if "server" in emby_server and "library_name" in emby_server:
-            emby_api = self.api_manager.get_emby_api(emby_server["server"])
-            if emby_api is not None:
-                if (
-                    emby_api.get_valid()
-                    and not emby_api.get_library_valid(emby_server["library_name"])
-                ):
-                    self.log_warning(
-                        f"No {utils.get_formatted_emby()}({emby_server['server']}) "
-                        f"library found for {emby_server['library_name']}"
-                    )
-
+            # The server is checked when the job runs since it may not be reachable yet
+            if self.api_manager.get_emby_api(emby_server["server"]) is not None:
                 return MediaServerInfo(
                     emby_server["server"],
                     emby_server["library_name"],
-                    ""
+                    "",
+                    emby_server.get("media_path", "")
                 )
 
             self.log_warning(
@@ -208,33 +211,134 @@ class DvrMaintainer(ServiceBase):
                     )
         return None
 
-    def __get_files_in_path(self, path: str) -> List[FileInfo]:
-        file_info: list[FileInfo] = []
-        for file in glob.glob(f"{path}/**/*", recursive=True):
-            if file.endswith(".ts") or file.endswith(".mkv"):
-                file_age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(file))
-                file_info.append(
-                    FileInfo(file, file_age.days + (file_age.seconds / 86400)))
-        return file_info
-
-    def __delete_file(self, pathFileName: str):
-        if self.run_test:
-            self.log_info(
-                f"Running test! Would delete {utils.get_tag("file", pathFileName)}"
-            )
-        else:
+    def __add_files_in_path(
+        self,
+        path: str,
+        current_time: float,
+        file_info: list[FileInfo]
+    ):
+        """
+        Add all media files below a path using the stat of the directory entries.
+        Hidden files and folders are skipped like the recursive glob did and
+        symlinked folders are not followed, matching the watch index
+        """
+        folders: list[str] = [path]
+        while len(folders) > 0:
+            folder = folders.pop()
             try:
-                os.remove(pathFileName)
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                        elif os.path.splitext(entry.name)[1] in self.file_extensions:
+                            file_info.append(
+                                FileInfo(
+                                    entry.path,
+                                    (current_time - entry.stat(follow_symlinks=False).st_mtime) / 86400
+                                )
+                            )
             except OSError as e:
                 self.log_error(
-                    f"Problem deleting "
-                    f"{utils.get_tag("file", pathFileName)} "
+                    f"Problem scanning "
+                    f"{utils.get_tag("path", folder)} "
                     f"{utils.get_tag("error", e)}"
                 )
 
-    def __keep_last_delete(self, path: str, keep_last: int) -> bool:
-        shows_deleted = False
-        file_info = self.__get_files_in_path(path)
+    def __get_show_folder_valid(self, utility_path: str, show_name: str) -> bool:
+        """ Get if a show folder exists without passing through a symlinked folder """
+        show_path = utility_path
+        for folder_name in show_name.split("/"):
+            show_path = f"{show_path}/{folder_name}"
+            if os.path.islink(show_path) or not os.path.isdir(show_path):
+                return False
+        return True
+
+    def __get_indexed_library(self, library: LibraryConfig) -> dict[str, list[FileInfo]]:
+        """ Bucket the media files of the configured shows from the watch index """
+        current_time = time.time()
+        show_files: dict[str, list[FileInfo]] = {}
+        for show in library.shows:
+            if show.name not in show_files:
+                folder_files = self.folder_watcher.get_files(
+                    f"{library.utility_path}/{show.name}", skip_hidden=True
+                )
+                if folder_files is not None:
+                    show_files[show.name] = [
+                        FileInfo(file.path, (current_time - file.mtime) / 86400)
+                        for file in folder_files
+                        if os.path.splitext(file.name)[1] in self.file_extensions
+                    ]
+        return show_files
+
+    def __scan_library(self, library: LibraryConfig) -> dict[str, list[FileInfo]]:
+        """
+        Walk the library utility path once and bucket the media files by show folder.
+        Only the folders of configured shows are walked
+        """
+        current_time = time.time()
+        show_files: dict[str, list[FileInfo]] = {}
+        show_names: set[str] = set()
+        for show in library.shows:
+            if "/" in show.name:
+                # Nested show folders are scanned on their own
+                if (
+                    show.name not in show_files
+                    and self.__get_show_folder_valid(library.utility_path, show.name)
+                ):
+                    show_files[show.name] = []
+                    self.__add_files_in_path(
+                        f"{library.utility_path}/{show.name}",
+                        current_time,
+                        show_files[show.name]
+                    )
+            else:
+                show_names.add(show.name)
+
+        try:
+            with os.scandir(library.utility_path) as entries:
+                for entry in entries:
+                    if entry.name in show_names and entry.is_dir(follow_symlinks=False):
+                        show_files[entry.name] = []
+                        self.__add_files_in_path(
+                            entry.path, current_time, show_files[entry.name]
+                        )
+        except OSError as e:
+            self.log_error(
+                f"Problem scanning "
+                f"{utils.get_tag("path", library.utility_path)} "
+                f"{utils.get_tag("error", e)}"
+            )
+
+        return show_files
+
+    def __delete_file(self, pathFileName: str) -> bool:
+        """ Delete a file. Returns if the file was deleted """
+        if self.run_test:
+            self.log_info(
+                f"Running test! Would delete {utils.get_tag("file", pathFileName)}"
+            )
+            return False
+
+        try:
+            os.remove(pathFileName)
+            return True
+        except OSError as e:
+            self.log_error(
+                f"Problem deleting "
+                f"{utils.get_tag("file", pathFileName)} "
+                f"{utils.get_tag("error", e)}"
+            )
+        return False
+
+    def __keep_last_delete(
+        self,
+        path: str,
+        keep_last: int,
+        file_info: list[FileInfo]
+    ) -> list[str]:
+        deleted_paths: list[str] = []
         if len(file_info) > keep_last:
             self.log_info(
                 f"KEEP_LAST_{keep_last} "
@@ -242,11 +346,12 @@ class DvrMaintainer(ServiceBase):
                 f"{utils.get_tag("path", utils.get_standout_text(utils.get_short_path(path)))}"
             )
 
-            sorted_file_info = sorted(
-                file_info, key=lambda item: item.age_days, reverse=True)
+            # Only the oldest files are needed so select them with a heap
             shows_to_delete = len(file_info) - keep_last
-            deleted_shows = 0
-            for file in sorted_file_info:
+            oldest_file_info = heapq.nlargest(
+                shows_to_delete, file_info, key=lambda item: item.age_days
+            )
+            for file in oldest_file_info:
                 file_tag = utils.get_tag(
                     "file",
                     utils.get_standout_text(
@@ -257,17 +362,17 @@ class DvrMaintainer(ServiceBase):
                     f"KEEP_LAST_{keep_last} deleting oldest "
                     f"{utils.get_tag("age days", int(round(file.age_days)))} {file_tag}"
                 )
-                self.__delete_file(file.path)
-                shows_deleted = True
-                deleted_shows += 1
-                if deleted_shows >= shows_to_delete:
-                    break
+                if self.__delete_file(file.path):
+                    deleted_paths.append(file.path)
 
-        return shows_deleted
+        return deleted_paths
 
-    def __keep_show_days(self, path: str, keep_days: int) -> bool:
-        shows_deleted = False
-        file_info = self.__get_files_in_path(path)
+    def __keep_show_days(
+        self,
+        keep_days: int,
+        file_info: list[FileInfo]
+    ) -> list[str]:
+        deleted_paths: list[str] = []
         for file in file_info:
             if file.age_days >= keep_days:
                 age_days_str = f"{file.age_days:.1f}"
@@ -277,43 +382,91 @@ class DvrMaintainer(ServiceBase):
                     f"KEEP_DAYS_{keep_days} deleting "
                     f"{utils.get_tag("age days", age_days_str)} {file_tag}"
                 )
-                self.__delete_file(file.path)
-                shows_deleted = True
-        return shows_deleted
+                if self.__delete_file(file.path):
+                    deleted_paths.append(file.path)
+        return deleted_paths
 
     def __check_library_delete_shows(
         self,
         library: LibraryConfig
-    ) -> List[int]:
-        deleted_data: list[int] = []
+    ) -> List[str]:
+        deleted_paths: list[str] = []
+        show_files = (
+            self.__get_indexed_library(library)
+            if self.folder_watcher is not None and self.folder_watcher.get_valid() else
+            self.__scan_library(library)
+        )
         for show in library.shows:
-            library_file_path = f"{library.utility_path}/{show.name}"
-            if os.path.exists(library_file_path):
+            if show.name in show_files:
+                show_deleted_paths: list[str] = []
                 if show.action_type == "KEEP_LAST":
-                    shows_deleted = self.__keep_last_delete(
-                        library_file_path,
-                        show.action_value
+                    show_deleted_paths = self.__keep_last_delete(
+                        f"{library.utility_path}/{show.name}",
+                        show.action_value,
+                        show_files[show.name]
                     )
-                    if shows_deleted:
-                        deleted_data.append(library.id)
                 elif show.action_type == "KEEP_LENGTH_DAYS":
-                    shows_deleted = self.__keep_show_days(
-                        library_file_path,
-                        show.action_value
+                    show_deleted_paths = self.__keep_show_days(
+                        show.action_value,
+                        show_files[show.name]
                     )
-                    if shows_deleted:
-                        deleted_data.append(library.id)
 
-        return deleted_data
+                if len(show_deleted_paths) > 0:
+                    # Another action on the same show must not see deleted files
+                    deleted_path_set = set(show_deleted_paths)
+                    show_files[show.name] = [
+                        file for file in show_files[show.name]
+                        if file.path not in deleted_path_set
+                    ]
+                    deleted_paths.extend(show_deleted_paths)
+
+        return deleted_paths
+
+    def __get_server_paths(
+        self,
+        library: LibraryConfig,
+        media_server: MediaServerInfo,
+        deleted_paths: list[str]
+    ) -> list[str]:
+        """ Map deleted utility paths to the media server paths. Empty if a full scan is needed """
+        if not media_server.media_path:
+            return []
+
+        server_paths: list[str] = []
+        for deleted_path in deleted_paths:
+            server_path = utils.get_mapped_path(
+                deleted_path, library.utility_path, media_server.media_path
+            )
+            if not server_path:
+                return []
+            server_paths.append(server_path)
+        return server_paths
 
-    def __notify_plex_refresh(self, plex_server: MediaServerInfo) -> str:
-        plex_api = self.api_manager.get_plex_api(plex_server.server_name)
-        plex_api.set_library_scan(plex_server.library_name)
+    def __notify_plex_refresh(
+        self,
+        library: LibraryConfig,
+        plex_server: MediaServerInfo,
+        deleted_paths: list[str]
+    ) -> str:
+        self.library_refresher.request_plex_refresh(
+            plex_server.server_name,
+            plex_server.library_name,
+            self.__get_server_paths(library, plex_server, deleted_paths)
+        )
         return f"{utils.get_formatted_plex()}({plex_server.server_name})"
 
-    def __notify_emby_refresh(self, emby_server: MediaServerInfo) -> str:
-        emby_api = self.api_manager.get_emby_api(emby_server.server_name)
-        emby_api.set_library_scan(emby_server.library_id)
+    def __notify_emby_refresh(
+        self,
+        library: LibraryConfig,
+        emby_server: MediaServerInfo,
+        deleted_paths: list[str]
+    ) -> str:
+        self.library_refresher.request_emby_refresh(
+            emby_server.server_name,
+            emby_server.library_name,
+            emby_server.library_id,
+            self.__get_server_paths(library, emby_server, deleted_paths)
+        )
         return f"{utils.get_formatted_emby()}({emby_server.server_name})"
 
     def __get_library_data(self) -> List[LibraryConfig]:
@@ -323,12 +476,20 @@ class DvrMaintainer(ServiceBase):
             for plex_server in library_config.plex_server_list:
                 plex_api = self.api_manager.get_plex_api(
                     plex_server.server_name)
-                if plex_api.get_valid() and plex_api.get_library_valid(plex_server.library_name):
+                if not plex_api.get_valid():
+                    self.log_warning(plex_api.get_connection_error_log())
+                elif not plex_api.get_library_valid(plex_server.library_name):
+                    self.log_warning(
+                        f"No {utils.get_formatted_plex()}({plex_server.server_name}) "
+                        f"library found for {plex_server.library_name}"
+                    )
+                else:
                     plex_server_list.append(
                         MediaServerInfo(
                             plex_server.server_name,
                             plex_server.library_name,
-                            ""
+                            "",
+                            plex_server.media_path
                         )
                     )
 
@@ -336,13 +497,23 @@ class DvrMaintainer(ServiceBase):
             for emby_server in library_config.emby_server_list:
                 emby_api = self.api_manager.get_emby_api(
                     emby_server.server_name)
+                if not emby_api.get_valid():
+                    self.log_warning(emby_api.get_connection_error_log())
+                    continue
+
                 library_id = emby_api.get_library_id(emby_server.library_name)
-                if emby_api.get_valid() and library_id != emby_api.get_invalid_item_id():
+                if library_id == emby_api.get_invalid_item_id():
+                    self.log_warning(
+                        f"No {utils.get_formatted_emby()}({emby_server.server_name}) "
+                        f"library found for {emby_server.library_name}"
+                    )
+                else:
                     emby_server_list.append(
                         MediaServerInfo(
                             emby_server.server_name,
                             emby_server.library_name,
-                            library_id
+                            library_id,
+                            emby_server.media_path
                         )
                     )
 
@@ -361,54 +532,47 @@ class DvrMaintainer(ServiceBase):
     def __do_maintenance(self):
         libraries = self.__get_library_data()
 
-        deleted_data_library_ids: list[int] = []
+        deleted_library_paths: dict[int, list[str]] = {}
         for library in libraries:
-            temp_deleted_library_ids = self.__check_library_delete_shows(
-                library)
-            for temp_library_id in temp_deleted_library_ids:
-                deleted_data_library_ids.append(temp_library_id)
-
-        # Notify media servers of a refresh
-        shrunk_deleted_libraries: list[int] = []
-        for deleted_data_library_id in deleted_data_library_ids:
-            library_in_list: bool = False
-            for shrunk_deleted_library_id in shrunk_deleted_libraries:
-                if shrunk_deleted_library_id == deleted_data_library_id:
-                    library_in_list = True
-                    break
-            if not library_in_list:
-                shrunk_deleted_libraries.append(deleted_data_library_id)
-
-        for deleted_library_id in shrunk_deleted_libraries:
-            for library in libraries:
-                if library.id == deleted_library_id:
-                    target_name: str = ""
-                    for plex_server in library.plex_server_list:
-                        plex_target_name = self.__notify_plex_refresh(
-                            plex_server)
-                        target_name = utils.build_target_string(
-                            target_name,
-                            plex_target_name,
-                            plex_server.library_name
-                        )
+            deleted_paths = self.__check_library_delete_shows(library)
+            if len(deleted_paths) > 0:
+                deleted_library_paths[library.id] = deleted_paths
 
-                    for emby_server in library.emby_server_list:
-                        emby_target_name = self.__notify_emby_refresh(
-                            emby_server)
-                        target_name = utils.build_target_string(
-                            target_name,
-                            emby_target_name,
-                            emby_server.library_name
-                        )
+        # Notify media servers of the deleted paths
+        for library in libraries:
+            if library.id in deleted_library_paths:
+                deleted_paths = deleted_library_paths[library.id]
+                target_name: str = ""
+                for plex_server in library.plex_server_list:
+                    plex_target_name = self.__notify_plex_refresh(
+                        library, plex_server, deleted_paths)
+                    target_name = utils.build_target_string(
+                        target_name,
+                        plex_target_name,
+                        plex_server.library_name
+                    )
 
-                    if target_name:
-                        self.log_info(
-                            f"Notified {target_name} to refresh"
-                        )
+                for emby_server in library.emby_server_list:
+                    emby_target_name = self.__notify_emby_refresh(
+                        library, emby_server, deleted_paths)
+                    target_name = utils.build_target_string(
+                        target_name,
+                        emby_target_name,
+                        emby_server.library_name
+                    )
+
+                if target_name:
+                    self.log_info(
+                        f"Queued {target_name} to refresh"
+                    )
 
     def init_scheduler_jobs(self):
         if self.cron is not None:
             self.log_service_enabled()
+            if self.folder_watcher is not None and self.folder_watcher.start(
+                [library.utility_path for library in self.library_configs]
+            ):
+                self.log_info("Watching libraries for changes")
             self.scheduler.add_job(
                 self.__do_maintenance,
                 trigger="cron",
@@ -417,3 +581,7 @@ class DvrMaintainer(ServiceBase):
             )
         else:
             self.log_warning("Enabled but will not Run. Cron is not valid!")
+
+    def shutdown(self):
+        if self.folder_watcher is not None:
+            self.folder_watcher.stop()
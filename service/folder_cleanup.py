@@ -3,16 +3,19 @@ Folder Cleanup Service
 Deletes empty folders and notified media servers
 """
 
+import fnmatch
 import os
+import re
 import shutil
 from dataclasses import dataclass, field
-from typing import List
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 from api.api_manager import ApiManager
 from common import utils
+from common.folder_watcher import FolderEntry, FolderWatcher
 from common.log_manager import LogManager
+from service.library_refresher import LibraryRefresher
 from service.service_base import ServiceBase
 
 
@@ -21,6 +24,7 @@ class MediaServerInfo:
     """ Media Server Information """
     server_name: str
     library_name: str
+    media_path: str = ""
 
 
 @dataclass
@@ -39,7 +43,8 @@ class FolderCleanup(ServiceBase):
         api_manager: ApiManager,
         config: dict,
         log_manager: LogManager,
-        scheduler: BlockingScheduler
+        scheduler: BlockingScheduler,
+        library_refresher: LibraryRefresher
     ):
         super().__init__(
             utils.ANSI_CODE_SERVICE_FOLDER_CLEANUP,
@@ -50,9 +55,9 @@ class FolderCleanup(ServiceBase):
             scheduler
         )
 
+        self.library_refresher = library_refresher
+
         self.paths: list[PathInfo] = []
-        self.ignore_folder_in_empty_check: list[str] = []
-        self.ignore_file_in_empty_check: list[str] = []
 
         for path in config["paths_to_check"]:
             if "path" in path:
@@ -75,33 +80,47 @@ class FolderCleanup(ServiceBase):
                             emby_server_info
                         )
 
-                    self.paths.append(path_info)
+                self.paths.append(path_info)
 
-        for folder in config["ignore_folder_in_empty_check"]:
-            self.ignore_folder_in_empty_check.append(
-                folder["ignore_folder"]
-            )
+        # Ignore entries are exact names or glob patterns like *.nfo
+        self.ignore_folder_names, self.ignore_folder_patterns = self.__read_ignore_list(
+            config["ignore_folder_in_empty_check"], "ignore_folder"
+        )
+        self.ignore_file_names, self.ignore_file_patterns = self.__read_ignore_list(
+            config["ignore_file_in_empty_check"], "ignore_file"
+        )
 
-        for file in config["ignore_file_in_empty_check"]:
-            self.ignore_folder_in_empty_check.append(
-                file["ignore_file"]
-            )
+        # Optionally keep an inotify index of the paths instead of walking them every run
+        self.folder_watcher: FolderWatcher = None
+        self.checked_change_count: int = -1
+        if "watch_mode" in config and config["watch_mode"] == "True":
+            self.folder_watcher = FolderWatcher(self.log_header, log_manager)
 
-    def __read_plex_server_info(self, plex_server: dict) -> MediaServerInfo:
-        if "server" in plex_server and "library_name" in plex_server:
-            plex_api = self.api_manager.get_plex_api(plex_server["server"])
-            if plex_api is not None:
-                if (plex_api.get_valid()
-                        and not plex_api.get_library_valid(plex_server["library_name"])
-                    ):
-                    self.log_warning(
-                        f"No {utils.get_formatted_plex()}({plex_server['server']}) "
-                        f"library found for {plex_server['library_name']}"
+    def __read_ignore_list(
+        self,
+        ignore_list: list[dict],
+        key: str
+    ) -> tuple[set[str], list[re.Pattern]]:
+        names: set[str] = set()
+        patterns: list[re.Pattern] = []
+        for ignore in ignore_list:
+            if key in ignore:
+                if any(char in ignore[key] for char in "*?["):
+                    patterns.append(
+                        re.compile(fnmatch.translate(ignore[key]))
                     )
+                else:
+                    names.add(ignore[key])
+        return names, patterns
 
+    def __read_plex_server_info(self, plex_server: dict) -> MediaServerInfo:
+        if "server" in plex_server and "library_name" in plex_server:
+            # The server is checked when the job runs since it may not be reachable yet
+            if self.api_manager.get_plex_api(plex_server["server"]) is not None:
                 return MediaServerInfo(
                     plex_server["server"],
-                    plex_server["library_name"]
+                    plex_server["library_name"],
+                    plex_server.get("media_path", "")
                 )
             else:
                 self.log_warning(
@@ -112,20 +131,12 @@ class FolderCleanup(ServiceBase):
 
     def __read_emby_server_info(self, emby_server: dict) -> MediaServerInfo:
         if "server" in emby_server and "library_name" in emby_server:
-            emby_api = self.api_manager.get_emby_api(emby_server["server"])
-            if emby_api is not None:
-                if (
-                    emby_api.get_valid()
-                    and not emby_api.get_library_valid(emby_server["library_name"])
-                ):
-                    self.log_warning(
-                        f"No {utils.get_formatted_emby()}({emby_server['server']}) "
-                        f"library found for {emby_server['library_name']}"
-                    )
-
+            # The server is checked when the job runs since it may not be reachable yet
+            if self.api_manager.get_emby_api(emby_server["server"]) is not None:
                 return MediaServerInfo(
                     emby_server["server"],
-                    emby_server["library_name"]
+                    emby_server["library_name"],
+                    emby_server.get("media_path", "")
                 )
             else:
                 self.log_warning(
@@ -134,35 +145,114 @@ class FolderCleanup(ServiceBase):
                 )
         return None
 
-    def __is_dir_empty(self, dirnames: List[str]) -> bool:
-        dir_empty = True
-        for dirname in dirnames:
-            if len(self.ignore_folder_in_empty_check) > 0:
-                for ignore_dir in self.ignore_folder_in_empty_check:
-                    if dirname != ignore_dir:
-                        dir_empty = False
-                        break
-            else:
-                dir_empty = False
+    def __is_ignored(
+        self,
+        name: str,
+        ignore_names: set[str],
+        ignore_patterns: list[re.Pattern]
+    ) -> bool:
+        if name in ignore_names:
+            return True
+        for ignore_pattern in ignore_patterns:
+            if ignore_pattern.match(name):
+                return True
+        return False
+
+    def __delete_folder(
+        self,
+        folder: str,
+        ignored_entries: list[FolderEntry],
+        deleted_folders: list[str]
+    ) -> bool:
+        """ Delete an empty folder and the ignored entries it still holds """
+        self.log_info(
+            f"Deleting empty "
+            f"{utils.get_tag("folder", utils.get_standout_text(folder))}"
+        )
+        try:
+            for entry in ignored_entries:
+                if entry.is_dir:
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            os.rmdir(folder)
+            deleted_folders.append(folder)
+            return True
+        except OSError as e:
+            self.log_error(
+                f"Failed to delete {utils.get_tag("folder", folder)} "
+                f"{utils.get_tag("error", e)}"
+            )
+        return False
+
+    def __get_folder_entries(self, folder: str) -> list[FolderEntry]:
+        """ Get the entries of a folder from the watch index or by scanning it """
+        if self.folder_watcher is not None and self.folder_watcher.get_valid():
+            entries = self.folder_watcher.get_entries(folder)
+            if entries is not None:
+                return entries
+
+        folder_entries: list[FolderEntry] = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                folder_entries.append(
+                    FolderEntry(
+                        entry.name,
+                        entry.path,
+                        entry.is_dir(follow_symlinks=False),
+                        0.0
+                    )
+                )
+        return folder_entries
 
-            if not dir_empty:
-                break
-        return dir_empty
-
-    def __is_files_empty(self, filenames: List[str]) -> bool:
-        filenames_empty: bool = True
-        for filename in filenames:
-            if len(self.ignore_file_in_empty_check) > 0:
-                for ignore_file in self.ignore_file_in_empty_check:
-                    if filename != ignore_file:
-                        filenames_empty = False
-                        break
-            else:
-                filenames_empty = False
+    def __delete_empty_folders(
+        self,
+        folder: str,
+        deleted_folders: list[str]
+    ) -> tuple[bool, list[FolderEntry]]:
+        """
+        Delete the empty folders below a folder in a single bottom up pass.
+        Returns if the folder is now empty and the ignored entries it holds
+        """
+        folder_empty: bool = True
+        ignored_entries: list[FolderEntry] = []
+        try:
+            for entry in self.__get_folder_entries(folder):
+                if entry.is_dir:
+                    if self.__is_ignored(
+                        entry.name,
+                        self.ignore_folder_names,
+                        self.ignore_folder_patterns
+                    ):
+                        ignored_entries.append(entry)
+                        continue
 
-            if not filenames_empty:
-                break
-        return filenames_empty
+                    child_empty, child_ignored_entries = self.__delete_empty_folders(
+                        entry.path, deleted_folders
+                    )
+                    if not (
+                        child_empty
+                        and self.__delete_folder(
+                            entry.path, child_ignored_entries, deleted_folders
+                        )
+                    ):
+                        folder_empty = False
+                elif self.__is_ignored(
+                    entry.name,
+                    self.ignore_file_names,
+                    self.ignore_file_patterns
+                ):
+                    ignored_entries.append(entry)
+                else:
+                    folder_empty = False
+        except OSError as e:
+            self.log_error(
+                f"Failed to check {utils.get_tag("folder", folder)} "
+                f"{utils.get_tag("error", e)}"
+            )
+            return False, []
+
+        return folder_empty, ignored_entries
 
     def __check_media_connections_valid(
         self,
@@ -178,6 +268,11 @@ class FolderCleanup(ServiceBase):
                 connections_valid = False
                 self.log_warning(plex_api.get_connection_error_log())
                 break
+            if not plex_api.get_library_valid(plex_server.library_name):
+                self.log_warning(
+                    f"No {utils.get_formatted_plex()}({plex_server.server_name}) "
+                    f"library found for {plex_server.library_name}"
+                )
 
         if connections_valid:
             for emby_server in emby_server_list:
@@ -187,45 +282,81 @@ class FolderCleanup(ServiceBase):
                     connections_valid = False
                     self.log_warning(emby_api.get_connection_error_log())
                     break
+                if not emby_api.get_library_valid(emby_server.library_name):
+                    self.log_warning(
+                        f"No {utils.get_formatted_emby()}({emby_server.server_name}) "
+                        f"library found for {emby_server.library_name}"
+                    )
 
         return connections_valid
 
+    def __get_server_paths(
+        self,
+        path: PathInfo,
+        media_server: MediaServerInfo,
+        deleted_folders: list[str]
+    ) -> list[str]:
+        """ Map deleted folders to the media server paths. Empty if a full scan is needed """
+        if not media_server.media_path:
+            return []
+
+        server_paths: list[str] = []
+        for deleted_folder in deleted_folders:
+            server_path = utils.get_mapped_path(
+                deleted_folder, path.path, media_server.media_path
+            )
+            if not server_path:
+                return []
+            server_paths.append(server_path)
+        return server_paths
+
     def __check_delete_empty_folders(self):
-        deleted_paths: list[PathInfo] = []
+        # Nothing can have become empty if the watched paths did not change
+        change_count: int = -1
+        if self.folder_watcher is not None and self.folder_watcher.get_valid():
+            change_count = self.folder_watcher.get_change_count()
+            if change_count == self.checked_change_count:
+                return
+
+        all_paths_checked: bool = True
+        deleted_paths: list[tuple[PathInfo, list[str]]] = []
         for path in self.paths:
             if self.__check_media_connections_valid(
                 path.plex_server_list,
                 path.emby_server_list
             ):
-                folders_deleted = False
-
-                keep_running: bool = True
-                while keep_running:
-                    keep_running = False
-                    for dirpath, dirnames, filenames in os.walk(path.path, topdown=False):
-                        if self.__is_dir_empty(dirnames) and self.__is_files_empty(filenames):
-                            self.log_info(
-                                f"Deleting empty "
-                                f"{utils.get_tag("folder", utils.get_standout_text(dirpath))}"
-                            )
-                            shutil.rmtree(dirpath, ignore_errors=True)
-                            keep_running = True
-                            folders_deleted = True
-
-                if folders_deleted:
-                    deleted_paths.append(path)
+                deleted_folders: list[str] = []
+                self.__delete_empty_folders(path.path, deleted_folders)
+
+                # Only the top folder of a deleted chain needs a refresh
+                deleted_folder_set = set(deleted_folders)
+                deleted_folders = [
+                    deleted_folder for deleted_folder in deleted_folders
+                    if os.path.dirname(deleted_folder) not in deleted_folder_set
+                ]
+
+                if len(deleted_folders) > 0:
+                    deleted_paths.append((path, deleted_folders))
             else:
+                all_paths_checked = False
                 self.log_warning(
                     f"Skipping {utils.get_tag("path", path.path)} due to invalid connections"
                 )
 
-        for deleted_path in deleted_paths:
+        if all_paths_checked:
+            self.checked_change_count = change_count
+
+        for deleted_path, deleted_folders in deleted_paths:
             target_name: str = ""
 
             for plex_server in deleted_path.plex_server_list:
-                plex_api = self.api_manager.get_plex_api(
-                    plex_server.server_name)
-                plex_api.set_library_scan(plex_server.library_name)
+                self.library_refresher.request_plex_refresh(
+                    plex_server.server_name,
+                    plex_server.library_name,
+                    self.__get_server_paths(
+                        deleted_path, plex_server, deleted_folders
+                    )
+                )
                 target_name = utils.build_target_string(
                     target_name,
                     f"{utils.get_formatted_plex()}({plex_server.server_name})",
@@ -235,7 +366,14 @@ class FolderCleanup(ServiceBase):
             for emby_server in deleted_path.emby_server_list:
                 emby_api = self.api_manager.get_emby_api(
                     emby_server.server_name)
-                emby_api.set_library_scan(emby_server.library_name)
+                self.library_refresher.request_emby_refresh(
+                    emby_server.server_name,
+                    emby_server.library_name,
+                    emby_api.get_library_id(emby_server.library_name),
+                    self.__get_server_paths(
+                        deleted_path, emby_server, deleted_folders
+                    )
+                )
                 target_name = utils.build_target_string(
                     target_name,
                     f"{utils.get_formatted_emby()}({emby_server.server_name})",
@@ -244,12 +382,16 @@ class FolderCleanup(ServiceBase):
 
             if target_name:
                 self.log_info(
-                    f"Notified {target_name} to refresh"
+                    f"Queued {target_name} to refresh"
                 )
 
     def init_scheduler_jobs(self):
         if self.cron is not None:
             self.log_service_enabled()
+            if self.folder_watcher is not None and self.folder_watcher.start(
+                [path.path for path in self.paths]
+            ):
+                self.log_info("Watching paths for changes")
             self.scheduler.add_job(
                 self.__check_delete_empty_folders,
                 trigger="cron",
@@ -258,3 +400,7 @@ class FolderCleanup(ServiceBase):
             )
         else:
             self.log_warning("Enabled but will not Run. Cron is not valid!")
+
+    def shutdown(self):
+        if self.folder_watcher is not None:
+            self.folder_watcher.stop()
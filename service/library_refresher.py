@@ -0,0 +1,193 @@
+"""
+Library Refresher
+    Collects library refresh requests from all services and sends them
+    to the media servers once no new requests arrived for a quiet window
+    or the first waiting request reached the maximum delay
+"""
+
+import threading
+import time
+from dataclasses import dataclass, field
+
+from api.api_manager import ApiManager
+from common import utils
+from common.log_manager import LogManager
+
+
+@dataclass
+class RefreshRequest:
+    """ Class representing the merged refresh requests of a media server library """
+    server_type: str
+    server_name: str
+    library_name: str
+    library_id: str
+    full_scan: bool = False
+    paths: dict[str, None] = field(default_factory=dict)
+    request_count: int = 0
+
+
+class LibraryRefresher:
+    """
+    Merges refresh requests per server and library. The requests are
+    flushed after quiet_window_seconds without a new request so services
+    running on the same cron only trigger one refresh. A steady stream of
+    requests is still flushed max_delay_seconds after the first one
+    """
+
+    PLEX: str = "plex"
+    EMBY: str = "emby"
+
+    def __init__(
+        self,
+        api_manager: ApiManager,
+        config: dict,
+        log_manager: LogManager
+    ):
+        self.api_manager = api_manager
+        self.log_manager = log_manager
+        self.log_header = utils.get_log_header(
+            utils.ANSI_CODE_SERVICE_LIBRARY_REFRESH, "Library Refresh"
+        )
+
+        self.quiet_window_seconds: float = 30.0
+        if "library_refresh_quiet_seconds" in config:
+            self.quiet_window_seconds = max(
+                0.0, float(config["library_refresh_quiet_seconds"])
+            )
+
+        self.max_delay_seconds: float = 300.0
+        if "library_refresh_max_delay_seconds" in config:
+            self.max_delay_seconds = max(
+                0.0, float(config["library_refresh_max_delay_seconds"])
+            )
+
+        self.pending_requests: dict[tuple[str, str, str], RefreshRequest] = {}
+        self.pending_lock = threading.Lock()
+        self.flush_timer: threading.Timer = None
+        self.first_request_time: float = None
+
+    def request_plex_refresh(
+        self,
+        server_name: str,
+        library_name: str,
+        paths: list[str]
+    ):
+        """ Request a refresh of a plex library. No paths requests a full scan """
+        self.__add_request(
+            self.PLEX, server_name, library_name, "", paths
+        )
+
+    def request_emby_refresh(
+        self,
+        server_name: str,
+        library_name: str,
+        library_id: str,
+        paths: list[str]
+    ):
+        """ Request a refresh of an emby library. No paths requests a full scan """
+        self.__add_request(
+            self.EMBY, server_name, library_name, library_id, paths
+        )
+
+    def __add_request(
+        self,
+        server_type: str,
+        server_name: str,
+        library_name: str,
+        library_id: str,
+        paths: list[str]
+    ):
+        key = (server_type, server_name, library_name)
+        with self.pending_lock:
+            current_time = time.monotonic()
+            if self.first_request_time is None:
+                self.first_request_time = current_time
+
+            if key not in self.pending_requests:
+                self.pending_requests[key] = RefreshRequest(
+                    server_type, server_name, library_name, library_id
+                )
+
+            refresh_request = self.pending_requests[key]
+            refresh_request.request_count += 1
+            if len(paths) == 0:
+                refresh_request.full_scan = True
+            for path in paths:
+                refresh_request.paths[path] = None
+
+            # Restart the quiet window on every new request but never wait
+            # longer than the maximum delay from the first waiting request
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            flush_seconds = min(
+                self.quiet_window_seconds,
+                max(
+                    0.0,
+                    self.first_request_time + self.max_delay_seconds - current_time
+                )
+            )
+            if flush_seconds > 0:
+                self.flush_timer = threading.Timer(flush_seconds, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+        if flush_seconds <= 0:
+            self.flush()
+
+    def __refresh_plex(self, refresh_request: RefreshRequest) -> str:
+        plex_api = self.api_manager.get_plex_api(refresh_request.server_name)
+        if (
+            refresh_request.full_scan
+            or not plex_api.set_library_scan_paths(
+                refresh_request.library_name,
+                list(refresh_request.paths)
+            )
+        ):
+            plex_api.set_library_scan(refresh_request.library_name)
+        return f"{utils.get_formatted_plex()}({refresh_request.server_name})"
+
+    def __refresh_emby(self, refresh_request: RefreshRequest) -> str:
+        emby_api = self.api_manager.get_emby_api(refresh_request.server_name)
+        if (
+            refresh_request.full_scan
+            or not emby_api.set_media_updated(list(refresh_request.paths))
+        ):
+            emby_api.set_library_scan(refresh_request.library_id)
+        return f"{utils.get_formatted_emby()}({refresh_request.server_name})"
+
+    def flush(self):
+        """ Send all pending refresh requests to the media servers """
+        with self.pending_lock:
+            refresh_requests = list(self.pending_requests.values())
+            self.pending_requests.clear()
+            self.first_request_time = None
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+        target_name: str = ""
+        request_count: int = 0
+        for refresh_request in refresh_requests:
+            if refresh_request.server_type == self.PLEX:
+                server_target_name = self.__refresh_plex(refresh_request)
+            else:
+                server_target_name = self.__refresh_emby(refresh_request)
+
+            target_name = utils.build_target_string(
+                target_name,
+                server_target_name,
+                refresh_request.library_name
+            )
+            request_count += refresh_request.request_count
+
+        if target_name:
+            self.log_manager.log_info(
+                f"{self.log_header} Refreshed {target_name} "
+                f"{utils.get_tag("requests", request_count)}"
+            )
+
+    def shutdown(self):
+        """ Send any refresh requests still waiting for the quiet window """
+        self.flush()
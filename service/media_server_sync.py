@@ -5,22 +5,28 @@ Synchronize watch and play state between media servers.
 Uses Plex with Tautulli and Emby with Jellystat
 """
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
 from dataclasses import dataclass, field
-from typing import List
+from typing import Any, Callable, Iterable, List
 from apscheduler.schedulers.blocking import BlockingScheduler
+from requests.exceptions import RequestException
 
+from common.checkpoint_store import CheckpointStore
 from common.log_manager import LogManager
 from common.types import UserInfo, UserEmbyInfo, UserPlexInfo
 from common import utils
 
 from service.service_base import ServiceBase
 
+from api.api_base import get_request_failure_count
 from api.api_manager import ApiManager
-from api.emby import EmbyAPI, EmbyItem, EmbyUserPlayState
+from api.emby import EmbyAPI, EmbyItem, EmbyPathIndexItem, EmbyUserPlayState
 from api.plex import PlexAPI
 from api.jellystat import JellystatAPI, JellystatHistoryItem, JellystatHistoryItems
-from api.tautulli import TautulliHistoryItem, TautulliHistoryItems
+from api.tautulli import TautulliHistoryItem
 
 
 @dataclass
@@ -67,6 +73,29 @@ class MediaServerSync(ServiceBase):
 
         self.config_user_list: list[ConfigUserInfo] = []
 
+        # Number of user groups synced concurrently and the cap of concurrent
+        # user group syncs reading from or writing to any single server
+        self.max_workers: int = 4
+        if "max_workers" in config:
+            self.max_workers = max(1, int(config["max_workers"]))
+        self.max_workers_per_server: int = 2
+        if "max_workers_per_server" in config:
+            self.max_workers_per_server = max(
+                1, int(config["max_workers_per_server"])
+            )
+        self.server_semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self.server_semaphores_lock = threading.Lock()
+
+        # Persistent last processed play per user so each run only syncs new plays
+        checkpoint_file: str = "/config/media_server_sync_checkpoint.json"
+        if "checkpoint_file" in config:
+            checkpoint_file = config["checkpoint_file"]
+        self.checkpoint_store = CheckpointStore(
+            checkpoint_file,
+            self.log_header,
+            self.log_manager
+        )
+
         for user in config["users"]:
             new_config_user = ConfigUserInfo()
 
@@ -190,10 +219,13 @@ class MediaServerSync(ServiceBase):
                             )
                         )
                     else:
+                        new_user_info.all_users_valid = False
                         self.log_warning(
                             f"No {utils.get_formatted_plex()}({config_plex_user.server_name}) "
                             f"user found for {config_plex_user.user_name} ... Skipping User"
                         )
+                else:
+                    new_user_info.all_users_valid = False
 
             for config_emby_user in config_user.emby_user_list:
                 emby_api = self.api_manager.get_emby_api(
@@ -217,16 +249,58 @@ class MediaServerSync(ServiceBase):
                             )
                         )
                     else:
+                        new_user_info.all_users_valid = False
                         self.log_warning(
                             f"No {utils.get_formatted_emby()}({config_emby_user.server_name}) "
                             f"user found for {config_emby_user.user_name} ... Skipping User"
                         )
+                else:
+                    new_user_info.all_users_valid = False
 
             if (len(new_user_info.plex_users) + len(new_user_info.emby_users)) > 1:
                 user_list.append(new_user_info)
 
         return user_list
 
+    def __get_checkpoint_key(
+        self,
+        server_type: str,
+        server_name: str,
+        user_id: str
+    ) -> str:
+        """ Get the checkpoint key of the last processed play for a user """
+        return f"{server_type}:{server_name}:{user_id}"
+
+    def __get_checkpoint_item(
+        self,
+        item_results: list[tuple[Any, bool]],
+        get_date: Callable[[Any], Any]
+    ) -> Any:
+        """
+        Get the newest synced play older than every play that failed to sync,
+        so failed plays stay after the checkpoint and are retried next run.
+        Returns None if there is no such play
+        """
+        failed_dates = [get_date(item) for item, synced in item_results if not synced]
+        first_failed_date = min(failed_dates) if len(failed_dates) > 0 else None
+        return max(
+            (
+                item for item, _ in item_results
+                if first_failed_date is None or get_date(item) < first_failed_date
+            ),
+            key=get_date,
+            default=None
+        )
+
+    def __log_failed_plays(self, user_name: str, item_results: list[tuple[Any, bool]]):
+        """ Log the number of plays that failed to sync and will be retried """
+        failed_count = sum(1 for _, synced in item_results if not synced)
+        if failed_count > 0:
+            self.log_warning(
+                f"{utils.get_tag("user", user_name)} "
+                f"{failed_count} plays failed to sync ... Retrying next run"
+            )
+
     def __set_emby_watch_state(
         self,
         emby_api: EmbyAPI,
@@ -281,6 +355,25 @@ class MediaServerSync(ServiceBase):
 
         return emby_api.get_invalid_item_id()
 
+    def __get_emby_index_item_from_plex_item(
+        self,
+        plex_api: PlexAPI,
+        emby_api: EmbyAPI,
+        tautulli_item: TautulliHistoryItem
+    ) -> EmbyPathIndexItem:
+        """ Get the Emby path index item from a plex item """
+        plex_path = plex_api.get_item_path(tautulli_item.id)
+        if plex_path is not plex_api.get_invalid_type() and plex_path:
+            emby_path = self.__get_emby_path_from_plex_path(
+                plex_api,
+                emby_api,
+                plex_path
+            )
+            if emby_api.get_item_id_from_path(emby_path) != emby_api.get_invalid_item_id():
+                return emby_api.get_path_index_item(emby_path)
+
+        return None
+
     def __sync_emby_user_with_plex_watch_state(
         self,
         plex_api: PlexAPI,
@@ -410,19 +503,18 @@ class MediaServerSync(ServiceBase):
             sync_emby_user.server_name
         )
 
-        sync_item_id = self.__get_emby_item_id_from_plex_item(
+        emby_item = self.__get_emby_index_item_from_plex_item(
             plex_api, sync_emby_api, tautulli_item
         )
 
-        # If the item id is valid and the user has not already watched the item
-        if sync_item_id != sync_emby_api.get_invalid_item_id():
+        # If the item is valid and the user has not already watched the item
+        if emby_item is not None:
+            sync_item_id = emby_item.id
             sync_user_play_state = sync_emby_api.get_user_play_state(
                 sync_emby_user.user_id, sync_item_id
             )
-            emby_item = sync_emby_api.search_item(sync_item_id)
             if (
                 sync_user_play_state is not None
-                and emby_item is not None
                 and emby_item.run_time_ticks is not None
                 and tautulli_item.playback_percentage is not None
                 and (tautulli_item.playback_percentage != round(
@@ -500,56 +592,54 @@ class MediaServerSync(ServiceBase):
 
     def __consolidate_plex_history(
         self,
-        history_items: TautulliHistoryItems
+        history_items: Iterable[TautulliHistoryItem]
     ) -> List[TautulliHistoryItem]:
-        return_history: list[TautulliHistoryItem] = []
-        compare_groups: list[list[TautulliHistoryItem]] = []
-        for item in history_items.items:
-            item_found: bool = False
-            for group in compare_groups:
-                for group_item in group:
-                    if group_item.id == item.id:
-                        group.append(item)
-                        item_found = True
-                        break
-            if not item_found:
-                new_group_list: list[TautulliHistoryItem] = []
-                new_group_list.append(item)
-                compare_groups.append(new_group_list)
-
-        for compare_group in compare_groups:
-            item_candidate: TautulliHistoryItem = None
-            for group_item in compare_group:
-                if item_candidate is None:
-                    item_candidate = group_item
-                elif group_item.date_watched > item_candidate.date_watched:
-                    item_candidate = group_item
-            if item_candidate is not None:
-                return_history.append(item_candidate)
-
-        return return_history
+        """ Reduce the plex history to the latest play of each item """
+        return utils.get_latest_per_key(
+            history_items,
+            lambda item: item.id,
+            lambda item: item.date_watched
+        )
 
     def __sync_plex_state(
         self,
         current_user: UserPlexInfo,
         user: UserInfo,
-        date_time_for_history: str
+        date_time_for_history: str,
+        group_checkpoints: dict[str, Any]
     ):
         """
-        For a specific plex user find watched items and sync corresponding emby users watch state
+        For a specific plex user find watched items and sync corresponding emby users watch state.
+        The new checkpoint is added to group_checkpoints
         """
         plex_api = self.api_manager.get_plex_api(current_user.server_name)
         tautulli_api = self.api_manager.get_tautulli_api(
             current_user.server_name)
 
-        watch_history_data = self.__consolidate_plex_history(
-            tautulli_api.get_watch_history_for_user(
-                current_user.user_id,
-                date_time_for_history
+        # Only request and process plays stopped after the last processed play
+        checkpoint_key = self.__get_checkpoint_key(
+            "plex", current_user.server_name, current_user.user_id
+        )
+        last_stopped: int = self.checkpoint_store.get(checkpoint_key)
+        if last_stopped is not None:
+            date_time_for_history = max(
+                date_time_for_history,
+                datetime.fromtimestamp(last_stopped).strftime("%Y-%m-%d")
             )
+
+        watch_history = tautulli_api.get_watch_history(
+            current_user.user_id,
+            date_time_for_history
+        )
+        watch_history_data = self.__consolidate_plex_history(
+            item for item in watch_history
+            if last_stopped is None or item.date_watched > last_stopped
         )
 
+        # A play failed to sync when any request for it failed
+        item_results: list[tuple[TautulliHistoryItem, bool]] = []
         for history_item in watch_history_data:
+            failure_count = get_request_failure_count()
             if history_item.watched is not None and history_item.watched:
                 self.__sync_plex_watch_state(
                     plex_api,
@@ -564,6 +654,20 @@ class MediaServerSync(ServiceBase):
                     history_item,
                     user
                 )
+            item_results.append(
+                (history_item, get_request_failure_count() == failure_count)
+            )
+
+        self.__log_failed_plays(current_user.friendly_name, item_results)
+
+        # Only move the checkpoint when every user in the group could be synced
+        # and the whole history was read
+        if user.all_users_valid and watch_history.complete:
+            checkpoint_item = self.__get_checkpoint_item(
+                item_results, lambda item: item.date_watched
+            )
+            if checkpoint_item is not None:
+                group_checkpoints[checkpoint_key] = checkpoint_item.date_watched
 
     def __set_plex_show_watched(
         self,
@@ -833,60 +937,67 @@ class MediaServerSync(ServiceBase):
         if history_items == js_api.get_invalid_type():
             return return_history
 
-        compare_groups: list[list[JellystatHistoryItem]] = []
-        for item in history_items.items:
-            hours_since_play = utils.get_hours_since_play(
-                True,
-                item.date_time
+        last_activity_date: str = self.checkpoint_store.get(
+            self.__get_checkpoint_key(
+                "emby", current_user.server_name, current_user.user_id
             )
+        )
+        last_activity_date_time: datetime = (
+            datetime.fromisoformat(last_activity_date)
+            if last_activity_date else
+            None
+        )
 
-            if hours_since_play >= 24:
-                continue
-
-            item_found: bool = False
-            for group in compare_groups:
-                for group_item in group:
-                    if group_item.id == item.id:
-                        group.append(item)
-                        item_found = True
-                        break
-            if not item_found:
-                new_group_list: list[JellystatHistoryItem] = []
-                new_group_list.append(item)
-                compare_groups.append(new_group_list)
-
-        for compare_group in compare_groups:
-            item_candidate: JellystatHistoryItem = None
-            for group_item in compare_group:
-                if item_candidate is None:
-                    item_candidate = group_item
-                elif (
-                    group_item.date_time
-                    >= item_candidate.date_time
-                ):
-                    item_candidate = group_item
-            if item_candidate is not None:
-                return_history.append(item_candidate)
+        # Reduce the history played in the last day and after the last processed
+        # play to the latest play of each item
+        return_history = utils.get_latest_per_key(
+            (
+                item for item in history_items.items
+                if utils.get_hours_since_play(True, item.date_time) < 24
+                and (last_activity_date_time is None or item.date_time > last_activity_date_time)
+            ),
+            lambda item: item.id,
+            lambda item: item.date_time,
+            True
+        )
 
         return return_history
 
-    def __sync_emby_state(self, current_user: UserEmbyInfo, user: UserInfo):
-        """ Sync the state of an Emby user to configured media servers """
+    def __sync_emby_state(
+        self,
+        current_user: UserEmbyInfo,
+        user: UserInfo,
+        group_checkpoints: dict[str, Any]
+    ):
+        """
+        Sync the state of an Emby user to configured media servers.
+        The new checkpoint is added to group_checkpoints
+        """
         emby_api = self.api_manager.get_emby_api(current_user.server_name)
 
         history_items = self.__get_emby_history_for_user(
             current_user
         )
 
-        for item in history_items:
-            current_play_state: EmbyUserPlayState = emby_api.get_user_play_state(
-                current_user.user_id,
-                item.episode_id if item.series_name else item.id
-            )
+        # Resolve the play state of the whole history in batched requests
+        failure_count = get_request_failure_count()
+        play_states: dict[str, EmbyUserPlayState] = emby_api.get_user_play_states(
+            current_user.user_id,
+            [item.episode_id if item.series_name else item.id for item in history_items]
+        )
+        play_states_complete: bool = get_request_failure_count() == failure_count
 
-            if current_play_state is None:
+        # A play failed to sync when any request for it failed
+        item_results: list[tuple[JellystatHistoryItem, bool]] = []
+        for item in history_items:
+            item_id = item.episode_id if item.series_name else item.id
+            if item_id not in play_states:
+                item_results.append((item, play_states_complete))
                 continue
 
+            failure_count = get_request_failure_count()
+            current_play_state: EmbyUserPlayState = play_states[item_id]
+
             # Determine if we need to sync watch state or play state
             if current_play_state.state.played:
                 self.__sync_emby_watched_state(
@@ -903,21 +1014,110 @@ class MediaServerSync(ServiceBase):
                     item,
                     user.emby_users
                 )
+            item_results.append(
+                (item, get_request_failure_count() == failure_count)
+            )
+
+        self.__log_failed_plays(current_user.user_name, item_results)
+
+        # Only move the checkpoint when every user in the group could be synced
+        if user.all_users_valid:
+            checkpoint_item = self.__get_checkpoint_item(
+                item_results, lambda item: item.date_time
+            )
+            if checkpoint_item is not None:
+                group_checkpoints[
+                    self.__get_checkpoint_key(
+                        "emby", current_user.server_name, current_user.user_id
+                    )
+                ] = checkpoint_item.date_watched
+
+    def __get_server_semaphore(self, server_type: str, server_name: str) -> threading.BoundedSemaphore:
+        """ Get the semaphore capping concurrent user syncs for a server """
+        with self.server_semaphores_lock:
+            key = f"{server_type}:{server_name}"
+            if key not in self.server_semaphores:
+                self.server_semaphores[key] = threading.BoundedSemaphore(
+                    self.max_workers_per_server
+                )
+            return self.server_semaphores[key]
+
+    def __sync_user_group(self, user: UserInfo, date_time_for_history: str) -> dict[str, Any]:
+        """
+        Sync every user in a group keeping the groups log output together.
+        Returns the new checkpoints of the group or None if the group failed
+        """
+        if self.max_workers > 1:
+            self.start_log_buffer()
+
+        group_checkpoints: dict[str, Any] = {}
+
+        try:
+            # Every user of the group reads from or writes to all the servers of
+            # the group so hold each of their semaphores. Acquiring them in a
+            # fixed order keeps groups sharing servers from deadlocking
+            with ExitStack() as server_stack:
+                for server_type, server_name in sorted(
+                    {("plex", plex_user.server_name) for plex_user in user.plex_users}
+                    | {("emby", emby_user.server_name) for emby_user in user.emby_users}
+                ):
+                    server_stack.enter_context(
+                        self.__get_server_semaphore(server_type, server_name)
+                    )
+
+                for plex_user in user.plex_users:
+                    self.__sync_plex_state(
+                        plex_user,
+                        user,
+                        date_time_for_history,
+                        group_checkpoints
+                    )
+
+                for emby_user in user.emby_users:
+                    self.__sync_emby_state(emby_user, user, group_checkpoints)
+        except (RequestException, KeyError, ValueError) as e:
+            self.log_error(f"Sync user group failed {utils.get_tag("error", e)}")
+            return None
+        finally:
+            self.flush_log_buffer()
+
+        return group_checkpoints
 
     def __sync_state(self):
         """ Sync all the configured states """
         date_time_for_history = utils.get_datetime_for_history_plex_string(1)
         user_list = self.__get_user_data()
-        for user in user_list:
-            for plex_user in user.plex_users:
-                self.__sync_plex_state(
-                    plex_user,
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="media_server_sync"
+        ) as executor:
+            futures = [
+                executor.submit(
+                    self.__sync_user_group,
                     user,
                     date_time_for_history
                 )
+                for user in user_list
+            ]
+
+        # Only the checkpoints of groups that synced without an error are kept
+        group_error: Exception = None
+        for future in futures:
+            if future.exception() is not None:
+                group_error = group_error or future.exception()
+                continue
+
+            group_checkpoints = future.result()
+            if group_checkpoints is not None:
+                for checkpoint_key, checkpoint_value in group_checkpoints.items():
+                    self.checkpoint_store.set(checkpoint_key, checkpoint_value)
+
+        self.checkpoint_store.save()
 
-            for emby_user in user.emby_users:
-                self.__sync_emby_state(emby_user, user)
+        # Raise an unexpected failure so the scheduler logs it with its traceback
+        if group_error is not None:
+            raise group_error
 
     def init_scheduler_jobs(self):
         """ Initialize all scheduled jobs """
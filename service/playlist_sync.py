@@ -3,14 +3,18 @@ Playlist Sync Service
     Synchronize plex collections to emby playlists
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from datetime import datetime
+import hashlib
 import time
+from typing import Callable
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 from api.api_manager import ApiManager
 from api.plex import PlexAPI, PlexCollection
-from api.emby import EmbyAPI, EmbyPlaylist
+from api.emby import EmbyAPI, EmbyChunkResult, EmbyPlaylist, EmbyPlaylistItem
 from common import utils
 from common.log_manager import LogManager
 from service.service_base import ServiceBase
@@ -25,6 +29,22 @@ class PlexCollectionConfig:
     target_emby_servers: list[str] = field(default_factory=list)
 
 
+@dataclass
+class EmbyPlaylistSyncState:
+    """ Class representing the playlist items last synced to an emby server """
+    playlist_id: str
+    item_ids: list[str]
+
+
+@dataclass
+class CollectionSyncState:
+    """ Class representing the last synced state of a plex collection """
+    updated_at: datetime
+    content_hash: str
+    expire_time: float
+    synced_emby_playlists: dict[str, EmbyPlaylistSyncState] = field(default_factory=dict)
+
+
 @dataclass
 class AddDeleteInfo:
     """ Class representing the number of items added and deleted """
@@ -53,16 +73,28 @@ class PlaylistSync(ServiceBase):
 
         self.plex_collection_configs: list[PlexCollectionConfig] = []
 
+        # Upper bound on waiting for emby to show a playlist change
         self.time_for_emby_to_update_seconds: float = 5.0
         if "time_for_emby_to_update_seconds" in config:
             self.time_for_emby_to_update_seconds = float(
                 config["time_for_emby_to_update_seconds"]
             )
 
-        self.time_between_syncs_seconds: float = 1.0
-        if "time_between_syncs_seconds" in config:
-            self.time_between_syncs_seconds = float(
-                config["time_between_syncs_seconds"]
+        # First poll interval, doubled after every poll up to the max
+        self.playlist_poll_seconds: float = 0.25
+        if "playlist_poll_seconds" in config:
+            self.playlist_poll_seconds = max(
+                0.01, float(config["playlist_poll_seconds"])
+            )
+        self.playlist_poll_max_seconds: float = 2.0
+
+        # Collections unchanged since they were synced to an emby server are skipped
+        # until the sync state expires, which picks up smart collection changes
+        self.collection_sync_states: dict[str, CollectionSyncState] = {}
+        self.sync_state_expire_hours: float = 6.0
+        if "sync_state_expire_hours" in config:
+            self.sync_state_expire_hours = max(
+                0.0, float(config["sync_state_expire_hours"])
             )
 
         try:
@@ -74,8 +106,8 @@ class PlaylistSync(ServiceBase):
                     and "target_emby_servers" in plex_collection
                 ):
                     server_name = plex_collection["server"]
-                    plex_api = self.api_manager.get_plex_api(server_name)
-                    if plex_api is not None:
+                    # The servers are checked when the job runs since they may not be reachable yet
+                    if self.api_manager.get_plex_api(server_name) is not None:
                         library_name = plex_collection["library"]
                         collection_name = plex_collection["collection_name"]
                         target_emby_servers: list[str] = []
@@ -90,18 +122,6 @@ class PlaylistSync(ServiceBase):
                             and collection_name != ""
                             and len(target_emby_servers) > 0
                         ):
-                            if (
-                                plex_api.get_valid()
-                                and not plex_api.get_collection_valid(library_name, collection_name)
-                            ):
-                                library_tag = utils.get_tag(
-                                    "library", library_name)
-                                collection_tag = utils.get_tag(
-                                    "collection", collection_name)
-                                self.log_warning(
-                                    f"{utils.get_formatted_plex()}({server_name}) {library_tag} {collection_tag} not found on server"
-                                )
-
                             self.plex_collection_configs.append(
                                 PlexCollectionConfig(
                                     server_name, library_name, collection_name, target_emby_servers
@@ -115,6 +135,13 @@ class PlaylistSync(ServiceBase):
         except Exception as e:
             self.log_error(f"Read config {utils.get_tag("error", e)}")
 
+    def __get_failed_ids(self, chunk_results: list[EmbyChunkResult]) -> list[str]:
+        return [
+            failed_id
+            for chunk_result in chunk_results if not chunk_result.success
+            for failed_id in chunk_result.ids
+        ]
+
     def __emby_add_remove_items_to_playlist(
         self,
         emby_api: EmbyAPI,
@@ -122,68 +149,164 @@ class PlaylistSync(ServiceBase):
         emby_playlist: EmbyPlaylist
     ) -> AddDeleteInfo:
         # Check if any items were added to the playlist
-        added_items: list[str] = []
-        for emby_item_id in emby_item_ids:
-            item_id_found = False
-            for item in emby_playlist.items:
-                if emby_item_id == item.id:
-                    item_id_found = True
-                    break
-            if not item_id_found:
-                added_items.append(emby_item_id)
+        playlist_item_ids: set[str] = {item.id for item in emby_playlist.items}
+        added_items: list[str] = [
+            emby_item_id for emby_item_id in emby_item_ids
+            if emby_item_id not in playlist_item_ids
+        ]
 
         # Check if any items were deleted out of the playlist
-        deleted_playlist_items: list[str] = []
-        for item in emby_playlist.items:
-            if item.id not in emby_item_ids:
-                deleted_playlist_items.append(item.playlist_item_id)
+        emby_item_id_set: set[str] = set(emby_item_ids)
+        deleted_playlist_items: list[str] = [
+            item.playlist_item_id for item in emby_playlist.items
+            if item.id not in emby_item_id_set
+        ]
 
         if len(added_items) > 0 or len(deleted_playlist_items) > 0:
             if len(added_items) > 0:
-                if not emby_api.add_playlist_items(emby_playlist.id, added_items):
+                failed_items = self.__get_failed_ids(
+                    emby_api.add_playlist_items(emby_playlist.id, added_items)
+                )
+                if len(failed_items) > 0:
                     playlist_tag = utils.get_tag(
                         "playlist", emby_playlist.name)
-                    items_tag = utils.get_tag("items", added_items)
+                    items_tag = utils.get_tag("items", failed_items)
                     self.log_warning(
                         f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) failed {playlist_tag} adding {items_tag}"
                     )
 
             if len(deleted_playlist_items) > 0:
-                if not emby_api.remove_playlist_items(
-                    emby_playlist.id,
-                    deleted_playlist_items
-                ):
+                failed_items = self.__get_failed_ids(
+                    emby_api.remove_playlist_items(
+                        emby_playlist.id,
+                        deleted_playlist_items
+                    )
+                )
+                if len(failed_items) > 0:
                     playlist_tag = utils.get_tag(
                         "playlist", emby_playlist.name)
-                    items_tag = utils.get_tag("items", deleted_playlist_items)
+                    items_tag = utils.get_tag("items", failed_items)
                     self.log_warning(
                         f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) failed {playlist_tag} removing {items_tag}"
                     )
 
-            # Give Emby time to update the playlist
-            time.sleep(self.time_for_emby_to_update_seconds)
-
             return AddDeleteInfo(len(added_items), len(deleted_playlist_items))
         return AddDeleteInfo(0, 0)
 
+    def __wait_for_playlist(
+        self,
+        emby_api: EmbyAPI,
+        playlist_id: str,
+        playlist_ready: Callable[[EmbyPlaylist], bool]
+    ) -> EmbyPlaylist:
+        """
+        Poll the playlist with exponential backoff until playlist_ready is
+        True or time_for_emby_to_update_seconds passed. Returns the last
+        playlist received
+        """
+        end_time = time.monotonic() + self.time_for_emby_to_update_seconds
+        poll_seconds = self.playlist_poll_seconds
+        while True:
+            emby_playlist: EmbyPlaylist = emby_api.get_playlist_items(
+                playlist_id)
+            if emby_playlist is not None and playlist_ready(emby_playlist):
+                return emby_playlist
+
+            remaining_seconds = end_time - time.monotonic()
+            if remaining_seconds <= 0:
+                return emby_playlist
+
+            time.sleep(min(poll_seconds, remaining_seconds))
+            poll_seconds = min(poll_seconds * 2, self.playlist_poll_max_seconds)
+
+    def __emby_reorder_playlist(
+        self,
+        emby_api: EmbyAPI,
+        emby_item_ids: list[str],
+        emby_playlist: EmbyPlaylist,
+        playlist_name: str
+    ):
+        """
+        Reorder the playlist to match emby_item_ids with the fewest moves.
+        Items on the longest increasing subsequence of current positions
+        are already in order relative to each other so only the rest move
+        """
+        current_positions: dict[str, list[int]] = {}
+        for position, item in enumerate(emby_playlist.items):
+            current_positions.setdefault(item.id, []).append(position)
+
+        target_positions: list[int] = []
+        for item_id in emby_item_ids:
+            if item_id not in current_positions or len(current_positions[item_id]) == 0:
+                self.log_warning(
+                    f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) "
+                    f"{utils.get_tag("playlist", playlist_name)} "
+                    f"{utils.get_tag("item", item_id)} not in playlist ... Skipping reorder"
+                )
+                return
+            target_positions.append(current_positions[item_id].pop(0))
+        keep_indexes: set[int] = set(
+            utils.get_longest_increasing_subsequence(target_positions)
+        )
+
+        # Simulate the playlist to know the index each moved item must go to
+        current_items: list[EmbyPlaylistItem] = list(emby_playlist.items)
+        previous_item: EmbyPlaylistItem = None
+        for target_index, position in enumerate(target_positions):
+            playlist_item = emby_playlist.items[position]
+            if target_index not in keep_indexes:
+                current_items.remove(playlist_item)
+                move_index = (
+                    current_items.index(previous_item) + 1
+                    if previous_item is not None else
+                    0
+                )
+                current_items.insert(move_index, playlist_item)
+
+                if not emby_api.set_move_playlist_item_to_index(
+                    emby_playlist.id,
+                    playlist_item.playlist_item_id,
+                    move_index
+                ):
+                    playlist_tag = utils.get_tag("playlist", playlist_name)
+                    item_tag = utils.get_tag(
+                        "item", playlist_item.playlist_item_id)
+                    index_tag = utils.get_tag("index", move_index)
+                    self.log_warning(
+                        f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) failed {playlist_tag} moving {item_tag} to {index_tag}"
+                    )
+            previous_item = playlist_item
+
     def __emby_update_playlist(
         self,
         emby_api: EmbyAPI,
         plex_api: PlexAPI,
         emby_item_ids: list[str],
         original_emby_playlist: EmbyPlaylist
-    ):
+    ) -> bool:
+        """ Update the playlist to match the items. Returns True if emby shows the playlist in sync """
+        playlist_in_sync: bool = False
         add_delete_info = self.__emby_add_remove_items_to_playlist(
             emby_api, emby_item_ids, original_emby_playlist
         )
 
-        # Get the latest playlist
-        edited_emby_playlist: EmbyPlaylist = emby_api.get_playlist_items(
-            original_emby_playlist.id)
+        # Wait for emby to show the added and deleted items
+        edited_emby_playlist: EmbyPlaylist = original_emby_playlist
+        if add_delete_info.added_items > 0 or add_delete_info.deleted_items > 0:
+            emby_item_id_set: set[str] = set(emby_item_ids)
+            edited_emby_playlist = self.__wait_for_playlist(
+                emby_api,
+                original_emby_playlist.id,
+                lambda playlist: (
+                    len(playlist.items) == len(emby_item_ids)
+                    and {item.id for item in playlist.items} == emby_item_id_set
+                )
+            )
 
         if edited_emby_playlist is not None:
             # Should be the correct length before this call but make sure
             if len(edited_emby_playlist.items) == len(emby_item_ids):
+                playlist_in_sync = True
                 playlist_changed = False
                 playlist_index = 0
                 for item_id in emby_item_ids:
@@ -193,29 +316,29 @@ class PlaylistSync(ServiceBase):
                     playlist_index += 1
 
                 if playlist_changed:
-                    # The order changed now iterate through the correct item order and find the playlist id to use in moving items
-                    current_index = 0
-                    for correct_item_id in emby_item_ids:
-                        for current_playlist_item in edited_emby_playlist.items:
-                            if correct_item_id == current_playlist_item.id:
-                                if emby_api.set_move_playlist_item_to_index(
-                                    edited_emby_playlist.id,
-                                    current_playlist_item.playlist_item_id,
-                                    current_index
-                                ):
-                                    time.sleep(self.time_between_syncs_seconds)
-                                else:
-                                    playlist_tag = utils.get_tag(
-                                        "playlist", original_emby_playlist.name)
-                                    item_tag = utils.get_tag(
-                                        "item", current_playlist_item.playlist_item_id)
-                                    index_tag = utils.get_tag(
-                                        "index", current_index)
-                                    self.log_warning(
-                                        f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) failed {playlist_tag} moving {item_tag} to {index_tag}"
-                                    )
-                                current_index += 1
-                                break
+                    self.__emby_reorder_playlist(
+                        emby_api,
+                        emby_item_ids,
+                        edited_emby_playlist,
+                        original_emby_playlist.name
+                    )
+
+                    # Wait for emby to show the new order before the next sync
+                    reordered_emby_playlist = self.__wait_for_playlist(
+                        emby_api,
+                        original_emby_playlist.id,
+                        lambda playlist: [item.id for item in playlist.items] == emby_item_ids
+                    )
+                    if (
+                        reordered_emby_playlist is None
+                        or [item.id for item in reordered_emby_playlist.items] != emby_item_ids
+                    ):
+                        playlist_in_sync = False
+                        playlist_tag = utils.get_tag(
+                            "playlist", original_emby_playlist.name)
+                        self.log_warning(
+                            f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) {playlist_tag} new order not confirmed within {utils.get_tag("seconds", self.time_for_emby_to_update_seconds)}"
+                        )
 
                     if playlist_changed or add_delete_info.added_items > 0 or add_delete_info.deleted_items > 0:
                         collection_tag = utils.get_tag(
@@ -246,18 +369,23 @@ class PlaylistSync(ServiceBase):
                     f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) sync {utils.get_formatted_plex()}({plex_api.get_server_name()}) {collection_tag} playlist update failed. Playlist length should be {length_tag} {reported_length_tag}!"
                 )
 
+        return playlist_in_sync
+
     def __sync_emby_playlist_with_plex_collection(
         self,
         emby_api: EmbyAPI,
         plex_api: PlexAPI,
         plex_collection: PlexCollection
-    ):
+    ) -> EmbyPlaylistSyncState:
+        """ Sync the playlist. Returns the synced state if every item was found and the playlist is in sync """
+        all_items_found: bool = True
         emby_item_ids: list[str] = []
         for plex_item in plex_collection.items:
             emby_item_id = emby_api.get_item_id_from_path(plex_item.path)
             if emby_item_id != emby_api.get_invalid_item_id():
                 emby_item_ids.append(emby_item_id)
             else:
+                all_items_found = False
                 collection_tag = utils.get_tag(
                     "collection", plex_collection.name)
                 item_tag = utils.get_tag("item", plex_item.title)
@@ -267,54 +395,196 @@ class PlaylistSync(ServiceBase):
 
         emby_playlist_id = emby_api.get_playlist_id(plex_collection.name)
         if emby_playlist_id == emby_api.get_invalid_item_id():
-            emby_api.create_playlist(plex_collection.name, emby_item_ids)
+            created_playlist_id = emby_api.create_playlist(
+                plex_collection.name, emby_item_ids)
 
             collection_tag = utils.get_tag("collection", plex_collection.name)
             self.log_info(
                 f"Creating {utils.get_formatted_plex()}({plex_api.get_server_name()}) {collection_tag} on {utils.get_formatted_emby()}({emby_api.get_server_name()})"
             )
-        else:
-            emby_playlist: EmbyPlaylist = emby_api.get_playlist_items(
-                emby_playlist_id)
-            if emby_playlist is not None:
+            if created_playlist_id == emby_api.get_invalid_item_id():
+                return None
+
+            return self.__get_playlist_sync_state(
+                all_items_found, created_playlist_id, emby_item_ids
+            )
+
+        emby_playlist: EmbyPlaylist = emby_api.get_playlist_items(
+            emby_playlist_id)
+        if emby_playlist is not None:
+            return self.__get_playlist_sync_state(
                 self.__emby_update_playlist(
-                    emby_api, plex_api, emby_item_ids, emby_playlist)
+                    emby_api, plex_api, emby_item_ids, emby_playlist
+                ) and all_items_found,
+                emby_playlist_id,
+                emby_item_ids
+            )
+        return None
+
+    def __get_playlist_sync_state(
+        self,
+        synced: bool,
+        playlist_id: str,
+        emby_item_ids: list[str]
+    ) -> EmbyPlaylistSyncState:
+        """ Get the state of a synced playlist. Returns None if the playlist is not in sync """
+        return EmbyPlaylistSyncState(playlist_id, emby_item_ids) if synced else None
+
+    def __get_emby_playlist_in_sync(
+        self,
+        emby_api: EmbyAPI,
+        sync_state: CollectionSyncState
+    ) -> bool:
+        """
+        Get if the emby playlist still has the items it was synced with. A
+        deleted or edited playlist or items given new ids by a rescan need a sync
+        """
+        server_name = emby_api.get_server_name()
+        if server_name not in sync_state.synced_emby_playlists:
+            return False
+
+        playlist_state = sync_state.synced_emby_playlists[server_name]
+        emby_playlist: EmbyPlaylist = emby_api.get_playlist_items(
+            playlist_state.playlist_id
+        )
+        return (
+            emby_playlist is not None
+            and [item.id for item in emby_playlist.items] == playlist_state.item_ids
+        )
 
-                # Give emby time to process
-                time.sleep(self.time_between_syncs_seconds)
+    def __sync_emby_target(
+        self,
+        emby_api: EmbyAPI,
+        plex_api: PlexAPI,
+        plex_collection: PlexCollection
+    ) -> EmbyPlaylistSyncState:
+        """ Sync one emby server from the collection keeping its log output together """
+        self.start_log_buffer()
+        try:
+            return self.__sync_emby_playlist_with_plex_collection(
+                emby_api, plex_api, plex_collection)
+        except Exception as e:
+            self.log_error(
+                f"{utils.get_formatted_emby()}({emby_api.get_server_name()}) sync failed {utils.get_tag("error", e)}"
+            )
+        finally:
+            self.flush_log_buffer()
+        return None
+
+    def __get_collection_hash(self, plex_collection: PlexCollection) -> str:
+        """ Hash the ordered item paths of a collection """
+        collection_hash = hashlib.sha256()
+        for item in plex_collection.items:
+            collection_hash.update(item.path.encode("utf-8"))
+            collection_hash.update(b"\0")
+        return collection_hash.hexdigest()
 
     def __sync_plex_collection(
         self,
         plex_api: PlexAPI,
-        emby_api: EmbyAPI,
-        plex_library_name: str,
-        plex_collection_name: str
+        emby_apis: list[EmbyAPI],
+        plex_collection_config: PlexCollectionConfig
     ):
+        state_key = (
+            f"{plex_collection_config.server_name}:"
+            f"{plex_collection_config.library_name}:"
+            f"{plex_collection_config.collection_name}"
+        )
+        sync_state = self.collection_sync_states.get(state_key)
+        if sync_state is not None and time.time() >= sync_state.expire_time:
+            sync_state = None
+            self.collection_sync_states.pop(state_key, None)
+
+        # Playlists changed on emby since they were synced are synced again
+        if sync_state is not None:
+            for emby_api in emby_apis:
+                if not self.__get_emby_playlist_in_sync(emby_api, sync_state):
+                    sync_state.synced_emby_playlists.pop(
+                        emby_api.get_server_name(), None
+                    )
+
+        # Skip fetching the items if the collection was not updated since every target synced
+        updated_at = plex_api.get_collection_updated_at(
+            plex_collection_config.library_name,
+            plex_collection_config.collection_name
+        )
+        if (
+            sync_state is not None
+            and updated_at is not None
+            and updated_at == sync_state.updated_at
+            and all(emby_api.get_server_name() in sync_state.synced_emby_playlists for emby_api in emby_apis)
+        ):
+            return
+
         collection: PlexCollection = plex_api.get_collection(
-            plex_library_name,
-            plex_collection_name
+            plex_collection_config.library_name,
+            plex_collection_config.collection_name
         )
+        if collection == plex_api.get_invalid_type():
+            library_tag = utils.get_tag(
+                "library", plex_collection_config.library_name)
+            collection_tag = utils.get_tag(
+                "collection", plex_collection_config.collection_name)
+            self.log_warning(
+                f"{utils.get_formatted_plex()}({plex_collection_config.server_name}) {library_tag} {collection_tag} not found on server"
+            )
+            return
+
+        content_hash = self.__get_collection_hash(collection)
+        if sync_state is None or sync_state.content_hash != content_hash:
+            sync_state = CollectionSyncState(
+                collection.updated_at,
+                content_hash,
+                time.time() + (self.sync_state_expire_hours * 3600)
+            )
+            self.collection_sync_states[state_key] = sync_state
+        else:
+            sync_state.updated_at = collection.updated_at
+
+        target_emby_apis: list[EmbyAPI] = [
+            emby_api for emby_api in emby_apis
+            if emby_api.get_server_name() not in sync_state.synced_emby_playlists
+        ]
+        if len(target_emby_apis) == 0:
+            return
+
+        # Fan the single collection snapshot out to every emby server
+        with ThreadPoolExecutor(
+            max_workers=len(target_emby_apis),
+            thread_name_prefix="playlist_sync"
+        ) as executor:
+            results = list(
+                executor.map(
+                    lambda emby_api: self.__sync_emby_target(
+                        emby_api, plex_api, collection
+                    ),
+                    target_emby_apis
+                )
+            )
 
-        if collection != plex_api.get_invalid_type():
-            self.__sync_emby_playlist_with_plex_collection(
-                emby_api, plex_api, collection)
+        for emby_api, playlist_state in zip(target_emby_apis, results):
+            if playlist_state is not None:
+                sync_state.synced_emby_playlists[emby_api.get_server_name()] = playlist_state
 
     def __sync_playlists(self):
         for plex_collection_config in self.plex_collection_configs:
             plex_api = self.api_manager.get_plex_api(
                 plex_collection_config.server_name)
             if plex_api.get_valid():
+                emby_apis: list[EmbyAPI] = []
                 for emby_server_name in plex_collection_config.target_emby_servers:
                     emby_api = self.api_manager.get_emby_api(emby_server_name)
                     if emby_api.get_valid():
-                        self.__sync_plex_collection(
-                            plex_api,
-                            emby_api,
-                            plex_collection_config.library_name,
-                            plex_collection_config.collection_name
-                        )
+                        emby_apis.append(emby_api)
                     else:
                         self.log_warning(emby_api.get_connection_error_log())
+
+                if len(emby_apis) > 0:
+                    self.__sync_plex_collection(
+                        plex_api,
+                        emby_apis,
+                        plex_collection_config
+                    )
             else:
                 self.log_warning(plex_api.get_connection_error_log())
 
@@ -1,5 +1,6 @@
 """ Service Base class for all services"""
 
+import threading
 from typing import Optional
 from apscheduler.schedulers.blocking import BlockingScheduler
 
@@ -28,6 +29,10 @@ class ServiceBase:
         self.cron: Optional[CronInfo] = None
         self.log_header = utils.get_log_header(ansi_code, service_name)
 
+        # Per thread buffer used to keep log output of concurrent work together
+        self.log_buffer = threading.local()
+        self.log_buffer_lock = threading.Lock()
+
         if "cron_run_rate" in config:
             self.cron = utils.get_cron_from_string(config["cron_run_rate"])
             if self.cron is None:
@@ -37,15 +42,39 @@ class ServiceBase:
 
     def log_info(self, message: str):
         """ Log an info message """
-        self.log_manager.log_info(f"{self.log_header} {message}")
+        if not self.__add_to_log_buffer(self.log_manager.log_info, message):
+            self.log_manager.log_info(f"{self.log_header} {message}")
 
     def log_warning(self, message: str):
         """ Log a warning message """
-        self.log_manager.log_warning(f"{self.log_header} {message}")
+        if not self.__add_to_log_buffer(self.log_manager.log_warning, message):
+            self.log_manager.log_warning(f"{self.log_header} {message}")
 
     def log_error(self, message: str):
         """ Log an error message """
-        self.log_manager.log_error(f"{self.log_header} {message}")
+        if not self.__add_to_log_buffer(self.log_manager.log_error, message):
+            self.log_manager.log_error(f"{self.log_header} {message}")
+
+    def __add_to_log_buffer(self, log_function, message: str) -> bool:
+        """ Add a message to this threads log buffer. Returns False if not buffering """
+        messages = getattr(self.log_buffer, "messages", None)
+        if messages is None:
+            return False
+        messages.append((log_function, f"{self.log_header} {message}"))
+        return True
+
+    def start_log_buffer(self):
+        """ Buffer this threads log messages until flush_log_buffer is called """
+        self.log_buffer.messages = []
+
+    def flush_log_buffer(self):
+        """ Log all buffered messages of this thread together and stop buffering """
+        messages = getattr(self.log_buffer, "messages", None)
+        self.log_buffer.messages = None
+        if messages:
+            with self.log_buffer_lock:
+                for log_function, message in messages:
+                    log_function(message)
 
     def log_service_enabled(self):
         """ Log that the service is enabled """
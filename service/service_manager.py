@@ -6,6 +6,7 @@ from api.api_manager import ApiManager
 from common.log_manager import LogManager
 
 from service.service_base import ServiceBase
+from service.library_refresher import LibraryRefresher
 from service.delete_watched import DeleteWatched
 from service.dvr_maintainer import DvrMaintainer
 from service.folder_cleanup import FolderCleanup
@@ -33,6 +34,13 @@ class ServiceManager:
         self.log_manager = log_manager
         self.scheduler = scheduler
 
+        # Shared by the services that delete media to merge library refreshes
+        self.library_refresher = LibraryRefresher(
+            api_manager,
+            config,
+            self.log_manager
+        )
+
         # Create the Media Server Sync Service
         if (
             "media_server_sync" in config
@@ -58,7 +66,8 @@ class ServiceManager:
                     api_manager,
                     config["delete_watched"],
                     self.log_manager,
-                    scheduler
+                    scheduler,
+                    self.library_refresher
                 )
             )
 
@@ -72,7 +81,8 @@ class ServiceManager:
                     api_manager,
                     config["dvr_maintainer"],
                     self.log_manager,
-                    scheduler
+                    scheduler,
+                    self.library_refresher
                 )
             )
 
@@ -86,7 +96,8 @@ class ServiceManager:
                     api_manager,
                     config["folder_cleanup"],
                     self.log_manager,
-                    scheduler
+                    scheduler,
+                    self.library_refresher
                 )
             )
 
@@ -113,3 +124,4 @@ class ServiceManager:
         """ Shutdown the services. """
         for service_base in self.services:
             service_base.shutdown()
+        self.library_refresher.shutdown()
@@ -0,0 +1,97 @@
+"""
+Latest Per Key Benchmark
+
+Times utils.get_latest_per_key against the nested group scan it replaced in
+MediaServerSync for growing history sizes. Run from the repository root:
+
+    python tools/bench_latest_per_key.py
+"""
+
+import os
+import random
+import sys
+import timeit
+from dataclasses import dataclass
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import utils  # noqa: E402
+
+
+@dataclass
+class HistoryItem:
+    """ Class representing a history row with the fields the reducers read """
+    id: int
+    date_watched: int
+
+
+def get_history(rows: int) -> list[HistoryItem]:
+    """ Build a history where half of the item ids are repeated """
+    rng = random.Random(rows)
+    return [
+        HistoryItem(rng.randrange(rows // 2), rng.randrange(1_000_000))
+        for _ in range(rows)
+    ]
+
+
+def get_latest_by_group_scan(history_items: list[HistoryItem]) -> list[HistoryItem]:
+    """ The grouping MediaServerSync used before get_latest_per_key """
+    return_history: list[HistoryItem] = []
+    compare_groups: list[list[HistoryItem]] = []
+    for item in history_items:
+        item_found: bool = False
+        for group in compare_groups:
+            for group_item in group:
+                if group_item.id == item.id:
+                    group.append(item)
+                    item_found = True
+                    break
+        if not item_found:
+            compare_groups.append([item])
+
+    for compare_group in compare_groups:
+        item_candidate: HistoryItem = None
+        for group_item in compare_group:
+            if item_candidate is None:
+                item_candidate = group_item
+            elif group_item.date_watched > item_candidate.date_watched:
+                item_candidate = group_item
+        if item_candidate is not None:
+            return_history.append(item_candidate)
+
+    return return_history
+
+
+def get_latest_by_key(history_items: list[HistoryItem]) -> list[HistoryItem]:
+    """ The single pass reducer """
+    return utils.get_latest_per_key(
+        history_items,
+        lambda item: item.id,
+        lambda item: item.date_watched
+    )
+
+
+def get_best_ms(function, history_items: list[HistoryItem], number: int) -> float:
+    """ Best time of a few repeats in milliseconds per call """
+    return min(
+        timeit.repeat(lambda: function(history_items), number=number, repeat=3)
+    ) / number * 1000
+
+
+def main():
+    print(f"{'rows':>6} {'group scan':>12} {'per key':>10} {'per key / row':>14}")
+    for rows in (1000, 2000, 4000, 8000):
+        history_items = get_history(rows)
+        if get_latest_by_group_scan(history_items) != get_latest_by_key(history_items):
+            raise RuntimeError(f"Reducers disagree for {rows} rows")
+
+        scan_ms = get_best_ms(get_latest_by_group_scan, history_items, 1)
+        key_ms = get_best_ms(get_latest_by_key, history_items, 20)
+        print(
+            f"{rows:>6} {scan_ms:>10.1f}ms {key_ms:>8.2f}ms "
+            f"{key_ms / rows * 1_000_000:>11.1f}ns"
+        )
+
+
+if __name__ == "__main__":
+    main()